@@ -0,0 +1,72 @@
+#!/usr/bin/env python2
+"""
+Audit log overhead benchmark.
+
+Times AuditLog.record() against writing the same information as a
+line of text through the logging module, the obvious alternative.
+"""
+from mysqlproxy.audit import AuditLog
+import argparse
+import tempfile
+import logging
+import random
+import shutil
+import time
+import os
+
+
+def build_queries(num_queries):
+    rand = random.Random(42)
+    return ["SELECT id, name, total FROM orders_%d WHERE customer_id = %d "
+        "AND status = 'shipped' ORDER BY id DESC" % (rand.randrange(0, 50),
+            rand.randrange(0, 100000)) for _ in xrange(0, num_queries)]
+
+
+def bench_text_log(path, queries):
+    logger = logging.getLogger('bench_audit')
+    logger.propagate = False
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    try:
+        for session_id, query in enumerate(queries):
+            logger.info('%d %s %d [%d] %s', session_id, 'app', 3, 0, query)
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+
+def bench_audit_log(path, queries):
+    audit_log = AuditLog(path, capacity=16 * 1024 * 1024)
+    record = audit_log.record
+    try:
+        for session_id, query in enumerate(queries):
+            record(session_id, 'app', 3, query, 0)
+    finally:
+        audit_log.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--queries', default=200000, type=int,
+        help='Queries logged')
+    largs = parser.parse_args()
+
+    queries = build_queries(largs.queries)
+    tmp_dir = tempfile.mkdtemp()
+    timings = {}
+    try:
+        for name, fn in [('text log', bench_text_log), ('AuditLog', bench_audit_log)]:
+            start = time.time()
+            fn(os.path.join(tmp_dir, name.replace(' ', '_')), queries)
+            timings[name] = time.time() - start
+            print '%-9s %8.2fs  %8.2f us/query' % (name, timings[name],
+                timings[name] / largs.queries * 1e6)
+    finally:
+        shutil.rmtree(tmp_dir)
+    print 'speedup: %.1fx' % (timings['text log'] / timings['AuditLog'])
+
+
+if __name__ == '__main__':
+    main()
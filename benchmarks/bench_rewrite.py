@@ -0,0 +1,94 @@
+#!/usr/bin/env python2
+"""
+Query rewrite overhead benchmark.
+
+Loads a set of generated rules (one per table, a mix of replace,
+hint and limit rules) and times QueryRewriter.rewrite() on a query
+mix mostly hitting no rule, against running every rule's regex on
+every query.
+"""
+from mysqlproxy.rewrite import QueryRewriter, RewriteRule
+import argparse
+import random
+import time
+
+
+def build_rules(num_rules):
+    rules = []
+    for i in xrange(0, num_rules):
+        table = 'table_%d' % i
+        kind = i % 3
+        if kind == 0:
+            rules.append(RewriteRule('replace-%d' % i,
+                r'\bfrom\s+%s\s+order\s+by\s+rand\(\)' % table,
+                replace='FROM %s' % table))
+        elif kind == 1:
+            rules.append(RewriteRule('hint-%d' % i,
+                r'^\s*select\b(?=.*\b%s\b)' % table,
+                hint='MAX_EXECUTION_TIME(1000)', keywords=[table]))
+        else:
+            rules.append(RewriteRule('limit-%d' % i,
+                r'^\s*select\b.*\bfrom\s+%s\b' % table, limit=1000))
+    return rules
+
+
+def build_queries(num_queries, num_rules, hit_ratio):
+    rand = random.Random(42)
+    queries = []
+    for i in xrange(0, num_queries):
+        if rand.random() < hit_ratio:
+            table = 'table_%d' % rand.randrange(0, num_rules)
+        else:
+            table = 'orders_%d' % rand.randrange(0, 50)
+        queries.append("SELECT id, name, total FROM %s WHERE customer_id = %d "
+            "AND status = 'shipped' ORDER BY id DESC" % (table, rand.randrange(0, 100000)))
+    return queries
+
+
+def bench_naive(rules, queries):
+    rewritten = 0
+    for query in queries:
+        original = query
+        for rule in rules:
+            result = rule.apply(query)
+            if result is not None:
+                query = result
+        if query is not original:
+            rewritten += 1
+    return rewritten
+
+
+def bench_rewriter(rules, queries):
+    rewriter = QueryRewriter(rules)
+    rewrite = rewriter.rewrite
+    rewritten = 0
+    for query in queries:
+        if rewrite(query) is not query:
+            rewritten += 1
+    return rewritten
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--rules', default=1000, type=int,
+        help='Rules loaded')
+    parser.add_argument('-n', '--queries', default=20000, type=int,
+        help='Queries rewritten')
+    parser.add_argument('--hit-ratio', default=0.05, type=float,
+        help='Share of queries some rule applies to')
+    largs = parser.parse_args()
+
+    rules = build_rules(largs.rules)
+    queries = build_queries(largs.queries, largs.rules, largs.hit_ratio)
+    timings = {}
+    for name, fn in [('every rule', bench_naive), ('QueryRewriter', bench_rewriter)]:
+        start = time.time()
+        rewritten = fn(rules, queries)
+        timings[name] = time.time() - start
+        print '%-14s %8.2fs  %8.1f us/query  %d rewritten' % (name, timings[name],
+            timings[name] / largs.queries * 1e6, rewritten)
+    print 'speedup: %.1fx' % (timings['every rule'] / timings['QueryRewriter'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python2
+"""
+Text protocol row encoding benchmark.
+
+Compares per-row ResultSetRowText packets against the batched
+TextRowEncoder on an integer/varchar result set.
+"""
+from mysqlproxy.query_response import ResultSetText, ResultSetRowText
+from mysqlproxy import column_types, capabilities
+import argparse
+import time
+
+
+class NullWriter(object):
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+
+def build_results(num_rows):
+    results = ResultSetText(capabilities.PROTOCOL_41)
+    results.add_column(u'id', column_types.LONGLONG, 20)
+    results.add_column(u'name', column_types.VAR_STRING, 64)
+    for i in xrange(0, num_rows):
+        results.add_row([i, 'user-%d@example.com' % i])
+    return results
+
+
+def bench_packets(results):
+    out = NullWriter()
+    seq_id = 0
+    for row_values in results.rows:
+        row = ResultSetRowText(row_values, seq_id=seq_id+1)
+        _, seq_id = row.write_out(out)
+    return out.written
+
+
+def bench_encoder(results):
+    out = NullWriter()
+    results.send_row_info(out, 0)
+    return out.written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--rows', default=1000000, type=int,
+        help='Rows in the result set')
+    largs = parser.parse_args()
+
+    results = build_results(largs.rows)
+    timings = {}
+    for name, fn in [('ResultSetRowText', bench_packets), ('TextRowEncoder', bench_encoder)]:
+        start = time.time()
+        written = fn(results)
+        timings[name] = time.time() - start
+        print '%-18s %8.2fs  %10.0f rows/s  %d bytes' % (name, timings[name],
+            largs.rows / timings[name], written)
+    print 'speedup: %.1fx' % (timings['ResultSetRowText'] / timings['TextRowEncoder'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python2
+"""
+TLS handshake benchmark.
+
+Connections per second the proxy's TLS setup handles with and
+without session resumption, on a self-signed certificate.  The load
+comes from `openssl s_time` (Python 2 can't resume sessions client
+side), which only speaks plain TLS, so the server here wraps sockets
+right away instead of after the MySQL greeting and SSL request;
+the handshake itself goes through the same TLSTerminator.  TLS 1.2,
+as s_time doesn't wait for TLS 1.3 tickets to resume with.
+"""
+from mysqlproxy.tls import TLSTerminator, TLSError, server_context, self_signed_cert
+import subprocess
+import threading
+import argparse
+import tempfile
+import shutil
+import socket
+import time
+import os
+
+
+def serve(listener, tls, stop):
+    while not stop.is_set():
+        incoming, _ = listener.accept()
+        try:
+            tls.shutdown(tls.wrap(incoming))
+        except TLSError:
+            pass
+        incoming.close()
+
+
+def bench(name, tls, seconds, reuse):
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+    port = listener.getsockname()[1]
+    stop = threading.Event()
+    server = threading.Thread(target=serve, args=(listener, tls, stop))
+    server.daemon = True
+    server.start()
+
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['openssl', 's_time', '-connect', '127.0.0.1:%d' % port,
+            '-tls1_2', '-reuse' if reuse else '-new', '-time', str(seconds)],
+            stdout=devnull, stderr=devnull)
+    elapsed = time.time() - start
+    stats = tls.stats()
+    print '%-18s %8.1f conn/s %8.3f ms/handshake in the proxy  %d/%d resumed' % (name,
+        stats['handshakes'] / elapsed, stats['avg_handshake_ms'], stats['resumed'],
+        stats['handshakes'])
+
+    stop.set()
+    socket.create_connection(('127.0.0.1', port)).close()
+    server.join()
+    listener.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-t', '--time', default=5, type=int,
+        help='Seconds per run')
+    parser.add_argument('--ciphers', default=None, type=str,
+        help='OpenSSL cipher list for the proxy')
+    largs = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        certfile, keyfile = self_signed_cert(tmp_dir)
+        runs = [
+            ('full handshake', True, False),
+            ('resumed (tickets)', True, True),
+            ('resumed (cache)', False, True),
+            ]
+        for name, tickets, reuse in runs:
+            tls = TLSTerminator(server_context(certfile, keyfile, ciphers=largs.ciphers,
+                session_tickets=tickets))
+            bench(name, tls, largs.time, reuse)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
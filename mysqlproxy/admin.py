@@ -0,0 +1,186 @@
+"""
+In-band admin commands.
+
+Queries starting with PROXY are answered by the proxy itself from
+its in-process counters, never going near the backend:
+
+    PROXY SHOW STATS        every counter, as (component, name, value)
+    PROXY SHOW SESSIONS     one row per client session
+    PROXY SHOW POOLS        backend connection pool usage
+    PROXY SHOW BACKENDS     health of the backend groups' members
+    PROXY SHOW CACHE        hit rates of the shared caches
+    PROXY PROFILE START     start the sampling profiler
+    PROXY PROFILE STOP      stop it, returning the collapsed stacks
+"""
+from mysqlproxy.query_response import StreamingResultSetText
+from mysqlproxy.packet import OKPacket, ERRPacket
+from mysqlproxy import column_types, error_codes as errs
+from itertools import islice
+import logging
+import time
+import re
+
+_LOG = logging.getLogger(__name__)
+
+_ADMIN_COMMAND = re.compile(r'^\s*proxy\s+(\w+(?:\s+\w+)*)\s*;?\s*$', re.I)
+
+
+def is_admin_command(query):
+    return query[:5].lower() == 'proxy' and _ADMIN_COMMAND.match(query) is not None
+
+
+def result_set(session_obj, column_names, rows):
+    """
+    Text result set of string columns named `column_names`
+    """
+    rows = [[value if value is None else unicode(value) for value in row]
+        for row in rows]
+    row_iter = iter(rows)
+    response = StreamingResultSetText(session_obj.client_capabilities,
+        lambda size: list(islice(row_iter, size)),
+        flags=session_obj.server_status)
+    for pos, name in enumerate(column_names):
+        width = max([len(row[pos] or u'') for row in rows] + [len(name), 16])
+        response.add_column(unicode(name), column_types.VAR_STRING, width)
+    return response
+
+
+def component_stats(proxy):
+    """
+    (component, stats dict) for each shared component in use
+    """
+    components = [
+        ('sessions', {'active': len(proxy.registry)}),
+        ]
+    for name in ('tenant_router', 'backend_group', 'pool', 'preconnect', 'field_list_cache',
+            'column_block_cache', 'memory_budget', 'timer_wheel', 'rewriter', 'admission',
+            'hedge', 'slow_log', 'audit_log', 'capture', 'local_infile_stats', 'tls',
+            'profiler'):
+        component = getattr(proxy, name, None)
+        if component is not None:
+            components.append((name, component.stats()))
+    return components
+
+
+def show_stats(session_obj):
+    rows = []
+    for component, stats in component_stats(session_obj.proxy_obj):
+        for name in sorted(stats):
+            rows.append((component, name, stats[name]))
+    return result_set(session_obj, ('Component', 'Name', 'Value'), rows)
+
+
+def show_sessions(session_obj):
+    now = time.time()
+    rows = []
+    for conn_id, proxy, started in session_obj.proxy_obj.registry.snapshot():
+        state = proxy.state
+        rows.append((conn_id, proxy.session.username, state.default_db,
+            state.charset, proxy.backend_thread_id(),
+            'Query' if proxy.in_query else 'Sleep',
+            int(now - started), state.pinned_reason))
+    return result_set(session_obj, ('Id', 'User', 'Db', 'Charset', 'Backend_thread',
+        'Command', 'Time', 'Pinned'), rows)
+
+
+def show_pools(session_obj):
+    pool = session_obj.proxy_obj.pool
+    if pool is None:
+        return result_set(session_obj, ('Pool',), [])
+    stats = pool.stats()
+    names = sorted(stats)
+    return result_set(session_obj, ['Pool'] + [name.capitalize() for name in names],
+        [['default'] + [stats[name] for name in names]])
+
+
+def show_backends(session_obj):
+    proxy = session_obj.proxy_obj
+    router = getattr(proxy, 'tenant_router', None)
+    if router is not None:
+        groups = router.groups()
+    elif proxy.backend_group is not None:
+        groups = [(None, proxy.backend_group)]
+    else:
+        groups = []
+    now = time.time()
+    rows = []
+    for cluster, group in groups:
+        for backend in group.backends:
+            rows.append((cluster, backend.name, 'up' if backend.healthy else 'down',
+                backend.consecutive_failures,
+                int(now - backend.last_change) if backend.last_change else None,
+                int(backend.last_check_time * 1000) if backend.last_check_time is not None
+                    else None,
+                u'%.2f' % (group.load(backend, now) * 1000), backend.in_flight,
+                backend.last_error))
+    return result_set(session_obj, ('Cluster', 'Backend', 'State', 'Failures', 'Since',
+        'Check_ms', 'Load_ms', 'In_flight', 'Last_error'), rows)
+
+
+def show_cache(session_obj):
+    proxy = session_obj.proxy_obj
+    rows = []
+    for name in ('field_list_cache', 'column_block_cache'):
+        cache = getattr(proxy, name)
+        if cache is not None:
+            stats = cache.stats()
+            rows.append((name, stats['entries'], stats['hits'], stats['misses']))
+    if proxy.rewriter is not None:
+        stats = proxy.rewriter.stats()
+        rows.append(('rewrite_memo', stats['memo_entries'], stats['memo_hits'],
+            stats['queries'] - stats['memo_hits']))
+    rows = [row + (u'%.1f%%' % (100.0 * row[2] / (row[2] + row[3]))
+        if row[2] + row[3] else None,) for row in rows]
+    return result_set(session_obj, ('Cache', 'Entries', 'Hits', 'Misses', 'Hit_rate'),
+        rows)
+
+
+def profile_start(session_obj):
+    profiler = session_obj.proxy_obj.profiler
+    if profiler is None:
+        return ERRPacket(session_obj.client_capabilities, errs.UNKNOWN_COMMAND,
+            u'Profiling is not enabled', seq_id=1)
+    profiler.reset()
+    started = profiler.start()
+    return OKPacket(session_obj.client_capabilities, 0, 0, seq_id=1,
+        status_flags=session_obj.server_status,
+        info=u'profiler started' if started else u'profiler already running')
+
+
+def profile_stop(session_obj):
+    profiler = session_obj.proxy_obj.profiler
+    if profiler is None:
+        return ERRPacket(session_obj.client_capabilities, errs.UNKNOWN_COMMAND,
+            u'Profiling is not enabled', seq_id=1)
+    profiler.stop()
+    rows = [line.rsplit(' ', 1) for line in profiler.collapsed()]
+    return result_set(session_obj, ('Stack', 'Samples'), rows)
+
+
+COMMANDS = {
+    'show stats': show_stats,
+    'show sessions': show_sessions,
+    'show pools': show_pools,
+    'show backends': show_backends,
+    'show cache': show_cache,
+    'profile start': profile_start,
+    'profile stop': profile_stop,
+    }
+
+
+def run_admin_command(session_obj, query):
+    """
+    Response to admin command `query`
+    """
+    proxy = session_obj.proxy_obj
+    if proxy.admin_users is not None and session_obj.username not in proxy.admin_users:
+        return ERRPacket(session_obj.client_capabilities, errs.ACCESS_DENIED,
+            u'Access denied to proxy admin commands', seq_id=1)
+    command = ' '.join(_ADMIN_COMMAND.match(query).group(1).lower().split())
+    command_fn = COMMANDS.get(command)
+    if command_fn is None:
+        return ERRPacket(session_obj.client_capabilities, errs.UNKNOWN_COMMAND,
+            u'Unknown proxy command: %s (try one of: %s)' % (command,
+                ', '.join(sorted(COMMANDS))), seq_id=1)
+    _LOG.debug('Admin command from connection %d: %s' % (proxy.connection_id, command))
+    return command_fn(session_obj)
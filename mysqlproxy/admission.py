@@ -0,0 +1,284 @@
+"""
+Admission control.
+
+Caps how many queries a user (or a query fingerprint) may have
+running at once and how many per second it may start, plus how many
+client handshakes may be in flight.  Requests over a limit wait
+for up to `queue_timeout` seconds and are turned away after that.
+
+State is kept per user / fingerprint, each behind its own lock,
+so sessions of different users never contend with each other.
+Limits can be changed while running with set_limits() and
+set_user_limits().
+"""
+import threading
+import logging
+import time
+
+_LOG = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class TokenBucket(object):
+    """
+    `rate` tokens per second, holding at most `burst`
+    """
+    def __init__(self, rate, burst=None):
+        self.lock = threading.Lock()
+        self.rate = 0.0
+        self.burst = 0.0
+        self.reconfigure(rate, burst)
+        self.tokens = self.burst
+        self.updated = time.time()
+
+    def reconfigure(self, rate, burst=None):
+        with self.lock:
+            self.rate = float(rate)
+            self.burst = float(burst or max(rate, 1))
+
+    def reserve(self, max_wait=0.0, now=None):
+        """
+        Take a token.  Returns how long to wait before using it
+        (0 if there was one right away), or None if that would be
+        longer than `max_wait`, in which case nothing is taken.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if tokens >= 1:
+                self.tokens = tokens - 1
+                return 0.0
+            wait = (1 - tokens) / self.rate
+            if wait > max_wait:
+                self.tokens = tokens
+                return None
+            # going into debt keeps later callers queued behind us
+            self.tokens = tokens - 1
+            return wait
+
+    @property
+    def idle(self):
+        return self.tokens + (time.time() - self.updated) * self.rate >= self.burst
+
+
+class ConcurrencyLimit(object):
+    """
+    Counting semaphore whose size can change while in use.
+    A limit of 0 means no limit.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, timeout=0.0):
+        with self.cond:
+            if not self.limit or self.active < self.limit:
+                self.active += 1
+                return True
+            deadline = time.time() + timeout
+            self.waiting += 1
+            try:
+                while self.limit and self.active >= self.limit:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def set_limit(self, limit):
+        with self.cond:
+            self.limit = limit
+            self.cond.notify_all()
+
+    @property
+    def idle(self):
+        return self.active == 0 and self.waiting == 0
+
+
+class Admission(object):
+    """
+    Returned by AdmissionController.admit(), release()
+    it once the query is done
+    """
+    __slots__ = ('slots',)
+
+    def __init__(self, slots):
+        self.slots = slots
+
+    def release(self):
+        slots, self.slots = self.slots, ()
+        for slot in slots:
+            slot.release()
+
+
+class AdmissionController(object):
+    """
+    Shared by all sessions.  All limits default to 0, no limit.
+    """
+    LIMIT_NAMES = ('user_concurrency', 'user_qps', 'fingerprint_concurrency',
+        'fingerprint_qps', 'max_handshakes', 'queue_timeout')
+
+    def __init__(self, user_concurrency=0, user_qps=0, fingerprint_concurrency=0,
+            fingerprint_qps=0, max_handshakes=0, queue_timeout=0.0, max_keys=10000):
+        self.user_concurrency = user_concurrency
+        self.user_qps = user_qps
+        self.fingerprint_concurrency = fingerprint_concurrency
+        self.fingerprint_qps = fingerprint_qps
+        self.max_handshakes = max_handshakes
+        self.queue_timeout = queue_timeout
+        self.max_keys = max_keys
+        self.user_overrides = {} # user -> {'concurrency': n, 'qps': n}
+        # (kind, key) -> ConcurrencyLimit / TokenBucket, created on first use
+        self.slots = {}
+        self.buckets = {}
+        self.handshakes = ConcurrencyLimit(max_handshakes)
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.handshakes_rejected = 0
+        # only held while creating, pruning or reconfiguring entries
+        self.lock = threading.Lock()
+
+    @property
+    def needs_fingerprint(self):
+        return bool(self.fingerprint_concurrency or self.fingerprint_qps)
+
+    def _user_limit(self, user, name):
+        overrides = self.user_overrides.get(user)
+        if overrides is not None and overrides.get(name) is not None:
+            return overrides[name]
+        return getattr(self, 'user_%s' % name)
+
+    def _limit(self, kind, key, name):
+        if kind == 'user':
+            return self._user_limit(key, name)
+        return getattr(self, 'fingerprint_%s' % name)
+
+    def _get_or_create(self, table, kind, key, factory):
+        entry = table.get((kind, key))
+        if entry is not None:
+            return entry
+        with self.lock:
+            entry = table.get((kind, key))
+            if entry is None:
+                if len(table) >= self.max_keys:
+                    self._prune(table)
+                entry = table[(kind, key)] = factory()
+        return entry
+
+    def _prune(self, table):
+        for table_key, entry in table.items():
+            if entry.idle:
+                del table[table_key]
+
+    def admit(self, user, normalized=None):
+        """
+        Wait for room to run a query of `user` with fingerprint
+        `normalized` (None to skip fingerprint limits).
+        Returns an Admission, raises AdmissionRejected.
+        """
+        deadline = time.time() + self.queue_timeout
+        keys = [('user', user)]
+        if normalized is not None:
+            keys.append(('fingerprint', normalized))
+        for kind, key in keys:
+            rate = self._limit(kind, key, 'qps')
+            if not rate:
+                continue
+            bucket = self._get_or_create(self.buckets, kind, key,
+                lambda: TokenBucket(rate))
+            now = time.time()
+            wait = bucket.reserve(deadline - now, now)
+            if wait is None:
+                self.rejected += 1
+                raise AdmissionRejected('%s query rate limit reached' % kind)
+            if wait > 0:
+                self.queued += 1
+                time.sleep(wait)
+        acquired = []
+        for kind, key in keys:
+            limit = self._limit(kind, key, 'concurrency')
+            if not limit:
+                continue
+            slot = self._get_or_create(self.slots, kind, key,
+                lambda: ConcurrencyLimit(limit))
+            if not slot.acquire(deadline - time.time()):
+                for held in acquired:
+                    held.release()
+                self.rejected += 1
+                raise AdmissionRejected('too many concurrent queries for %s' % kind)
+            acquired.append(slot)
+        self.admitted += 1
+        return Admission(acquired)
+
+    def begin_handshake(self):
+        """
+        False if too many handshakes are in progress already
+        """
+        if self.handshakes.acquire(self.queue_timeout):
+            return True
+        self.handshakes_rejected += 1
+        return False
+
+    def end_handshake(self):
+        self.handshakes.release()
+
+    def set_limits(self, **limits):
+        """
+        Change any of LIMIT_NAMES while running
+        """
+        for name, value in limits.items():
+            if name not in self.LIMIT_NAMES:
+                raise ValueError('unknown limit %s' % name)
+        with self.lock:
+            for name, value in limits.items():
+                setattr(self, name, value)
+            self.handshakes.set_limit(self.max_handshakes)
+            for (kind, key), slot in self.slots.items():
+                slot.set_limit(self._limit(kind, key, 'concurrency'))
+            for (kind, key), bucket in self.buckets.items():
+                rate = self._limit(kind, key, 'qps')
+                if rate:
+                    bucket.reconfigure(rate)
+                else:
+                    del self.buckets[(kind, key)]
+
+    def set_user_limits(self, user, concurrency=None, qps=None):
+        """
+        Override the default limits for one user (None
+        reverts to the default)
+        """
+        with self.lock:
+            self.user_overrides[user] = {'concurrency': concurrency, 'qps': qps}
+            slot = self.slots.get(('user', user))
+            if slot is not None:
+                slot.set_limit(self._user_limit(user, 'concurrency'))
+            # picked up again with the new rate on next use
+            self.buckets.pop(('user', user), None)
+
+    def stats(self):
+        stats = dict([(name, getattr(self, name)) for name in self.LIMIT_NAMES])
+        stats.update({
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'rejected': self.rejected,
+            'handshakes_active': self.handshakes.active,
+            'handshakes_rejected': self.handshakes_rejected,
+            'tracked_keys': len(self.slots) + len(self.buckets),
+            })
+        return stats
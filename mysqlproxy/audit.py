@@ -0,0 +1,270 @@
+"""
+Binary audit log.
+
+Every client command is appended to a fixed size file, mapped
+into memory and used as a ring: once it's full the oldest records
+get overwritten.  Writing one is a struct.pack_into() and a slice
+copy into the map, no system call, no formatting.
+
+File layout, all little endian:
+
+    header (64 bytes): magic, version, capacity, head, tail, records
+    ring (capacity bytes): records, each 8 byte aligned
+
+head and tail are absolute byte offsets (they only ever grow, the
+position in the ring is offset % capacity): head is where the next
+record goes, tail where the oldest complete one starts.  A record is
+
+    length u32, command u8, flags u8, user length u16, time f64,
+    session id u32, status u16, query length u16, user, query
+
+`status` is 0 for success, the MySQL error code sent otherwise or
+STATUS_NO_RESPONSE.  Records never wrap around the end of the ring,
+what's left there is filled with a PAD record instead.
+
+AuditLogReader decodes the file, it's safe to read while the proxy
+writes to it (see scripts/mysqlproxy-audit).
+"""
+import threading
+import datetime
+import struct
+import mmap
+import time
+import os
+
+MAGIC = 'MPAUDIT\x00'
+VERSION = 1
+
+HEADER = struct.Struct('<8sIIQQQ')
+HEADER_SIZE = 64
+RECORD = struct.Struct('<IBBHdIHH')
+# enough to skip a record, all a PAD is (it may be just 8 bytes)
+RECORD_START = struct.Struct('<IB')
+# head, tail and records, rewritten after every record
+HEADER_COUNTERS = struct.Struct('<QQQ')
+HEADER_COUNTERS_OFFSET = 16
+
+PAD = 0xff
+FLAG_TRUNCATED = 0x01
+STATUS_NO_RESPONSE = 0xffff
+
+MAX_QUERY_LENGTH = 0xffff
+
+
+def _align(size):
+    return (size + 7) & ~7
+
+
+class AuditLogError(Exception):
+    pass
+
+
+class AuditLog(object):
+    """
+    Shared by all sessions.  Opens (or creates) the ring file
+    at `path`; an existing one is appended to if its capacity
+    matches, started over otherwise.
+    """
+    def __init__(self, path, capacity=64 * 1024 * 1024, max_query_length=4096):
+        capacity = _align(capacity)
+        self.path = path
+        self.capacity = capacity
+        # a record can't take more than a quarter of the ring
+        self.max_query_length = min(max_query_length, MAX_QUERY_LENGTH,
+            capacity / 4 - RECORD.size - 255)
+        if self.max_query_length <= 0:
+            raise AuditLogError('audit log capacity %d is too small' % capacity)
+        self.lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        existing = os.fstat(self.fd).st_size
+        if existing != HEADER_SIZE + capacity:
+            os.ftruncate(self.fd, 0)
+            os.ftruncate(self.fd, HEADER_SIZE + capacity)
+        self.map = mmap.mmap(self.fd, HEADER_SIZE + capacity)
+        magic, version, file_capacity, head, tail, records = \
+            HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION or file_capacity != capacity:
+            head = tail = records = 0
+            HEADER.pack_into(self.map, 0, MAGIC, VERSION, capacity, 0, 0, 0)
+        self.head = head
+        self.tail = tail
+        self.records = records
+        self.dropped = 0
+
+    def record(self, session_id, user, command, query, status=0, when=None):
+        """
+        Append one record.  `user` and `query` are byte
+        strings (unicode gets UTF-8 encoded).
+        """
+        if isinstance(user, unicode):
+            user = user.encode('utf8')
+        if isinstance(query, unicode):
+            query = query.encode('utf8')
+        user = (user or '')[:255]
+        flags = 0
+        if len(query) > self.max_query_length:
+            query = query[:self.max_query_length]
+            flags |= FLAG_TRUNCATED
+        if when is None:
+            when = time.time()
+        length = RECORD.size + len(user) + len(query)
+        size = _align(length)
+        with self.lock:
+            if self.map is None:
+                self.dropped += 1
+                return
+            pos = self._reserve(size)
+            data = self.map
+            RECORD.pack_into(data, pos, size, command, flags, len(user), when,
+                session_id, status, len(query))
+            pos += RECORD.size
+            data[pos:pos + len(user)] = user
+            pos += len(user)
+            data[pos:pos + len(query)] = query
+            self.records += 1
+            # only after the record's in place, so readers never see half of it
+            HEADER_COUNTERS.pack_into(data, HEADER_COUNTERS_OFFSET, self.head,
+                self.tail, self.records)
+
+    def _reserve(self, size):
+        """
+        Make room for `size` bytes at the head, returns
+        their position in the map.  Call with the lock held.
+        """
+        capacity = self.capacity
+        offset = self.head % capacity
+        if offset + size > capacity:
+            # no room before the end, pad it out and start over at 0
+            pad_size = capacity - offset
+            self._evict(pad_size)
+            RECORD_START.pack_into(self.map, HEADER_SIZE + offset, pad_size, PAD)
+            self.head += pad_size
+            offset = 0
+        self._evict(size)
+        self.head += size
+        return HEADER_SIZE + offset
+
+    def _evict(self, size):
+        # drop the oldest records until `size` more bytes fit
+        data = self.map
+        while self.head + size - self.tail > self.capacity:
+            self.tail += struct.unpack_from('<I', data,
+                HEADER_SIZE + self.tail % self.capacity)[0]
+
+    def flush(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.flush()
+
+    def close(self):
+        with self.lock:
+            if self.map is None:
+                return
+            self.map.flush()
+            self.map.close()
+            self.map = None
+            os.close(self.fd)
+
+    def stats(self):
+        return {
+            'capacity': self.capacity,
+            'records': self.records,
+            'bytes_used': self.head - self.tail,
+            'dropped': self.dropped,
+            }
+
+
+class AuditRecord(object):
+    __slots__ = ('offset', 'time', 'session_id', 'user', 'command', 'query',
+        'status', 'truncated')
+
+    def __init__(self, offset, when, session_id, user, command, query, status,
+            truncated):
+        self.offset = offset
+        self.time = when
+        self.session_id = session_id
+        self.user = user
+        self.command = command
+        self.query = query
+        self.status = status
+        self.truncated = truncated
+
+    def format(self, command_names=None):
+        command = (command_names or {}).get(self.command, '0x%02x' % self.command)
+        if self.status == 0:
+            status = 'ok'
+        elif self.status == STATUS_NO_RESPONSE:
+            status = 'none'
+        else:
+            status = 'err %d' % self.status
+        when = datetime.datetime.fromtimestamp(self.time).strftime('%Y-%m-%d %H:%M:%S.%f')
+        return '%s %d %s %s [%s] %s%s' % (when, self.session_id, self.user, command,
+            status, self.query.replace('\n', ' '), '...' if self.truncated else '')
+
+
+class AuditLogReader(object):
+    """
+    Reads records out of an audit log file, including
+    one the proxy is still writing to
+    """
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size < HEADER_SIZE:
+            raise AuditLogError('%s is not an audit log' % path)
+        self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+        magic, version, self.capacity, _, _, _ = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION or size != HEADER_SIZE + self.capacity:
+            raise AuditLogError('%s is not an audit log' % path)
+        # times the writer overwrote records before we got to them
+        self.lost = 0
+
+    def bounds(self):
+        """
+        (head, tail, records) as last written
+        """
+        return HEADER_COUNTERS.unpack_from(self.map, HEADER_COUNTERS_OFFSET)
+
+    def read(self, offset=None):
+        """
+        Records from absolute `offset` (the oldest one left if
+        None) up to the head.  Returns (records, offset to carry
+        on from).
+        """
+        head, tail, _ = self.bounds()
+        if offset is None:
+            offset = tail
+        elif offset < tail:
+            self.lost += 1
+            offset = tail
+        records = []
+        data = self.map
+        capacity = self.capacity
+        while offset < head:
+            pos = HEADER_SIZE + offset % capacity
+            size, command = RECORD_START.unpack_from(data, pos)
+            record = None
+            if command != PAD and pos + RECORD.size <= HEADER_SIZE + capacity:
+                _, _, flags, user_len, when, session_id, status, query_len = \
+                    RECORD.unpack_from(data, pos)
+                start = pos + RECORD.size
+                record = AuditRecord(offset, when, session_id,
+                    data[start:start + user_len], command,
+                    data[start + user_len:start + user_len + query_len],
+                    status, bool(flags & FLAG_TRUNCATED))
+            # the writer may have lapped us while we were copying
+            tail = self.bounds()[1]
+            if tail > offset:
+                self.lost += 1
+                offset = tail
+                continue
+            if size < 8 or size % 8 or size > capacity or (record is None and command != PAD):
+                raise AuditLogError('corrupt record at offset %d' % offset)
+            if record is not None:
+                records.append(record)
+            offset += size
+        return records, offset
+
+    def close(self):
+        self.map.close()
+        self.file.close()
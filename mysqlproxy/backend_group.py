@@ -0,0 +1,361 @@
+"""
+Backend groups with health checking and failover.
+
+A group is an ordered list of backends serving the same data, the
+first one preferred.  A thread checks each of them every `interval`
+seconds: a ping and `check_query` over a connection kept for the
+purpose, all within `timeout` seconds.  `fall` failures in a row
+(checks or connects from sessions) eject a backend, `rise`
+successful checks in a row put it back.
+
+New backend connections (for sessions, the multiplexing pool and
+pre-connects) go to the first healthy backend, moving on to the
+next if connecting fails.  Connections already open to a backend
+that gets ejected are left alone, but the multiplexing and
+pre-connect pools close their idle ones rather than hand them out.
+
+For groups of equivalent replicas, balance=P2C spreads connections
+by load instead: of two healthy backends picked at random, the one
+with the lower EWMA of query response time, times one more than its
+queries in flight, gets it.  Response times come from the sessions
+timing cursor.execute (see observe()), and decay while a backend
+sits unused so one that was slow once gets tried again.  With
+multiplexing, the pool uses the same rule to pick among idle
+connections for every transaction.
+"""
+from mysqlproxy.client import ProxyConnection
+import threading
+import logging
+import random
+import math
+import time
+
+_LOG = logging.getLogger(__name__)
+
+# balancing modes: first healthy backend, or power of two choices
+PRIORITY = 'priority'
+P2C = 'p2c'
+
+
+class NoHealthyBackend(Exception):
+    pass
+
+
+class Backend(object):
+    """
+    One member of a BackendGroup: where it is and how it's doing
+    """
+    def __init__(self, host=None, port=3306, unix_socket=None, name=None):
+        self.host = host or 'localhost'
+        self.port = port
+        self.unix_socket = unix_socket
+        self.name = name or unix_socket or '%s:%d' % (self.host, port)
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.consecutive_successes = 0
+        self.last_error = None
+        self.last_check = None
+        self.last_check_time = None
+        self.last_change = None
+        # connection health checks go over, reconnected as needed
+        self.check_conn = None
+        # seconds, moving average of query response times
+        self.ewma = 0.0
+        self.last_observed = None
+        self.in_flight = 0
+        self.queries = 0
+
+    def connect(self, connection_class=ProxyConnection, **kwargs):
+        """
+        New connection to this backend, tagged with it
+        """
+        if self.unix_socket:
+            conn = connection_class(unix_socket=self.unix_socket, **kwargs)
+        else:
+            conn = connection_class(self.host, port=self.port, **kwargs)
+        conn.backend = self
+        return conn
+
+    def __repr__(self):
+        return '<Backend %s %s>' % (self.name, 'up' if self.healthy else 'down')
+
+
+def parse_backend(spec):
+    """
+    Backend from 'host:port', 'host' or a UNIX socket path
+    """
+    if spec.startswith('/'):
+        return Backend(unix_socket=spec)
+    host, _, port = spec.rpartition(':')
+    if not host:
+        return Backend(spec)
+    return Backend(host, port=int(port))
+
+
+class BackendGroup(object):
+    """
+    `backends` in order of preference.  `user`/`passwd` log in
+    the health check connections, made with `connection_class`.
+    `balance` is PRIORITY or P2C; with P2C, `ewma_weight` is how
+    much each response time counts and `decay_time` how fast
+    (seconds) an idle backend's average falls off.
+    """
+    def __init__(self, backends, user=None, passwd=None, check_query='SELECT 1',
+            interval=2.0, timeout=1.0, fall=3, rise=2, connection_class=ProxyConnection,
+            balance=PRIORITY, ewma_weight=0.2, decay_time=10.0):
+        if not backends:
+            raise ValueError('a backend group needs at least one backend')
+        if balance not in (PRIORITY, P2C):
+            raise ValueError('unknown balancing mode: %s' % balance)
+        self.backends = list(backends)
+        self.user = user
+        self.passwd = passwd
+        self.check_query = check_query
+        self.interval = interval
+        self.timeout = timeout
+        self.fall = fall
+        self.rise = rise
+        self.connection_class = connection_class
+        self.balance = balance
+        self.ewma_weight = ewma_weight
+        self.decay_time = decay_time
+        self.lock = threading.Lock()
+        self.checks = 0
+        self.check_failures = 0
+        self.connect_failures = 0
+        self.ejections = 0
+        self.reinstatements = 0
+        self.failovers = 0
+        self.running = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='health-check')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for backend in self.backends:
+            self.close_check_conn(backend)
+
+    def run(self):
+        while self.running:
+            began = time.time()
+            self.check_all()
+            self.stopped.wait(max(0, self.interval - (time.time() - began)))
+
+    def healthy(self):
+        return [backend for backend in self.backends if backend.healthy]
+
+    def candidates(self, exclude=None):
+        """
+        Backends to try connecting to, in order, but for
+        `exclude`.  With none healthy, all of them: some may
+        be back before the checks notice.
+        """
+        backends = [backend for backend in self.healthy() or self.backends
+            if backend is not exclude]
+        if self.balance == P2C and len(backends) > 1:
+            first = self.pick(backends)
+            backends.remove(first)
+            now = time.time()
+            backends.sort(key=lambda backend: self.load(backend, now))
+            backends.insert(0, first)
+        return backends
+
+    def load(self, backend, now=None):
+        """
+        Expected wait for a query sent to `backend`
+        """
+        if backend.last_observed is None:
+            return 0.0
+        if now is None:
+            now = time.time()
+        idle = max(0.0, now - backend.last_observed)
+        return backend.ewma * math.exp(-idle / self.decay_time) * (backend.in_flight + 1)
+
+    def pick(self, backends):
+        """
+        Less loaded of two of `backends` picked at random
+        """
+        if len(backends) == 1:
+            return backends[0]
+        first, second = random.sample(backends, 2)
+        now = time.time()
+        if self.load(second, now) < self.load(first, now):
+            return second
+        return first
+
+    def choose(self, conns):
+        """
+        Index of the connection in `conns` to hand out, for the
+        pool to pick among idle ones by their backends' load
+        """
+        if len(conns) == 1:
+            return 0
+        first, second = random.sample(xrange(len(conns)), 2)
+        now = time.time()
+        loads = [self.load(conns[index].backend, now)
+            if getattr(conns[index], 'backend', None) is not None else 0.0
+            for index in (first, second)]
+        return second if loads[1] < loads[0] else first
+
+    def begin(self, backend):
+        """
+        A query went out to `backend`
+        """
+        with self.lock:
+            backend.in_flight += 1
+
+    def observe(self, backend, elapsed):
+        """
+        A query `begin` was called for got its response
+        after `elapsed` seconds (None if it failed)
+        """
+        now = time.time()
+        with self.lock:
+            backend.in_flight -= 1
+            if elapsed is None:
+                return
+            backend.queries += 1
+            if backend.last_observed is None:
+                backend.ewma = elapsed
+            else:
+                decayed = backend.ewma * math.exp(
+                    -max(0.0, now - backend.last_observed) / self.decay_time)
+                backend.ewma = self.ewma_weight * elapsed + (1 - self.ewma_weight) * decayed
+            backend.last_observed = now
+
+    def connect(self, connection_class=None, exclude=None, **kwargs):
+        """
+        New connection to the first backend that takes one,
+        other than `exclude`
+        """
+        connection_class = connection_class or self.connection_class
+        last_error = None
+        for backend in self.candidates(exclude):
+            try:
+                conn = backend.connect(connection_class, **kwargs)
+            except Exception as ex:
+                _LOG.warning('Could not connect to backend %s: %s' % (backend.name, ex))
+                with self.lock:
+                    self.connect_failures += 1
+                self.record_failure(backend, ex)
+                last_error = ex
+                continue
+            if last_error is not None or (self.balance == PRIORITY
+                    and exclude is None and backend is not self.backends[0]):
+                # connections that went elsewhere than the preferred backend
+                with self.lock:
+                    self.failovers += 1
+            return conn
+        raise NoHealthyBackend('no backend could be connected to (last error: %s)' % last_error)
+
+    def is_usable(self, conn):
+        """
+        False for connections to a backend that has been
+        ejected since they were opened
+        """
+        backend = getattr(conn, 'backend', None)
+        return backend is None or backend.healthy
+
+    def check_all(self):
+        for backend in self.backends:
+            self.check(backend)
+
+    def check(self, backend):
+        """
+        Ping `backend` and run the check query on it,
+        counting the outcome.  Returns True if it passed.
+        """
+        began = time.time()
+        try:
+            conn = backend.check_conn
+            if conn is None or conn.socket is None:
+                conn = backend.check_conn = backend.connect(self.connection_class,
+                    user=self.user, passwd=self.passwd, connect_timeout=self.timeout)
+                conn.socket.settimeout(self.timeout)
+            else:
+                conn.ping(reconnect=False)
+            if self.check_query:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(self.check_query)
+                    cursor.fetchall()
+                finally:
+                    cursor.close()
+        except Exception as ex:
+            self.close_check_conn(backend)
+            with self.lock:
+                self.checks += 1
+                self.check_failures += 1
+            backend.last_check = time.time()
+            backend.last_check_time = backend.last_check - began
+            self.record_failure(backend, ex)
+            return False
+        with self.lock:
+            self.checks += 1
+        backend.last_check = time.time()
+        backend.last_check_time = backend.last_check - began
+        self.record_success(backend)
+        return True
+
+    def close_check_conn(self, backend):
+        conn, backend.check_conn = backend.check_conn, None
+        if conn is not None and conn.socket is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def record_failure(self, backend, error):
+        with self.lock:
+            backend.last_error = '%s' % error
+            backend.consecutive_successes = 0
+            backend.consecutive_failures += 1
+            if not backend.healthy or backend.consecutive_failures < self.fall:
+                return
+            backend.healthy = False
+            backend.last_change = time.time()
+            self.ejections += 1
+        _LOG.warning('Backend %s ejected after %d failures: %s' % (backend.name,
+            backend.consecutive_failures, error))
+
+    def record_success(self, backend):
+        with self.lock:
+            backend.consecutive_failures = 0
+            backend.consecutive_successes += 1
+            if backend.healthy or backend.consecutive_successes < self.rise:
+                return
+            backend.healthy = True
+            backend.last_change = time.time()
+            self.reinstatements += 1
+        _LOG.warning('Backend %s reinstated' % backend.name)
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                'members': len(self.backends),
+                'healthy': len(self.healthy()),
+                'checks': self.checks,
+                'check_failures': self.check_failures,
+                'connect_failures': self.connect_failures,
+                'ejections': self.ejections,
+                'reinstatements': self.reinstatements,
+                'failovers': self.failovers,
+                }
+            for backend in self.backends:
+                stats['%s.healthy' % backend.name] = int(backend.healthy)
+                stats['%s.consecutive_failures' % backend.name] = backend.consecutive_failures
+                stats['%s.queries' % backend.name] = backend.queries
+                stats['%s.in_flight' % backend.name] = backend.in_flight
+                stats['%s.ewma_ms' % backend.name] = backend.ewma * 1000
+        return stats
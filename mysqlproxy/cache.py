@@ -0,0 +1,155 @@
+"""
+In-process caches shared by all sessions
+"""
+from collections import OrderedDict
+import threading
+import logging
+import time
+import re
+
+_LOG = logging.getLogger(__name__)
+
+_IDENT = r'`?(\w+)`?'
+_QUALIFIED_IDENT = r'(?:%s\.)?%s' % (_IDENT, _IDENT)
+_DDL = re.compile(r'^\s*(?:create|alter|drop|rename|truncate)\s', re.I)
+_SCHEMA_DDL = re.compile(
+    r'^\s*(?:create|alter|drop)\s+(?:database|schema)\s+(?:if\s+(?:not\s+)?exists\s+)?'
+    + _IDENT, re.I)
+_TABLE_DDL = re.compile(
+    r'^\s*(?:(?:create|alter|drop)\s+(?:temporary\s+|online\s+|offline\s+|ignore\s+)*table'
+    r'|truncate(?:\s+table)?)\s+(?:if\s+(?:not\s+)?exists\s+)?'
+    + _QUALIFIED_IDENT + r'(?![\w`.])(?!\s*,)', re.I)
+_INDEX_DDL = re.compile(
+    r'^\s*(?:create\s+(?:unique\s+|fulltext\s+|spatial\s+)?|drop\s+)index\s+'
+    + _IDENT + r'\s+on\s+' + _QUALIFIED_IDENT, re.I)
+
+
+class FieldListCache(object):
+    """
+    COM_FIELD_LIST responses keyed by (schema, table, wildcard).
+    Entries are lists of serialized ColumnDefinition payloads so
+    a hit never goes near the field objects.
+    """
+    def __init__(self, ttl=60.0, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (expires_at, payloads)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, schema, table, wildcard):
+        key = (schema.lower(), table.lower(), wildcard)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, payloads = entry
+            if expires_at < time.time():
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.hits += 1
+            return payloads
+
+    def put(self, schema, table, wildcard, payloads):
+        key = (schema.lower(), table.lower(), wildcard)
+        with self.lock:
+            self.entries.pop(key, None)
+            while len(self.entries) >= self.max_entries:
+                self.entries.popitem(last=False)
+            self.entries[key] = (time.time() + self.ttl, payloads)
+
+    def invalidate(self, schema, table=None):
+        """
+        Drop every entry for `table` in `schema`, or for
+        the whole schema if no table is given
+        """
+        schema = schema.lower()
+        table = table.lower() if table else None
+        with self.lock:
+            for key in self.entries.keys():
+                if key[0] == schema and (table is None or key[1] == table):
+                    del self.entries[key]
+            self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.invalidations += 1
+
+    def observe_query(self, default_db, query):
+        """
+        Invalidate whatever a DDL statement passing through
+        the proxy may have changed.  If we can't tell what it
+        touched, everything goes.  True if `query` is DDL.
+        """
+        if not _DDL.match(query):
+            return False
+        match = _SCHEMA_DDL.match(query)
+        if match:
+            self.invalidate(match.group(1))
+            return True
+        match = _TABLE_DDL.match(query) or _INDEX_DDL.match(query)
+        if match:
+            schema, table = match.groups()[-2:]
+            schema = schema or default_db
+            if schema:
+                self.invalidate(schema, table)
+                return True
+        _LOG.debug('Unrecognized DDL, clearing field list cache: %s' % query)
+        self.clear()
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                }
+
+
+class ColumnBlockCache(object):
+    """
+    Serialized column metadata (see query_response.ColumnBlock)
+    keyed by result shape, evicted least recently used first
+    """
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # shape key -> ColumnBlock
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, shape_key):
+        with self.lock:
+            block = self.entries.pop(shape_key, None)
+            if block is None:
+                self.misses += 1
+                return None
+            self.entries[shape_key] = block
+            self.hits += 1
+            return block
+
+    def put(self, shape_key, block):
+        with self.lock:
+            self.entries.pop(shape_key, None)
+            while len(self.entries) >= self.max_entries:
+                self.entries.popitem(last=False)
+            self.entries[shape_key] = block
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                }
@@ -0,0 +1,173 @@
+"""
+Traffic capture.
+
+Records the commands clients send, one file per session, for
+replaying later (see mysqlproxy.replay).  Only what comes after the
+handshake is captured; the header keeps who the session was
+logged in as so a replay can log in the same way.
+
+File layout:
+
+    MPCAP1\\n
+    {"connection_id": 12, "user": "app", "db": "shop", ...}\\n
+    records: delay u32 (microseconds since the previous command,
+        or since the session started for the first), sequence id u8,
+        payload length u32, payload (as IncomingPacketChain read it)
+"""
+import threading
+import logging
+import struct
+import json
+import time
+import os
+
+_LOG = logging.getLogger(__name__)
+
+MAGIC = 'MPCAP1\n'
+RECORD = struct.Struct('<IBI')
+MAX_DELAY = 0xffffffff
+
+
+class CaptureError(Exception):
+    pass
+
+
+class SessionCapture(object):
+    """
+    Capture file of one session
+    """
+    def __init__(self, capture, path, header):
+        self.capture = capture
+        self.path = path
+        self.file = open(path, 'wb', 1<<16)
+        self.file.write(MAGIC + json.dumps(header, sort_keys=True) + '\n')
+        self.last = header['started']
+        self.commands = 0
+
+    def record(self, seq_id, payload, when=None):
+        if when is None:
+            when = time.time()
+        delay = min(MAX_DELAY, max(0, int((when - self.last) * 1e6)))
+        self.last = when
+        try:
+            self.file.write(RECORD.pack(delay, seq_id, len(payload)) + payload)
+        except (IOError, OSError) as ex:
+            _LOG.warning('Stopped capturing to %s: %s' % (self.path, ex))
+            self.close()
+            return
+        self.commands += 1
+        self.capture.count(len(payload))
+
+    def close(self):
+        if self.file is None:
+            return
+        try:
+            self.file.close()
+        except (IOError, OSError) as ex:
+            _LOG.warning('Could not finish capture %s: %s' % (self.path, ex))
+        self.file = None
+        self.capture.session_closed(self)
+
+    @property
+    def closed(self):
+        return self.file is None
+
+
+class TrafficCapture(object):
+    """
+    Shared by all sessions.  Captures every `sample_every`th
+    session into files in `directory`.
+    """
+    def __init__(self, directory, sample_every=1):
+        if not os.path.isdir(directory):
+            raise CaptureError('capture directory %s does not exist' % directory)
+        self.directory = directory
+        self.sample_every = max(1, sample_every)
+        self.lock = threading.Lock()
+        self.seen = 0
+        self.sessions = 0
+        self.active = 0
+        self.commands = 0
+        self.bytes = 0
+
+    def open_session(self, proxy):
+        """
+        SessionCapture for a session that just logged in,
+        None if it isn't sampled
+        """
+        with self.lock:
+            self.seen += 1
+            if (self.seen - 1) % self.sample_every:
+                return None
+            self.sessions += 1
+            self.active += 1
+        started = time.time()
+        header = {
+            'connection_id': proxy.connection_id,
+            'user': proxy.session.username,
+            'db': proxy.state.default_db,
+            'charset': proxy.state.charset,
+            'client_capabilities': proxy.session.client_capabilities,
+            'started': started,
+            }
+        path = os.path.join(self.directory, 'session-%d-%d.cap' % (int(started),
+            proxy.connection_id))
+        try:
+            return SessionCapture(self, path, header)
+        except (IOError, OSError) as ex:
+            _LOG.warning('Could not start capture %s: %s' % (path, ex))
+            with self.lock:
+                self.active -= 1
+            return None
+
+    def count(self, nbytes):
+        # not exact under contention, it's only for stats
+        self.commands += 1
+        self.bytes += nbytes
+
+    def session_closed(self, session_capture):
+        with self.lock:
+            self.active -= 1
+
+    def stats(self):
+        return {
+            'sample_every': self.sample_every,
+            'sessions': self.sessions,
+            'active': self.active,
+            'commands': self.commands,
+            'bytes': self.bytes,
+            }
+
+
+class CapturedSession(object):
+    """
+    A capture file read back in: `header` as written, and
+    `commands`, a list of (seconds since the session started,
+    sequence id, payload)
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as capture_file:
+            if capture_file.read(len(MAGIC)) != MAGIC:
+                raise CaptureError('%s is not a capture file' % path)
+            try:
+                self.header = json.loads(capture_file.readline())
+            except ValueError:
+                raise CaptureError('%s has a bad header' % path)
+            data = capture_file.read()
+        self.commands = []
+        offset = 0
+        elapsed = 0.0
+        while offset + RECORD.size <= len(data):
+            delay, seq_id, length = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            if offset + length > len(data):
+                # cut short, e.g. the proxy died mid-write
+                break
+            elapsed += delay / 1e6
+            self.commands.append((elapsed, seq_id, data[offset:offset + length]))
+            offset += length
+
+    @property
+    def started(self):
+        return self.header['started']
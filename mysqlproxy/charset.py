@@ -1,3 +1,8 @@
+"""
+MySQL character sets and their Python codecs
+"""
+import codecs
+
 CHARSETS = {
     #
     # id: charset_name, collation_name, is_default, mblen
@@ -211,16 +216,109 @@ for charset_id, charset_info in CHARSETS.items():
     if charset_info[2]:
         CHARSETS_BY_NAME[charset_info[0]] = (charset_id, charset_info)
 
+BINARY_CHARSET_ID = 63
+
+# MySQL charset name -> Python codec name, where Python has one
+PYTHON_CODEC_NAMES = {
+    'big5': 'big5',
+    'latin2': 'iso8859_2',
+    'cp850': 'cp850',
+    'latin1': 'cp1252', # MySQL's latin1 is really Windows-1252
+    'koi8r': 'koi8_r',
+    'ascii': 'ascii',
+    'ujis': 'euc_jp',
+    'sjis': 'shift_jis',
+    'cp1251': 'cp1251',
+    'hebrew': 'iso8859_8',
+    'tis620': 'tis_620',
+    'euckr': 'euc_kr',
+    'latin7': 'iso8859_13',
+    'koi8u': 'koi8_u',
+    'gb2312': 'gb2312',
+    'greek': 'iso8859_7',
+    'cp1250': 'cp1250',
+    'gbk': 'gbk',
+    'cp1257': 'cp1257',
+    'latin5': 'iso8859_9',
+    'utf8': 'utf_8',
+    'ucs2': 'utf_16_be',
+    'cp866': 'cp866',
+    'macce': 'mac_latin2',
+    'macroman': 'mac_roman',
+    'cp852': 'cp852',
+    'utf8mb4': 'utf_8',
+    'utf16': 'utf_16_be',
+    'cp1256': 'cp1256',
+    'utf32': 'utf_32_be',
+    'cp932': 'cp932',
+    'eucjpms': 'euc_jp',
+}
+
+
+def _build_codec_table():
+    """
+    Codec lookups are done once up front; CODECS is indexed
+    by charset id and holds None for binary or anything
+    Python has no codec for.
+    """
+    table = [None] * 256
+    for charset_id, charset_info in CHARSETS.items():
+        codec_name = PYTHON_CODEC_NAMES.get(charset_info[0])
+        if codec_name:
+            table[charset_id] = codecs.lookup(codec_name)
+    return table
+
+CODECS = _build_codec_table()
+CODECS_BY_NAME = dict([(name, codecs.lookup(codec_name)) \
+    for name, codec_name in PYTHON_CODEC_NAMES.items()])
+
+
+def charset_name(charset_id):
+    """
+    MySQL charset name for a charset (collation) id
+    """
+    return CHARSETS[charset_id][0] if charset_id in CHARSETS else None
+
+
+def charset_mblen(charset_id):
+    """
+    Max bytes per character for a charset id
+    """
+    return CHARSETS[charset_id][3] if charset_id in CHARSETS else 1
+
+
 def charset_encode(mystr, encoding='utf8'):
     if encoding == 'binary':
         return mystr
-    if encoding == 'utf8mb4':
-        encoding = 'utf8'
-    return mystr.encode(encoding)
+    codec = CODECS_BY_NAME.get(encoding)
+    if codec is None:
+        return mystr.encode(encoding)
+    return codec.encode(mystr)[0]
+
 
 def charset_decode(mystr, encoding='utf8'):
     if encoding == 'binary':
         return mystr
-    if encoding == 'utf8mb4':
-        encoding = 'utf8'
-    return mystr.decode(encoding)
+    codec = CODECS_BY_NAME.get(encoding)
+    if codec is None:
+        return mystr.decode(encoding)
+    return codec.decode(mystr)[0]
+
+
+def make_transcoder(from_charset_id, to_charset_id):
+    """
+    Function converting bytes in charset `from_charset_id` to
+    bytes in `to_charset_id`, or None if no conversion is needed
+    (same codec on both ends, binary data, or an unknown codec).
+    Characters that don't exist in the target charset become '?'
+    like they would coming from the server.
+    """
+    from_codec = CODECS[from_charset_id & 0xff]
+    to_codec = CODECS[to_charset_id & 0xff]
+    if from_codec is None or to_codec is None or from_codec.name == to_codec.name:
+        return None
+    decode = from_codec.decode
+    encode = to_codec.encode
+    def transcode(data):
+        return encode(decode(data, 'replace')[0], 'replace')[0]
+    return transcode
@@ -1,12 +1,19 @@
 """
 Client to server command handling
 """
-from mysqlproxy.packet import ERRPacket, OKPacket, EOFPacket
+from mysqlproxy.packet import ERRPacket, OKPacket, EOFPacket, RawPacket
 from mysqlproxy.query_response import ResultSetText, ResultSetRowText, \
     ResultSetBinary, ResultSetRowBinary, ColumnDefinition
-from mysqlproxy import column_types
+from mysqlproxy import column_types, capabilities, error_codes as errs
+from mysqlproxy.fingerprint import fingerprint
+from mysqlproxy.admission import AdmissionRejected
+from mysqlproxy.admin import is_admin_command, run_admin_command
+from mysqlproxy.client import MYSQL_OPTION_MULTI_STATEMENTS_ON, \
+    MYSQL_OPTION_MULTI_STATEMENTS_OFF
 import sys
 import socket
+import struct
+import time
 from StringIO import StringIO
 from datetime import datetime
 from pymysql import err
@@ -16,6 +23,8 @@ import re
 
 _LOG = logging.getLogger(__name__)
 
+_KILL = re.compile(r'^\s*kill\s+(?:(connection|query)\s+)?(\d+)\s*;?\s*$', re.I)
+
 COMMAND_CODES = {
     0x01: ('quit', 'cli_command_quit'),
     0x02: ('init_db', 'cli_change_db'),
@@ -28,18 +37,19 @@ COMMAND_CODES = {
     0x09: ('statistics', 'unsupported_client_command'),
     0x0a: ('process_info', 'unsupported_client_command'),
     0x0b: ('connect', 'unsupported_client_command'), # internal
-    0x0c: ('kill', 'unsupported_client_command'),
+    0x0c: ('kill', 'cli_command_kill'),
     0x0d: ('debug', 'unsupported_client_command'),
     0x0e: ('ping', 'cli_command_ping'),
     0x0f: ('time', 'unsupported_client_command'), # internal
     0x10: ('delayed_insert', 'unsupported_client_command'), # internal
-    0x11: ('change_user', 'unsupported_client_command'),
+    0x11: ('change_user', 'cli_command_change_user'),
     0x16: ('stmt_prepare', 'unsupported_client_command'),
     0x17: ('stmt_execute', 'unsupported_client_command'),
     0x18: ('stmt_send_long_data', 'unsupported_client_command'),
     0x19: ('stmt_close', 'unsupported_client_command'),
     0x19: ('stmt_reset', 'unsupported_client_command'),
-    0x1f: ('reset_connection', 'unsupported_client_command'),
+    0x1b: ('set_option', 'cli_command_set_option'),
+    0x1f: ('reset_connection', 'cli_command_reset_connection'),
     0x1d: ('daemon', 'unsupported_client_command'), # internal
 }
 
@@ -122,46 +132,211 @@ def cli_command_query(session_obj, pkt_data, code):
         row_val = u'mysqlproxy-0.1'
         response.add_column(col_name, column_types.VAR_STRING, len(row_val))
         response.add_row([row_val])
+    elif is_admin_command(query):
+        response = run_admin_command(session_obj, query)
+    elif _KILL.match(query):
+        # ids the client knows are ours, not the backend's
+        kind, conn_id = _KILL.match(query).groups()
+        return kill_session(session_obj, int(conn_id),
+            query_only=(kind or '').lower() == 'query')
     else:
         proxy = session_obj.proxy_obj
         plugin_continue, plugin_ret = proxy.plugins.call_hooks('com_query',
             query, session_obj)
         if plugin_continue:
-            response = proxy.build_response_from_query(query)
-        else:
-            response = plugin_ret
+            return proxy_query(session_obj, query)
+        response = plugin_ret
     session_obj.send_payload(response)
     return True
 
 
+def proxy_query(session_obj, query):
+    """
+    Send `query` on to the backend, subject to admission
+    control and rewrite rules, and relay the response
+    """
+    proxy = session_obj.proxy_obj
+    started = time.time()
+    normalized = None
+    if (proxy.admission is not None and proxy.admission.needs_fingerprint) \
+            or proxy.rewriter is not None:
+        normalized = fingerprint(query)
+    admission = None
+    if proxy.admission is not None:
+        try:
+            admission = proxy.admission.admit(session_obj.username,
+                normalized if proxy.admission.needs_fingerprint else None)
+        except AdmissionRejected as ex:
+            session_obj.send_payload(ERRPacket(
+                session_obj.client_capabilities,
+                error_code=errs.USER_LIMIT_REACHED,
+                error_msg=u'%s' % ex, seq_id=1))
+            return True
+    try:
+        if proxy.rewriter is not None:
+            query = proxy.rewriter.rewrite(query, normalized)
+        response = proxy.build_response_from_query(query)
+        nbytes, _ = session_obj.send_payload(response)
+    finally:
+        if admission is not None:
+            admission.release()
+    if proxy.slow_log is not None:
+        proxy.slow_log.log(query, time.time() - started,
+            backend_time=proxy.backend_time,
+            rows=getattr(response, 'rows_sent', 0),
+            nbytes=nbytes,
+            user=session_obj.username,
+            db=proxy.state.default_db,
+            normalized=normalized)
+    return True
+
+
 def cli_command_field_list(session_obj, pkt_data, code):
-    table_name, wildcard = pkt_data.split('\x00')[:2]
-    if not re.match(r'^[a-zA-Z0-9_]+', table_name):
+    table_name, wildcard = (pkt_data.split('\x00', 1) + [''])[:2]
+    if not re.match(r'^[a-zA-Z0-9_$]+$', table_name):
         session_obj.send_payload(ERRPacket(
             session_obj.client_capabilities, 1049,
             u'Invalid table name', seq_id=1))
         return True
 
-    if not re.match(r'^[a-zA-Z0-9_%]+', table_name):
+    if not re.match(r'^[a-zA-Z0-9_%$]*$', wildcard):
         session_obj.send_payload(ERRPacket(
             session_obj.client_capabilities, 1049,
             u'Invalid wildcard', seq_id=1))
         return True
 
-    cli_con = session_obj.proxy_obj.client_conn
-    field_list = cli_con.get_field_list(table_name, wildcard)
-    results = ResultSetText(session_obj.client_capabilities,
-        flags=session_obj.server_status)
-    for colname, coltype, col_max_len, \
-            field_len, field_max_len, _, _ in field_list:
-        results.add_column(unicode(colname), coltype, field_len)
-    # TODO: server status negoatiation
-    tx_packets = results.columns
-    for i in range(0, len(tx_packets)):
-        tx_packets[i].seq_id = i+1
-    tx_eof = EOFPacket(
+    proxy = session_obj.proxy_obj
+    schema = proxy.state.default_db
+    cache = proxy.field_list_cache
+    col_payloads = None
+    if cache is not None and schema:
+        col_payloads = cache.get(schema, table_name, wildcard)
+    if col_payloads is None:
+        try:
+            descriptors = proxy.backend().get_field_descriptors(table_name, wildcard)
+        except (err.OperationalError, err.InternalError,
+                err.ProgrammingError) as ex:
+            err_code, err_msg = ex
+            session_obj.send_payload(ERRPacket(
+                session_obj.client_capabilities,
+                error_code=err_code, error_msg=err_msg, seq_id=1))
+            return True
+        col_payloads = [ColumnDefinition.from_field_descriptor(
+            field, show_default=True, default=field.default).serialize()
+            for field in descriptors]
+        if cache is not None and schema:
+            cache.put(schema, table_name, wildcard, col_payloads)
+
+    # COM_FIELD_LIST gets no column count, just the definitions and an EOF
+    tx_packets = [RawPacket(col_payloads[i], seq_id=i+1)
+        for i in range(0, len(col_payloads))]
+    tx_packets.append(EOFPacket(
         session_obj.client_capabilities,
         status_flags=session_obj.server_status,
-        seq_id=len(tx_packets)+1)
-    tx_packets.append(tx_eof)
+        seq_id=len(tx_packets)+1))
+    session_obj.send_payload(tx_packets)
     return True
+
+
+def cli_command_set_option(session_obj, pkt_data, code):
+    if len(pkt_data) != 2:
+        session_obj.send_payload(ERRPacket(
+            session_obj.client_capabilities, 1047,
+            u'Malformed COM_SET_OPTION', seq_id=1))
+        return True
+    option, = struct.unpack('<H', pkt_data)
+    if option not in (MYSQL_OPTION_MULTI_STATEMENTS_ON,
+            MYSQL_OPTION_MULTI_STATEMENTS_OFF):
+        session_obj.send_payload(ERRPacket(
+            session_obj.client_capabilities, 1047,
+            u'Unknown option %d' % option, seq_id=1))
+        return True
+    # applied to the backend connection on its next use
+    session_obj.proxy_obj.state.multi_statements = \
+        option == MYSQL_OPTION_MULTI_STATEMENTS_ON
+    session_obj.send_payload(EOFPacket(
+        session_obj.client_capabilities,
+        status_flags=session_obj.server_status,
+        seq_id=1))
+    return True
+
+
+def parse_change_user(pkt_data, client_capabilities):
+    """
+    (user, auth response, schema, charset id) out of a
+    COM_CHANGE_USER payload.  Charset id is None if the
+    client didn't send one.
+    """
+    user, rest = pkt_data.split('\x00', 1)
+    if client_capabilities & capabilities.SECURE_CONNECTION:
+        auth_len = ord(rest[0]) if rest else 0
+        auth_response, rest = rest[1:1 + auth_len], rest[1 + auth_len:]
+    else:
+        auth_response, rest = (rest.split('\x00', 1) + [''])[:2]
+    schema, rest = (rest.split('\x00', 1) + [''])[:2]
+    charset_id = None
+    if len(rest) >= 2:
+        charset_id = struct.unpack('<H', rest[:2])[0]
+    # the auth plugin name and connect attributes that may follow
+    # don't matter, we only speak mysql_native_password
+    return user, auth_response, schema, charset_id
+
+
+def cli_command_change_user(session_obj, pkt_data, code):
+    try:
+        user, auth_response, schema, charset_id = parse_change_user(pkt_data,
+            session_obj.client_capabilities)
+    except (ValueError, IndexError, struct.error):
+        session_obj.send_payload(ERRPacket(session_obj.client_capabilities,
+            error_code=errs.MALFORMED_PACKET, error_msg=u'Malformed packet', seq_id=1))
+        return False
+    response = session_obj.proxy_obj.change_user(user, auth_response, schema, charset_id)
+    session_obj.send_payload(response)
+    # like the server, don't leave a client that failed to log in connected
+    return getattr(response, 'error_code', None) != errs.ACCESS_DENIED
+
+
+def cli_command_reset_connection(session_obj, pkt_data, code):
+    session_obj.send_payload(session_obj.proxy_obj.reset_connection())
+    return True
+
+
+def cli_command_kill(session_obj, pkt_data, code):
+    if len(pkt_data) != 4:
+        session_obj.send_payload(ERRPacket(
+            session_obj.client_capabilities, 1047,
+            u'Malformed COM_PROCESS_KILL', seq_id=1))
+        return True
+    conn_id, = struct.unpack('<I', pkt_data)
+    return kill_session(session_obj, conn_id)
+
+
+def kill_session(session_obj, conn_id, query_only=False):
+    """
+    KILL [QUERY] `conn_id`: cancel the query that session has
+    running on its backend connection, and unless `query_only`
+    disconnect it too.  Only sessions of the same user may be killed.
+    """
+    proxy = session_obj.proxy_obj
+    target = proxy.registry.get(conn_id)
+    if target is None:
+        session_obj.send_payload(ERRPacket(
+            session_obj.client_capabilities, errs.NO_SUCH_THREAD,
+            u'Unknown thread id: %d' % conn_id, seq_id=1))
+        return True
+    if target.session.username != session_obj.username:
+        session_obj.send_payload(ERRPacket(
+            session_obj.client_capabilities, errs.KILL_DENIED,
+            u'You are not owner of thread %d' % conn_id, seq_id=1))
+        return True
+    _LOG.info('Connection %d killing %s of connection %d' % (proxy.connection_id,
+        'query' if query_only else 'connection', conn_id))
+    if target is not proxy:
+        target.cancel_backend_query()
+        if not query_only:
+            target.session.abort('killed by connection %d' % proxy.connection_id)
+    session_obj.send_payload(OKPacket(
+        session_obj.client_capabilities, 0, 0,
+        status_flags=session_obj.server_status, seq_id=1))
+    # killing yourself ends your own connection
+    return query_only or target is not proxy
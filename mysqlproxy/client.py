@@ -2,11 +2,21 @@
 pymsyql client overrides
 """
 from pymysql.connections import Connection, MysqlPacket, \
-                                FieldDescriptorPacket
+                                FieldDescriptorPacket, MySQLResult
 from pymysql.util import byte2int
-from pymysql.constants.COMMAND import COM_FIELD_LIST
+from pymysql.constants.COMMAND import COM_FIELD_LIST, COM_QUERY
+from pymysql.constants.CLIENT import LOCAL_FILES
+from pymysql.cursors import SSCursor
 import struct
 
+COM_CHANGE_USER = 0x11
+COM_SET_OPTION = 0x1b
+COM_RESET_CONNECTION = 0x1f
+MYSQL_OPTION_MULTI_STATEMENTS_ON = 0
+MYSQL_OPTION_MULTI_STATEMENTS_OFF = 1
+# first byte of a LOAD DATA LOCAL INFILE file request
+LOCAL_INFILE_REQUEST = b'\xfb'
+
 
 class FieldDescriptorOrEOFPacket(FieldDescriptorPacket):
     """
@@ -18,8 +28,12 @@ class FieldDescriptorOrEOFPacket(FieldDescriptorPacket):
     def __init__(self, connection):
         MysqlPacket.__init__(self, connection)
         self.check_error()
+        self.default = None
         if not self.is_eof_packet():
             self.__parse_field_descriptor(connection.encoding)
+            # COM_FIELD_LIST tacks the column default on the end
+            if self._position < len(self._data):
+                self.default = self.read_length_coded_string()
 
     def __parse_field_descriptor(self, encoding):
         """Parse the 'Field Descriptor' (Metadata) packet.
@@ -44,11 +58,158 @@ class FieldDescriptorOrEOFPacket(FieldDescriptorPacket):
         # not used for normal result sets...
 
 
+class ProxyResult(MySQLResult):
+    """
+    MySQLResult that stops at a LOAD DATA LOCAL INFILE file
+    request instead of choking on it, with `local_infile` set
+    to the file name the server asked for
+    """
+    local_infile = None
+
+    def init_unbuffered_query(self):
+        self.unbuffered_active = True
+        first_packet = self.connection._read_packet()
+
+        if first_packet.is_ok_packet():
+            self._read_ok_packet(first_packet)
+            self.unbuffered_active = False
+            self.connection = None
+        elif first_packet.get_bytes(0) == LOCAL_INFILE_REQUEST:
+            # the result comes once the file's been sent
+            self.local_infile = first_packet.get_all_data()[1:]
+            self.unbuffered_active = False
+            self.connection = None
+        else:
+            self.field_count = first_packet.read_length_encoded_integer()
+            self._get_descriptions()
+            # as pymysql has it, for MySQLdb compatibility
+            self.affected_rows = 18446744073709551615
+
+
+class StreamingCursor(SSCursor):
+    """
+    SSCursor that stays unbuffered past the first result
+    of a multi-statement query or stored procedure call
+    """
+    def nextset(self):
+        conn = self._get_db()
+        current_result = self._result
+        if current_result is None or current_result is not conn._result:
+            return None
+        if current_result.unbuffered_active:
+            current_result._finish_unbuffered_query()
+        if not current_result.has_next:
+            return None
+        try:
+            conn._affected_rows = conn._read_query_result(unbuffered=True)
+        except:
+            # an ERR ends the batch, there's nothing more to read
+            current_result.has_next = None
+            raise
+        self._do_get_result()
+        return True
+
+    def has_more(self):
+        """
+        True if the backend said another result follows
+        the current one (only known once it's fully read)
+        """
+        return self._result is not None and bool(self._result.has_next)
+
+    def send_query(self, query):
+        """
+        First half of execute(): send `query` without waiting
+        for the response, see read_response()
+        """
+        conn = self._get_db()
+        while self.nextset():
+            pass
+        if isinstance(query, unicode):
+            query = query.encode(conn.encoding)
+        self._last_executed = query
+        conn._execute_command(COM_QUERY, query)
+        self._sent = query
+
+    def read_response(self):
+        """
+        Second half of execute(): read the response to the
+        query send_query() sent
+        """
+        conn = self._get_db()
+        conn._affected_rows = conn._read_query_result(unbuffered=True)
+        self._do_get_result()
+        self._executed = self._sent
+        return self.rowcount
+
+
 class ProxyConnection(Connection):
     def __init__(self, *largs, **kwargs):
         self.forwarded_auth_response = None
+        # pymysql always asks for multi statements
+        self.multi_statements = True
+        self.current_db = kwargs.get('db') or kwargs.get('database')
+        # LOAD DATA LOCAL INFILE gets relayed to the client, see local_infile
+        kwargs['client_flag'] = kwargs.get('client_flag', 0) | LOCAL_FILES
         Connection.__init__(self, *largs, **kwargs)
 
+    def select_db(self, db):
+        Connection.select_db(self, db)
+        self.current_db = db
+
+    def set_multi_statements(self, enabled):
+        """
+        Toggle CLIENT_MULTI_STATEMENTS for this connection
+        """
+        if enabled:
+            option = MYSQL_OPTION_MULTI_STATEMENTS_ON
+        else:
+            option = MYSQL_OPTION_MULTI_STATEMENTS_OFF
+        self._execute_command(COM_SET_OPTION, struct.pack('<H', option))
+        self._read_packet() # EOF, raises on ERR
+        self.multi_statements = enabled
+
+    def _read_query_result(self, unbuffered=False):
+        if not unbuffered:
+            return Connection._read_query_result(self, unbuffered)
+        try:
+            result = ProxyResult(self)
+            result.init_unbuffered_query()
+        except:
+            result.unbuffered_active = False
+            result.connection = None
+            raise
+        self._result = result
+        if result.server_status is not None:
+            self.server_status = result.server_status
+        return result.affected_rows
+
+    def write_packet(self, seq_id, payload):
+        """
+        Send `payload` as a single packet, e.g. part of a file
+        for LOAD DATA LOCAL INFILE
+        """
+        self._write_bytes(struct.pack('<I', len(payload))[:3] + chr(seq_id & 0xff) + payload)
+
+    def reset_connection(self):
+        """
+        COM_RESET_CONNECTION: drop session state (variables,
+        temporary tables, open transaction...) but stay logged
+        in.  Raises on servers older than 5.7.3.
+        """
+        self._execute_command(COM_RESET_CONNECTION, b'')
+        self._read_ok_packet()
+
+    def kill_query(self, thread_id):
+        """
+        Interrupt whatever connection `thread_id` is running,
+        leaving the connection itself alone
+        """
+        cursor = self.cursor()
+        try:
+            cursor.execute('KILL QUERY %d' % int(thread_id))
+        finally:
+            cursor.close()
+
     def get_field_list(self, table_name, wildcard=None):
         ''' Get column information for a table '''
         table_name = table_name + '\x00'
@@ -56,10 +217,21 @@ class ProxyConnection(Connection):
         self._fields_meta = self._read_field_list_result()
         return self._fields_meta
 
-    def _read_field_list_result(self):
-        fields_meta = []
+    def get_field_descriptors(self, table_name, wildcard=''):
+        """
+        Like get_field_list(), but hand back the field
+        descriptor packets themselves
+        """
+        self._execute_command(COM_FIELD_LIST, table_name + '\x00' + wildcard)
+        return self._read_field_descriptors()
+
+    def _read_field_descriptors(self):
+        descriptors = []
         read_packet = self._read_packet(FieldDescriptorOrEOFPacket)
         while not read_packet.is_eof_packet():
-            fields_meta.append(read_packet.description())
+            descriptors.append(read_packet)
             read_packet = self._read_packet(FieldDescriptorOrEOFPacket)
-        return fields_meta
+        return descriptors
+
+    def _read_field_list_result(self):
+        return [field.description() for field in self._read_field_descriptors()]
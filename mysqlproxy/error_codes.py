@@ -1 +1,12 @@
 ACCESS_DENIED = 1045
+CON_COUNT_ERROR = 1040
+OUT_OF_RESOURCES = 1041
+USER_LIMIT_REACHED = 1226
+NO_SUCH_THREAD = 1094
+KILL_DENIED = 1095
+UNKNOWN_COMMAND = 1047
+MALFORMED_PACKET = 1835
+INSECURE_TRANSPORT = 3159
+NOT_ALLOWED_COMMAND = 1148
+CANT_DO_THIS_DURING_AN_TRANSACTION = 1179
+CONN_HOST_ERROR = 2003
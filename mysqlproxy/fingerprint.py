@@ -0,0 +1,54 @@
+"""
+Query fingerprinting.
+
+A fingerprint is a query with its literals replaced by `?`,
+comments dropped, whitespace collapsed and everything lowercased,
+so `SELECT * FROM t WHERE id = 5` and `select *  from t where id=7`
+come out the same.  Optimizer hints and version comments are
+kept since they change what the query does.
+"""
+import re
+
+_TOKENS = re.compile(r"""
+    (?P<comment>/\*(?![+!]).*?\*/|--(?:\s|$)[^\n]*|\#[^\n]*)
+  | (?P<string>'(?:[^'\\]|\\.|'')*'|"(?:[^"\\]|\\.|"")*")
+  | (?P<number>\b(?:0x[0-9a-f]+|\d+(?:\.\d*)?(?:e[+-]?\d+)?)\b|\B\.\d+\b)
+  | (?P<ident>`(?:[^`]|``)*`)
+""", re.X | re.I | re.S)
+
+# plain template substitutions from here on, they're a lot
+# cheaper than calling back into python for every match
+_SPACES = re.compile(r'\s+')
+_OPERATOR_SPACES = re.compile(r' ?([=<>!,]+) ?')
+_PAREN_SPACES = re.compile(r'(?<=\() | (?=\))')
+_IN_LIST = re.compile(r'\(\?(?:,\?)+\)')
+_VALUES_LIST = re.compile(r'(values ?\([^()]*\))(?:,\([^()]*\))+')
+
+_REPLACEMENTS = {
+    'comment': ' ',
+    'string': '?',
+    'number': '?',
+    }
+
+
+def _replace_token(match):
+    kind = match.lastgroup
+    if kind == 'ident':
+        return match.group(kind)
+    return _REPLACEMENTS[kind]
+
+
+def fingerprint(query):
+    """
+    Normalized form of `query`
+    """
+    normalized = _TOKENS.sub(_replace_token, query)
+    normalized = _SPACES.sub(' ', normalized).strip().lower()
+    normalized = _OPERATOR_SPACES.sub(r'\1', normalized)
+    if '( ' in normalized or ' )' in normalized:
+        normalized = _PAREN_SPACES.sub('', normalized)
+    if '(?,' in normalized:
+        # IN (?, ?, ?) and multi-row VALUES shouldn't make new fingerprints
+        normalized = _IN_LIST.sub('(?+)', normalized)
+        normalized = _VALUES_LIST.sub(r'\1+', normalized)
+    return normalized.rstrip('; ')
@@ -0,0 +1,136 @@
+"""
+Output buffering and memory accounting.
+
+Result rows are pulled off the backend only as fast as the
+client drains them: each session writes into a bounded
+OutputBuffer, and once it's past its high watermark the session
+stops reading from the backend until the client has taken enough
+to get it back under the low watermark.  A MemoryBudget shared by
+all sessions keeps track of how much is sitting in those buffers.
+"""
+import threading
+import socket
+import logging
+
+_LOG = logging.getLogger(__name__)
+
+
+class ClientWriteTimeout(Exception):
+    pass
+
+
+class MemoryBudget(object):
+    """
+    Process wide count of bytes held in buffers, with a soft limit.
+    Going over the limit never fails a reservation; it's up to
+    callers to check `exceeded` before starting new work.
+    """
+    def __init__(self, limit_bytes):
+        self.limit_bytes = limit_bytes
+        self.used_bytes = 0
+        self.peak_bytes = 0
+        self.rejections = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, nbytes):
+        with self.lock:
+            self.used_bytes += nbytes
+            if self.used_bytes > self.peak_bytes:
+                self.peak_bytes = self.used_bytes
+
+    def release(self, nbytes):
+        with self.lock:
+            self.used_bytes -= nbytes
+
+    @property
+    def exceeded(self):
+        return self.used_bytes >= self.limit_bytes
+
+    def reject(self):
+        """
+        Count a request turned away for lack of memory
+        """
+        with self.lock:
+            self.rejections += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'limit_bytes': self.limit_bytes,
+                'used_bytes': self.used_bytes,
+                'peak_bytes': self.peak_bytes,
+                'rejections': self.rejections,
+                }
+
+
+class OutputBuffer(object):
+    """
+    File-like sitting in front of the client connection.
+    Writes accumulate until `high_watermark` bytes are buffered,
+    at which point they're drained down to `low_watermark`.
+    `write_timeout` (seconds) bounds how long a single drain may
+    block on a client that isn't reading; it needs the raw socket.
+    """
+    def __init__(self, net_fd, high_watermark=1<<20, low_watermark=1<<18,
+            write_timeout=None, sock=None, budget=None):
+        if low_watermark > high_watermark:
+            raise ValueError('low watermark above high watermark')
+        self.net_fd = net_fd
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.write_timeout = write_timeout
+        self.sock = sock
+        self.budget = budget
+        self.buf = bytearray()
+        self.bytes_written = 0
+        self.pauses = 0
+
+    def __len__(self):
+        return len(self.buf)
+
+    def write(self, data):
+        self.buf += data
+        if self.budget is not None:
+            self.budget.reserve(len(data))
+        if len(self.buf) >= self.high_watermark:
+            # backend reads stop right here until the client catches up
+            self.pauses += 1
+            self._drain(self.low_watermark)
+
+    def flush(self):
+        self._drain(0)
+        self.net_fd.flush()
+
+    def discard(self):
+        """
+        Drop anything still buffered, e.g. once the client is gone
+        """
+        if self.budget is not None:
+            self.budget.release(len(self.buf))
+        self.buf = bytearray()
+
+    def _drain(self, target):
+        if len(self.buf) <= target:
+            return
+        nbytes = len(self.buf) - target
+        # send the oldest bytes, keep the tail around
+        chunk = bytes(self.buf[:nbytes])
+        if self.write_timeout is not None and self.sock is not None:
+            old_timeout = self.sock.gettimeout()
+            self.sock.settimeout(self.write_timeout)
+            try:
+                self.net_fd.write(chunk)
+            except socket.timeout:
+                raise ClientWriteTimeout('client did not read %d bytes within %.1fs' % \
+                    (nbytes, self.write_timeout))
+            finally:
+                try:
+                    self.sock.settimeout(old_timeout)
+                except socket.error:
+                    pass
+        else:
+            self.net_fd.write(chunk)
+        del self.buf[:nbytes]
+        self.bytes_written += nbytes
+        if self.budget is not None:
+            self.budget.release(nbytes)
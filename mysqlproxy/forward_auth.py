@@ -135,6 +135,28 @@ class ForwardAuthConnection(ProxyConnection):
             auth_packet.check_error()
             if DEBUG: auth_packet.dump()
 
+    def forward_change_user(self, user, auth_response, db=None, charset_id=None):
+        """
+        COM_CHANGE_USER with a client's auth response.  It was
+        computed from the scramble we forwarded at handshake time,
+        which is the backend's own, so the backend can check it.
+        """
+        if isinstance(user, text_type):
+            user = user.encode(self.encoding)
+        data = user + b'\0' + int2byte(len(auth_response)) + auth_response \
+            + (db or b'') + b'\0'
+        if charset_id is not None:
+            data += struct.pack('<H', charset_id)
+        self._execute_command(COM_CHANGE_USER, data)
+        auth_packet = MysqlPacket(self)
+        auth_packet.check_error()
+        if not auth_packet.is_ok_packet():
+            # an auth method switch, which we can't go along with
+            # without the client's password
+            raise OperationalError(1045, "Access denied for user '%s'" % user)
+        self.user = user
+        self.current_db = db or None
+
     def post_auth_routine(self):
         """
         Anything that was initialized in a PyMySQL connection
@@ -0,0 +1,135 @@
+"""
+Hedged reads.
+
+A read-only query that hasn't had a response from its backend
+within the `percentile`th percentile of recent response times gets
+sent to a second backend of the group as well.  Whichever answers
+first serves the client; the other gets a KILL QUERY and its
+connection is dropped.  When the second one wins, the session
+carries on over it.
+
+Hedges are paid for out of a budget: every query adds
+`budget_percent`/100 of a token (up to `max_burst`), every hedge
+takes a whole one, so hedging never adds more than `budget_percent`
+percent to the queries the backends see.
+
+Only single SELECTs outside of transactions and from sessions
+without pinned state are hedged, as only those are guaranteed to
+mean the same thing on any backend and to be safe to run twice.
+"""
+from collections import deque
+import threading
+import logging
+import re
+
+_LOG = logging.getLogger(__name__)
+
+_SELECT = re.compile(r'^\s*(?:/\*.*?\*/\s*)*\(?\s*select\b', re.I | re.S)
+# reads with side effects, or that take locks
+_NOT_READ_ONLY = re.compile(r'\bfor\s+update\b|\block\s+in\s+share\s+mode\b'
+    r'|\binto\s+(?:outfile|dumpfile|@)|\bget_lock\s*\(|@\w+\s*:=', re.I)
+
+
+def is_read_only(query):
+    """
+    True for a single SELECT that's safe to run twice
+    """
+    if ';' in query.rstrip().rstrip(';'):
+        return False
+    return _SELECT.match(query) is not None and _NOT_READ_ONLY.search(query) is None
+
+
+class HedgePolicy(object):
+    """
+    Shared by all sessions: when to hedge and whether
+    there's budget left to.  Needs `min_samples` response
+    times before it hedges anything.
+    """
+    def __init__(self, percentile=95.0, budget_percent=5.0, min_samples=100,
+            window=1000, max_burst=10.0, recompute_every=50):
+        self.percentile = percentile
+        self.budget_percent = budget_percent
+        self.min_samples = min_samples
+        self.max_burst = max_burst
+        self.recompute_every = recompute_every
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+        # in hundredths of a hedge, so whole percentages add up exactly
+        self.tokens = 0.0
+        self.cached_delay = None
+        self.since_recompute = 0
+        self.queries = 0
+        self.fired = 0
+        self.won = 0
+        self.budget_exhausted = 0
+        self.unavailable = 0
+
+    def observe(self, elapsed=None):
+        """
+        A query went to the backends, taking `elapsed` seconds
+        to respond if it's one that could've been hedged
+        """
+        with self.lock:
+            self.queries += 1
+            self.tokens = min(self.max_burst * 100, self.tokens + self.budget_percent)
+            if elapsed is None:
+                return
+            self.samples.append(elapsed)
+            self.since_recompute += 1
+
+    def delay(self):
+        """
+        Seconds to wait for a response before hedging,
+        None if there isn't enough history to tell
+        """
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            if self.cached_delay is None or self.since_recompute >= self.recompute_every:
+                ordered = sorted(self.samples)
+                index = int(len(ordered) * self.percentile / 100.0)
+                self.cached_delay = ordered[min(index, len(ordered) - 1)]
+                self.since_recompute = 0
+            return self.cached_delay
+
+    def allow(self):
+        """
+        True if a hedge is in the budget
+        """
+        with self.lock:
+            if self.tokens >= 100:
+                return True
+            self.budget_exhausted += 1
+            return False
+
+    def fire(self):
+        """
+        A hedge went out, pay for it
+        """
+        with self.lock:
+            self.tokens -= 100
+            self.fired += 1
+
+    def count_unavailable(self):
+        """
+        A hedge was due but no second backend was at hand
+        """
+        with self.lock:
+            self.unavailable += 1
+
+    def count_won(self):
+        with self.lock:
+            self.won += 1
+
+    def stats(self):
+        delay = self.delay()
+        with self.lock:
+            return {
+                'queries': self.queries,
+                'hedges_fired': self.fired,
+                'hedges_won': self.won,
+                'budget_exhausted': self.budget_exhausted,
+                'unavailable': self.unavailable,
+                'budget_tokens': self.tokens / 100.0,
+                'delay_ms': delay * 1000 if delay is not None else None,
+                }
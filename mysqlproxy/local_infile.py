@@ -0,0 +1,133 @@
+"""
+LOAD DATA LOCAL INFILE relay.
+
+The backend answers such a query with a request for the file (0xfb
+and the file name), which goes on to the client.  The client sends
+the file back as a run of packets ended by an empty one, then gets
+the backend's OK or ERR.  Packets are passed on to the backend one
+at a time as they arrive, so no more than one packet of the file is
+ever held whatever its size.  The proxy never opens files itself.
+
+Plugins subscribed to the 'local_infile_chunk' hook get called with
+(session, filename, chunk) for every packet and may return a
+replacement chunk, '' to drop it.
+"""
+from mysqlproxy.client import LOCAL_INFILE_REQUEST
+from mysqlproxy.packet import OutgoingPacketChain
+from mysqlproxy.types import FixedLengthString
+from mysqlproxy import capabilities
+import threading
+import logging
+import socket
+import struct
+
+_LOG = logging.getLogger(__name__)
+
+MAX_PAYLOAD = 0xffffff
+
+
+class LocalInfileRefused(Exception):
+    pass
+
+
+class LocalInfileStats(object):
+    """
+    Shared by all sessions, throughput of the loads relayed
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loads = 0
+        self.refused = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.last_rate = 0.0
+
+    def count_refused(self):
+        with self.lock:
+            self.refused += 1
+
+    def add(self, nbytes, elapsed):
+        with self.lock:
+            self.loads += 1
+            self.bytes += nbytes
+            self.seconds += elapsed
+            self.last_rate = nbytes / elapsed if elapsed else 0.0
+
+    def stats(self):
+        return {
+            'loads': self.loads,
+            'refused': self.refused,
+            'bytes': self.bytes,
+            'bytes_per_sec': self.bytes / self.seconds if self.seconds else 0.0,
+            'last_bytes_per_sec': self.last_rate,
+            }
+
+
+def read_packet(net_fd):
+    """
+    (sequence id, payload) of the next packet from the client,
+    on its own (not joined with the ones continuing it)
+    """
+    header = net_fd.read(4)
+    if len(header) < 4:
+        raise socket.error('client went away during LOAD DATA LOCAL INFILE')
+    length = struct.unpack('<I', header[:3] + '\x00')[0]
+    payload = net_fd.read(length) if length else ''
+    if len(payload) < length:
+        raise socket.error('client went away during LOAD DATA LOCAL INFILE')
+    return ord(header[3]), payload
+
+
+def refuse(conn):
+    """
+    Answer a file request with an empty file, for clients
+    that can't send one, and read the backend's response
+    """
+    conn.write_packet(2, '')
+    try:
+        conn._read_query_result(unbuffered=True)
+    except Exception as ex:
+        _LOG.debug('Backend response to an empty file: %s' % ex)
+
+
+def relay(session, conn, filename, plugins=None):
+    """
+    Relay a file request from backend connection `conn` to
+    the client of `session` and the file back.  Returns the
+    sequence id the response to the client goes out with and
+    the number of bytes relayed; the backend's response is
+    left to read.
+    """
+    if not session.client_capabilities & capabilities.LOCAL_FILES:
+        refuse(conn)
+        raise LocalInfileRefused('client does not support LOAD DATA LOCAL INFILE')
+    request = OutgoingPacketChain(start_seq_id=1)
+    request.add_field(FixedLengthString(1 + len(filename), LOCAL_INFILE_REQUEST + filename))
+    request.write_out(session.out)
+    session.out.flush()
+    backend_seq_id = 2
+    nbytes = 0
+    backend_error = None
+    while True:
+        seq_id, chunk = read_packet(session.net_fd)
+        if not chunk:
+            break
+        nbytes += len(chunk)
+        if plugins is not None:
+            _, replacement = plugins.call_hooks('local_infile_chunk', session, filename, chunk)
+            if replacement is not None:
+                chunk = replacement
+        if backend_error is not None:
+            # keep reading to stay in step with the client
+            continue
+        try:
+            for offset in xrange(0, len(chunk), MAX_PAYLOAD - 1):
+                # empty packets would end the file early
+                conn.write_packet(backend_seq_id, chunk[offset:offset + MAX_PAYLOAD - 1])
+                backend_seq_id += 1
+        except Exception as ex:
+            backend_error = ex
+    if backend_error is not None:
+        raise backend_error
+    conn.write_packet(backend_seq_id, '')
+    return seq_id + 1, nbytes
@@ -0,0 +1,111 @@
+"""
+Session state tracking for transaction-level multiplexing.
+
+A backend connection can only be handed to another session
+when the session that used it left nothing behind.  The default
+database and character set are cheap to replay on the next
+checkout, so those are just remembered.  Anything else that
+lives in the backend connection (user variables, temporary
+tables, named locks, prepared statements...) pins the session
+to its current backend connection for the rest of its life.
+A write also leaves its last insert id and row count behind, so
+the session keeps its connection for one more command, in case
+that's the LAST_INSERT_ID() or ROW_COUNT() reading them.
+"""
+from mysqlproxy import status_flags
+import re
+
+_USE_DB = re.compile(r'^\s*use\s+`?([^`\s;]+)`?\s*;?\s*$', re.I)
+_SET_NAMES = re.compile(
+    r'^\s*set\s+(?:names|character\s+set|charset)\s+[\'"`]?(\w+)', re.I)
+_WRITE = re.compile(r'^\s*(?:insert|update|delete|replace)\b', re.I)
+_SET_AUTOCOMMIT = re.compile(
+    r'^\s*set\s+(?:(?:session\s+|@@session\.|@@|local\s+|@@local\.)?autocommit)\s*=', re.I)
+
+# (pattern, reason) pairs for statements that leave
+# state behind that we can't replay on another connection
+_PINNING_STATEMENTS = [
+    (re.compile(r'^\s*set\s', re.I), 'session variable'),
+    (re.compile(r'@\w+\s*:=|\binto\s+@', re.I), 'user variable'),
+    (re.compile(r'\bcreate\s+temporary\s+table\b', re.I), 'temporary table'),
+    (re.compile(r'^\s*lock\s+tables?\b', re.I), 'table lock'),
+    (re.compile(r'\bget_lock\s*\(', re.I), 'named lock'),
+    (re.compile(r'^\s*prepare\s', re.I), 'prepared statement'),
+    (re.compile(r'^\s*handler\s', re.I), 'handler'),
+    (re.compile(r'\bsql_calc_found_rows\b', re.I), 'found rows'),
+    ]
+
+
+class SessionState(object):
+    """
+    Everything a session did to its backend connection that
+    has to follow it from one pooled connection to the next.
+    """
+    def __init__(self, default_db=None, charset=None):
+        self.default_db = default_db
+        self.charset = charset
+        # whether COM_QUERY may carry several ;-separated statements
+        self.multi_statements = True
+        self.pinned_reason = None
+        # True if the last command wrote, see observe_query()
+        self.held = False
+
+    @property
+    def pinned(self):
+        return self.pinned_reason is not None
+
+    def pin(self, reason):
+        if self.pinned_reason is None:
+            self.pinned_reason = reason
+
+    def observe_query(self, query):
+        """
+        Look at a query about to be sent to the backend and
+        update tracked state accordingly.
+        """
+        self.held = False
+        if self.multi_statements and ';' in query.rstrip().rstrip(';'):
+            # splitting naively may cut a string literal in half, which
+            # at worst pins a session that didn't need pinning
+            for statement in query.split(';'):
+                if statement.strip():
+                    self._observe_statement(statement)
+            return
+        self._observe_statement(query)
+
+    def _observe_statement(self, query):
+        match = _USE_DB.match(query)
+        if match:
+            self.default_db = match.group(1)
+            return
+        match = _SET_NAMES.match(query)
+        if match:
+            self.charset = match.group(1).lower()
+            return
+        if _SET_AUTOCOMMIT.match(query):
+            # autocommit shows up in the server status flags
+            return
+        if _WRITE.match(query):
+            self.held = True
+        for pattern, reason in _PINNING_STATEMENTS:
+            if pattern.search(query):
+                self.pin(reason)
+                return
+
+    def reset(self):
+        """
+        Forget all tracked state
+        """
+        self.default_db = None
+        self.charset = None
+        self.pinned_reason = None
+        self.held = False
+
+
+def at_transaction_boundary(server_status):
+    """
+    True if the backend reports no open transaction and
+    autocommit is on, i.e. the connection may be handed off.
+    """
+    return not server_status & status_flags.STATUS_IN_TRANS \
+        and bool(server_status & status_flags.STATUS_AUTOCOMMIT)
@@ -6,10 +6,11 @@ from mysqlproxy.types import FixedLengthInteger, \
         RestOfPacketString
 from mysqlproxy import capabilities
 from StringIO import StringIO
+import struct
 
 __all__ = [
     'PacketMeta', 'IncomingPacketChain', 'OutgoingPacketChain',
-    'Packet', 'OKPacket', 'ERRPacket', 'EOFPacket'
+    'Packet', 'RawPacket', 'OKPacket', 'ERRPacket', 'EOFPacket'
     ]
 
 class PacketMeta(object):
@@ -158,6 +159,15 @@ class Packet(object):
             opc.add_field(field, label=label)
         return opc.write_out(fde)
 
+    def serialize(self):
+        """
+        Payload bytes of all fields, without packet headers
+        """
+        sio = StringIO()
+        for label, field in self.fields:
+            field.write_out(sio, label=None)
+        return sio.getvalue()
+
     def get_field(self, field_of_interest):
         """
         Return first field going by name `field_of_interest`
@@ -168,6 +178,32 @@ class Packet(object):
         raise ValueError('field name %s does not exist' % field_of_interest)
 
 
+class RawPacket(Packet):
+    """
+    Packet whose payload has already been serialized,
+    e.g. one that was kept around in a cache
+    """
+    def __init__(self, payload, **kwargs):
+        super(RawPacket, self).__init__(0, **kwargs)
+        self.payload = payload
+
+    def write_out(self, fde):
+        """
+        Write out payload, split up into 16M chunks if need be
+        """
+        seq_id = self.seq_id
+        offset = 0
+        while True:
+            chunk = self.payload[offset:offset + 0xffffff]
+            fde.write(struct.pack('<I', len(chunk))[:3] + chr(seq_id & 0xff))
+            fde.write(chunk)
+            offset += len(chunk)
+            if len(chunk) < 0xffffff:
+                break
+            seq_id += 1
+        return (len(self.payload), seq_id)
+
+
 class OKPacket(Packet):
     """
     Generic OK packet, will most likely not be read in
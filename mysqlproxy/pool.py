@@ -0,0 +1,167 @@
+"""
+Shared backend connection pool.
+
+Used when multiplexing client sessions over a smaller
+set of backend connections.  Sessions check a connection
+out for the length of a transaction and hand it back
+once they're at a transaction boundary again.
+"""
+from collections import deque
+import threading
+import logging
+import time
+
+_LOG = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class BackendPool(object):
+    """
+    Bounded pool of backend connections.
+    `connect_fn` is a zero-argument callable returning a fresh
+    (already authenticated) ProxyConnection.  `usable`, if given,
+    tells whether an idle connection may still be handed out
+    (e.g. its backend hasn't been ejected); those that may not
+    get closed instead.  `choose`, if given, picks which of several
+    idle connections to hand out, as an index into the list of them;
+    otherwise it's the most recently used.
+    """
+    def __init__(self, connect_fn, max_size=100, acquire_timeout=10.0, usable=None,
+            choose=None):
+        self.connect_fn = connect_fn
+        self.usable = usable
+        self.choose = choose
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.idle = deque() # (conn, idle since), most recently used on the right
+        self.num_open = 0
+        self.num_waiting = 0
+        self.checkouts = 0
+        self.acquire_timeouts = 0
+        self.reaped = 0
+        self.unusable = 0
+        self.cond = threading.Condition()
+        # the handshake needs to know what the backend can do
+        # before any session has checked a connection out
+        first_conn = self.connect_fn()
+        self.num_open = 1
+        self.server_capabilities = first_conn.server_capabilities
+        self.idle.append((first_conn, time.time()))
+
+    def acquire(self, timeout=None):
+        """
+        Check out a connection, opening a new one if the pool
+        isn't full yet.  Blocks up to `timeout` seconds otherwise.
+        """
+        if timeout is None:
+            timeout = self.acquire_timeout
+        deadline = time.time() + timeout
+        if self.usable is not None:
+            self.drop_unusable()
+        with self.cond:
+            while not self.idle and self.num_open >= self.max_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.acquire_timeouts += 1
+                    raise PoolTimeout('no backend connection available after %.1fs' % timeout)
+                self.num_waiting += 1
+                try:
+                    self.cond.wait(remaining)
+                finally:
+                    self.num_waiting -= 1
+            self.checkouts += 1
+            if self.idle:
+                if self.choose is not None and len(self.idle) > 1:
+                    index = self.choose([conn for conn, _ in self.idle])
+                    conn = self.idle[index][0]
+                    del self.idle[index]
+                    return conn
+                return self.idle.pop()[0]
+            self.num_open += 1
+        try:
+            return self.connect_fn()
+        except:
+            with self.cond:
+                self.num_open -= 1
+                self.cond.notify()
+            raise
+
+    def release(self, conn):
+        """
+        Hand a connection back.  The caller guarantees it's
+        outside of a transaction and holds no session state.
+        """
+        with self.cond:
+            self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    def discard(self, conn):
+        """
+        Drop a connection that's broken or carries state
+        that can't be handed to another session.
+        """
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self.cond:
+            self.num_open -= 1
+            self.cond.notify()
+
+    def drop_unusable(self):
+        """
+        Close idle connections `usable` turns down
+        """
+        with self.cond:
+            unusable = [conn for conn, _ in self.idle if not self.usable(conn)]
+            if not unusable:
+                return 0
+            self.idle = deque([(conn, since) for conn, since in self.idle
+                if conn not in unusable])
+            self.num_open -= len(unusable)
+            self.unusable += len(unusable)
+            self.cond.notify(len(unusable))
+        for conn in unusable:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        return len(unusable)
+
+    def reap_idle(self, max_idle):
+        """
+        Close connections that sat idle for more than `max_idle`
+        seconds, before the server's wait_timeout does it for us
+        """
+        cutoff = time.time() - max_idle
+        stale = []
+        with self.cond:
+            while self.idle and self.idle[0][1] < cutoff:
+                stale.append(self.idle.popleft()[0])
+            self.num_open -= len(stale)
+            self.reaped += len(stale)
+            if stale:
+                self.cond.notify(len(stale))
+        for conn in stale:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        return len(stale)
+
+    def stats(self):
+        with self.cond:
+            return {
+                'open': self.num_open,
+                'idle': len(self.idle),
+                'in_use': self.num_open - len(self.idle),
+                'waiting': self.num_waiting,
+                'max_size': self.max_size,
+                'checkouts': self.checkouts,
+                'acquire_timeouts': self.acquire_timeouts,
+                'reaped': self.reaped,
+                'unusable': self.unusable,
+                }
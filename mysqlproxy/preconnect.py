@@ -0,0 +1,185 @@
+"""
+Pre-connected backend sockets for forward auth.
+
+With forward auth a session can't send its client the handshake
+until it has the backend's greeting (and the salt in it), so the
+backend connect would otherwise be part of every client connect.
+This keeps a few connections around that have read their greeting
+and wait for a client to authenticate them.
+
+The backend only gives an unauthenticated connection connect_timeout
+seconds (10 by default) to log in, so they're only handed out for
+`max_age` seconds.  Past that they're logged in with the proxy's own
+credentials and closed: just dropping them would count as connection
+errors, and enough of those in a row get the proxy's host blocked
+(max_connect_errors).
+
+How many are kept warm follows the rate of recent client connects,
+enough to cover the arrivals expected while one connect is in flight
+(twice over), between `min_size` and `max_size`.
+"""
+from pymysql.connections import _scramble
+from collections import deque
+import threading
+import logging
+import math
+import time
+
+_LOG = logging.getLogger(__name__)
+
+
+class PreconnectPool(object):
+    """
+    `connect_fn` returns a new ForwardAuthConnection that has
+    read the greeting.  `user`/`passwd`, if given, log in the
+    connections that go unused.  `usable`, if given, tells
+    whether a warm connection may still be handed out.
+    """
+    def __init__(self, connect_fn, user=None, passwd=None, max_age=5.0, min_size=0,
+            max_size=32, rate_window=10.0, refill_interval=0.5, usable=None):
+        self.connect_fn = connect_fn
+        self.usable = usable
+        self.user = user
+        self.passwd = passwd
+        self.max_age = max_age
+        self.min_size = min_size
+        self.max_size = max_size
+        self.rate_window = rate_window
+        self.refill_interval = refill_interval
+        self.warm = deque() # (conn, connected at), oldest on the left
+        self.expired = []
+        self.arrivals = deque() # times get() was called in the last rate_window
+        self.connect_time = 0.05 # moving average, seconds
+        self.target = min_size
+        self.hits = 0
+        self.misses = 0
+        self.retired = 0
+        self.connect_errors = 0
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='preconnect')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.cond:
+            self.expired.extend([conn for conn, _ in self.warm])
+            self.warm.clear()
+        self.retire_expired()
+
+    def get(self):
+        """
+        A connection ready for forward_authentication(), warm if
+        there is one, made on the spot otherwise
+        """
+        now = time.time()
+        with self.cond:
+            self.arrivals.append(now)
+            while self.warm:
+                conn, connected_at = self.warm.popleft()
+                if now - connected_at < self.max_age \
+                        and (self.usable is None or self.usable(conn)):
+                    self.hits += 1
+                    self.cond.notify()
+                    return conn
+                self.expired.append(conn)
+            self.misses += 1
+            self.cond.notify()
+        return self.connect()
+
+    def connect(self):
+        began = time.time()
+        conn = self.connect_fn()
+        self.connect_time = 0.8 * self.connect_time + 0.2 * (time.time() - began)
+        return conn
+
+    def connect_rate(self, now=None):
+        """
+        Client connects per second lately
+        """
+        if now is None:
+            now = time.time()
+        arrivals = self.arrivals
+        while arrivals and arrivals[0] < now - self.rate_window:
+            arrivals.popleft()
+        return len(arrivals) / self.rate_window
+
+    def compute_target(self, now=None):
+        rate = self.connect_rate(now)
+        target = 0
+        if rate:
+            target = int(math.ceil(rate * (self.connect_time + self.refill_interval) * 2))
+        return max(self.min_size, min(self.max_size, target))
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.running:
+                    return
+                now = time.time()
+                # leave enough time for a client to authenticate
+                while self.warm and now - self.warm[0][1] >= self.max_age:
+                    self.expired.append(self.warm.popleft()[0])
+                self.target = self.compute_target(now)
+                missing = self.target - len(self.warm)
+            self.retire_expired()
+            for _ in xrange(0, missing):
+                try:
+                    conn = self.connect()
+                except Exception as ex:
+                    self.connect_errors += 1
+                    _LOG.warning('Could not pre-connect to backend: %s' % ex)
+                    break
+                with self.cond:
+                    self.warm.append((conn, time.time()))
+            with self.cond:
+                # get() wakes us up early when it takes one
+                if self.running:
+                    self.cond.wait(self.refill_interval)
+
+    def retire_expired(self):
+        with self.cond:
+            expired, self.expired = self.expired, []
+        for conn in expired:
+            self.retire(conn)
+
+    def retire(self, conn):
+        """
+        Log an unused connection in and close it, or just
+        close it if we have no credentials to do that with
+        """
+        self.retired += 1
+        try:
+            if self.user is not None:
+                conn.user = self.user
+                conn.forward_authentication(_scramble((self.passwd or '').encode('latin1'),
+                    conn.salt) if self.passwd else b'\0')
+                conn.close()
+            else:
+                conn.socket.close()
+        except Exception as ex:
+            _LOG.debug('Error retiring pre-connected backend connection: %s' % ex)
+
+    def stats(self):
+        with self.cond:
+            connect_rate = self.connect_rate()
+        return {
+            'warm': len(self.warm),
+            'target': self.target,
+            'hits': self.hits,
+            'misses': self.misses,
+            'retired': self.retired,
+            'connect_errors': self.connect_errors,
+            'connect_rate': connect_rate,
+            'connect_time': self.connect_time,
+            }
@@ -0,0 +1,163 @@
+"""
+Sampling profiler.
+
+A background thread looks at every other thread's stack through
+sys._current_frames() every so often and counts how often each
+distinct stack shows up.  Output is in the collapsed format flame
+graph tools take (one `frame;frame;frame count` line per stack).
+
+Stacks are counted as tuples of code objects and only turned
+into text on output, which keeps each sample cheap.  On top of
+that the sampler backs off whenever sampling takes more than
+`max_overhead` of the wall clock time.
+"""
+import threading
+import logging
+import time
+import sys
+import os
+
+_LOG = logging.getLogger(__name__)
+
+# leaf frames of threads that are blocked, not burning CPU
+IDLE_LEAVES = frozenset([
+    ('socket.py', 'read'),
+    ('socket.py', 'readline'),
+    ('socket.py', 'accept'),
+    ('threading.py', 'wait'),
+    ('threading.py', '_sleep'),
+    ('timer_wheel.py', 'run'),
+    ])
+
+
+def frame_label(code):
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+        code.co_firstlineno)
+
+
+class SamplingProfiler(object):
+    """
+    `interval` seconds between samples at most, stacks cut
+    off at `max_depth` frames.  With `skip_idle`, threads blocked
+    in socket reads and waits aren't counted.
+    """
+    def __init__(self, interval=0.005, max_depth=100, max_overhead=0.02,
+            skip_idle=True):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.max_overhead = max_overhead
+        self.skip_idle = skip_idle
+        self.thread = None
+        self.running = False
+        self.lock = threading.Lock()
+        self.idle_codes = {} # code -> whether it's in IDLE_LEAVES
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = {} # (code, code, ...) leaf last -> samples
+            self.samples = 0
+            self.idle_samples = 0
+            self.sampling_time = 0.0
+            self.run_time = 0.0
+            self.started_at = time.time() if self.running else None
+
+    def start(self):
+        if self.running:
+            return False
+        self.running = True
+        self.started_at = time.time()
+        self.thread = threading.Thread(target=self.run, name='profiler')
+        self.thread.daemon = True
+        self.thread.start()
+        _LOG.info('Profiler started')
+        return True
+
+    def stop(self):
+        if not self.running:
+            return False
+        self.running = False
+        self.thread.join()
+        self.thread = None
+        _LOG.info('Profiler stopped after %d samples' % self.samples)
+        return True
+
+    def run(self):
+        clock = time.time
+        while self.running:
+            began = clock()
+            self.sample()
+            cost = clock() - began
+            self.sampling_time += cost
+            # never spend more than max_overhead of the time sampling
+            time.sleep(max(self.interval, cost / self.max_overhead - cost))
+        self.run_time += time.time() - self.started_at
+
+    def sample(self):
+        """
+        Count the current stack of every thread but this one
+        """
+        own_ident = threading.current_thread().ident
+        max_depth = self.max_depth
+        skip_idle = self.skip_idle
+        idle_codes = self.idle_codes
+        frames = sys._current_frames()
+        with self.lock:
+            counts = self.counts
+            for ident, frame in frames.iteritems():
+                if ident == own_ident:
+                    continue
+                if skip_idle:
+                    code = frame.f_code
+                    idle = idle_codes.get(code)
+                    if idle is None:
+                        idle = idle_codes[code] = \
+                            (os.path.basename(code.co_filename), code.co_name) in IDLE_LEAVES
+                    if idle:
+                        self.idle_samples += 1
+                        continue
+                stack = []
+                while frame is not None and len(stack) < max_depth:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                key = tuple(stack)
+                counts[key] = counts.get(key, 0) + 1
+                self.samples += 1
+
+    def collapsed(self):
+        """
+        Lines of `root;...;leaf count`, most frequent first
+        """
+        with self.lock:
+            counts = self.counts.items()
+        labels = {}
+        lines = []
+        for stack, count in sorted(counts, key=lambda item: -item[1]):
+            names = []
+            for code in reversed(stack):
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = frame_label(code)
+                names.append(label)
+            lines.append('%s %d' % (';'.join(names), count))
+        return lines
+
+    def dump(self, out):
+        """
+        Write collapsed stacks to file-like `out`
+        """
+        for line in self.collapsed():
+            out.write(line + '\n')
+
+    def stats(self):
+        run_time = self.run_time
+        if self.running:
+            run_time += time.time() - self.started_at
+        return {
+            'running': self.running,
+            'samples': self.samples,
+            'idle_samples': self.idle_samples,
+            'stacks': len(self.counts),
+            'run_time': run_time,
+            'overhead': self.sampling_time / run_time if run_time else 0.0,
+            }
@@ -6,6 +6,14 @@ from mysqlproxy.types import *
 from mysqlproxy.packet import Packet, EOFPacket, OKPacket, ERRPacket, OutgoingPacketChain
 from mysqlproxy import status_flags
 from mysqlproxy.binary_protocol import generate_binary_field_info
+from mysqlproxy import capabilities
+from mysqlproxy.row_encoder import TextRowEncoder
+from mysqlproxy.charset import charset_mblen
+from mysqlproxy.spill import SpillFile
+from StringIO import StringIO
+import struct
+
+UTF8_CHARSET_ID = 33
 
 # in particular, ColumnDefinition41.  Again, 3.2 is not supported.
 class ColumnDefinition(Packet):
@@ -36,40 +44,152 @@ class ColumnDefinition(Packet):
             ('filler', FixedLengthString(2, '\x00\x00'))
             ]
         if show_default:
-            self.fields += [
-                ('default_len', LengthEncodedInteger(len(default_value) if default_value else 0)),
-                ('default_value', FixedLengthString(default_value))
-                ]
+            if default_value is None:
+                self.fields.append(('default_value', FixedLengthString(1, '\xfb')))
+            else:
+                self.fields.append(('default_value', LengthEncodedString(default_value)))
+
+    @classmethod
+    def from_field_descriptor(cls, field, encoding='utf8', **kwargs):
+        """
+        Build from a pymysql field descriptor packet, as
+        read off the backend.
+        """
+        def encode(val):
+            if isinstance(val, unicode):
+                return val.encode(encoding)
+            return val or b''
+        return cls(encode(field.name), field.type_code, field.length,
+            field.charsetnr,
+            schema=encode(field.db),
+            table=encode(field.table_name),
+            org_table=encode(field.org_table),
+            org_name=encode(field.org_name),
+            decimals=field.scale,
+            flags=field.flags,
+            **kwargs)
+
+
+class ColumnBlock(object):
+    """
+    Column count, column definitions and the trailing EOF of a
+    result set, serialized once with their packet headers.
+    Only the sequence ids and EOF status flags differ between
+    result sets of the same shape, so those get patched in
+    on the way out.
+    """
+    def __init__(self, client_capabilities, columns):
+        self.num_columns = len(columns)
+        self.column_types = [column.column_type for column in columns]
+        col_count = StringIO()
+        LengthEncodedInteger(self.num_columns).write_out(col_count, label=None)
+        payloads = [col_count.getvalue()]
+        payloads += [column.serialize() for column in columns]
+        payloads.append(EOFPacket(client_capabilities).serialize())
+        self.num_packets = len(payloads)
+        template = bytearray()
+        self.seq_offsets = []
+        for payload in payloads:
+            self.seq_offsets.append(len(template) + 3)
+            template += struct.pack('<I', len(payload))[:3] + b'\x00' + payload
+        self.status_offset = None
+        if client_capabilities & capabilities.PROTOCOL_41:
+            # eof header, 2 bytes of warnings, then the status flags
+            self.status_offset = self.seq_offsets[-1] + 4
+        self.template = bytes(template)
+
+    def render(self, start_seq_id, status_flags):
+        buf = bytearray(self.template)
+        seq_id = start_seq_id
+        for offset in self.seq_offsets:
+            buf[offset] = seq_id & 0xff
+            seq_id += 1
+        if self.status_offset is not None:
+            buf[self.status_offset] = status_flags & 0xff
+            buf[self.status_offset + 1] = (status_flags >> 8) & 0xff
+        return buf
+
+    def write_out(self, net_fd, start_seq_id, status_flags):
+        net_fd.write(self.render(start_seq_id, status_flags))
+        return (len(self.template), start_seq_id + self.num_packets - 1)
 
 
 class ResultSet(object):
-    def __init__(self, client_capabilities, seq_id=1, more_results=False, flags=0):
+    # rows per buffer handed to the socket by the text row encoder
+    ROW_BATCH_SIZE = 256
+    # estimated bookkeeping per row and per non-string value held in memory
+    ROW_OVERHEAD = 64
+    VALUE_OVERHEAD = 8
+
+    def __init__(self, client_capabilities, seq_id=1, more_results=False, flags=0,
+            spill_threshold=None, spill_dir=None):
         """
         columns -- list of ColumnDefinition objects
         rows -- 2d list of respective values
         more_results -- True if there are actually more results than given
             (this is just a server-status reported to the client)
+        spill_threshold -- bytes of rows held in memory past which they
+            go to a temp file in `spill_dir` instead (None to never spill)
         """
         self.client_capabilities = client_capabilities
         self.columns = []
+        self.column_block = None
         self.rows = []
         self.more_results = more_results
         self.seq_id = seq_id
         self.flags = flags
+        # charset the client expects string values in, and that
+        # of the backend they came from (None if not from a backend)
+        self.charset_id = UTF8_CHARSET_ID
+        self.backend_charset_id = None
+        self.column_charsets = None
+        self.spill_threshold = spill_threshold
+        self.spill_dir = spill_dir
+        self.spill_file = None
+        self.spill_encoder = None
+        self.rows_bytes = 0
 
     def write_out(self, net_fd):
         colinfo_written, next_seq_id = self.send_column_info(net_fd, self.seq_id)
         rowinfo_written, last_seq_id = self.send_row_info(net_fd, next_seq_id)
         return (colinfo_written+rowinfo_written, last_seq_id)
 
+    @property
+    def column_types(self):
+        if self.column_block is not None:
+            return self.column_block.column_types
+        return [column.column_type for column in self.columns]
+
+    @property
+    def column_count(self):
+        if self.column_block is not None:
+            return self.column_block.num_columns
+        return len(self.columns)
+
+    def set_column_block(self, column_block):
+        """
+        Use already serialized column metadata instead
+        of individually added columns
+        """
+        if self.row_count > 0:
+            raise ValueError('Attempt to add column after row population')
+        self.column_block = column_block
+
+    def build_column_block(self):
+        """
+        Serialize the added columns into a ColumnBlock
+        """
+        self.column_block = ColumnBlock(self.client_capabilities, self.columns)
+        return self.column_block
+
     def add_column(self, name, coltype, field_length, **kwargs):
-        if len(self.rows) > 0:
+        if self.row_count > 0:
             # By adding more columns later, any added rows 
             # would now be misaligned
             raise ValueError('Attempt to add column after row population')
 
-        charset_code = kwargs.pop('charset_code', 33) # always default to UTF8
-        char_count = 3 if charset_code == 33 else 1
+        charset_code = kwargs.pop('charset_code', UTF8_CHARSET_ID)
+        char_count = charset_mblen(charset_code)
         column = ColumnDefinition(name, 
             coltype, field_length * char_count,
             charset_code, **kwargs)
@@ -98,22 +218,65 @@ class ResultSetText(ResultSet):
     def add_row(self, row_values):
         """
         In the text protocol, the values are just written out
-        on the wire as fixed length strings, regardless of its type
+        on the wire as fixed length strings, regardless of its type.
+        Rows are kept as-is and only encoded when sent, unless
+        they're past the spill threshold.
         """
-        if len(row_values) != len(self.columns):
+        if len(row_values) != self.column_count:
             raise ValueError(u'row value count (%d) != column count (%d)' % \
-                (len(row_values), len(self.columns)))
-        self.rows.append(
-            ResultSetRowText(row_values)
-            )
+                (len(row_values), self.column_count))
+        self.rows.append(row_values)
+        if self.spill_threshold is None:
+            return
+        if self.spill_file is not None:
+            if len(self.rows) >= self.ROW_BATCH_SIZE:
+                self.spill()
+            return
+        self.rows_bytes += self.ROW_OVERHEAD + sum(
+            len(val) if isinstance(val, basestring) else self.VALUE_OVERHEAD
+            for val in row_values)
+        if self.rows_bytes > self.spill_threshold:
+            self.spill()
+
+    def spill(self):
+        """
+        Encode the rows held in memory onto the end of the spill
+        file, numbered as if the columns went out from `seq_id`
+        """
+        if self.spill_file is None:
+            first_seq_id = self.seq_id + self.column_count + 2
+            self.spill_file = SpillFile(first_seq_id, self.spill_dir)
+            self.spill_encoder = self.row_encoder()
+        next_seq_id = self.spill_file.next_seq_id
+        for start in range(0, len(self.rows), self.ROW_BATCH_SIZE):
+            batch = self.rows[start:start + self.ROW_BATCH_SIZE]
+            buf, next_seq_id = self.spill_encoder.encode_rows(batch, next_seq_id)
+            self.spill_file.append(buf, len(batch), next_seq_id)
+        self.rows = []
+        self.rows_bytes = 0
+
+    @property
+    def row_count(self):
+        spilled = self.spill_file.rows if self.spill_file is not None else 0
+        return spilled + len(self.rows)
+
+    def close(self):
+        """
+        Drop the spill file, if any, and the rows in it
+        """
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
 
     def send_column_info(self, net_fd, seq_id):
         """
         Send column metadata over the wire, followed by an EOF
         """
-        num_cols = len(self.columns)
-        if num_cols == 0 or len(self.rows) == 0:
+        num_cols = self.column_count
+        if num_cols == 0 or not self.has_rows():
             return OKPacket(self.client_capabilities, 0, 0, seq_id=self.seq_id).write_out(net_fd)
+        if self.column_block is not None:
+            return self.column_block.write_out(net_fd, seq_id, self.flags)
         opc = OutgoingPacketChain(start_seq_id=seq_id)
         opc.add_field(LengthEncodedInteger(num_cols), 'num_columns')
         total_written, seq_id = opc.write_out(net_fd)
@@ -128,14 +291,33 @@ class ResultSetText(ResultSet):
         total_written += eof_written
         return total_written, seq_id
 
+    def has_rows(self):
+        return self.row_count > 0
+
+    def row_encoder(self):
+        return TextRowEncoder(self.column_types,
+            charset_id=self.charset_id,
+            column_charsets=self.column_charsets,
+            backend_charset_id=self.backend_charset_id)
+
     def send_row_info(self, net_fd, seq_id):
+        encoder = self.spill_encoder or self.row_encoder()
+        total_written = 0
+        next_seq_id = seq_id + 1
+        if self.spill_file is not None:
+            total_written += self.spill_file.write_out(net_fd, next_seq_id)
+            next_seq_id += self.spill_file.packets
+            self.close()
+        for start in range(0, len(self.rows), self.ROW_BATCH_SIZE):
+            buf, next_seq_id = encoder.encode_rows(
+                self.rows[start:start + self.ROW_BATCH_SIZE], next_seq_id)
+            net_fd.write(buf)
+            total_written += len(buf)
+        return self.send_row_eof(net_fd, next_seq_id - 1, total_written)
+
+    def send_row_eof(self, net_fd, seq_id, total_written):
         server_status_flags = self.flags | \
             (0 if not self.more_results else status_flags.MORE_RESULTS_EXISTS)
-        total_written = 0
-        for row in self.rows:
-            row.seq_id = seq_id+1
-            row_bytes_written, seq_id = row.write_out(net_fd)
-            total_written += row_bytes_written
         eof_written, seq_id = EOFPacket(
             self.client_capabilities,
             seq_id=seq_id+1,
@@ -143,6 +325,109 @@ class ResultSetText(ResultSet):
         return total_written, seq_id
 
 
+class StreamingResultSetText(ResultSetText):
+    """
+    Result set whose rows aren't held in memory.  They're pulled
+    from `fetch_rows` (e.g. an unbuffered cursor's fetchmany)
+    batch by batch while being written out, so how fast the
+    backend gets read is up to how fast `net_fd` takes them.
+    """
+    def __init__(self, client_capabilities, fetch_rows, **kwargs):
+        """
+        has_more -- optional callable telling, once all rows
+            are fetched, whether another result follows
+        """
+        self.has_more = kwargs.pop('has_more', None)
+        super(StreamingResultSetText, self).__init__(client_capabilities, **kwargs)
+        self.fetch_rows = fetch_rows
+        self.rows_sent = 0
+
+    def add_row(self, row_values):
+        raise ValueError('rows of a streaming result set come from its fetch_rows')
+
+    def materialize(self, spill_threshold=None, spill_dir=None):
+        """
+        Fetch every row into a ResultSetText of the same shape,
+        for whatever needs them all at hand.  Rows past
+        `spill_threshold` bytes go to disk.
+        """
+        result = ResultSetText(self.client_capabilities, seq_id=self.seq_id,
+            more_results=self.more_results, flags=self.flags,
+            spill_threshold=spill_threshold, spill_dir=spill_dir)
+        result.columns = self.columns
+        result.column_block = self.column_block
+        result.charset_id = self.charset_id
+        result.backend_charset_id = self.backend_charset_id
+        result.column_charsets = self.column_charsets
+        try:
+            rows = self.fetch_rows(self.ROW_BATCH_SIZE)
+            while rows:
+                for row in rows:
+                    result.add_row(row)
+                rows = self.fetch_rows(self.ROW_BATCH_SIZE)
+        except:
+            result.close()
+            raise
+        if self.has_more is not None:
+            result.more_results = self.has_more()
+        return result
+
+    def has_rows(self):
+        # we won't know until we're sending them, and an
+        # empty result set still gets its column info
+        return True
+
+    def send_row_info(self, net_fd, seq_id):
+        encoder = self.row_encoder()
+        total_written = 0
+        next_seq_id = seq_id + 1
+        rows = self.fetch_rows(self.ROW_BATCH_SIZE)
+        while rows:
+            buf, next_seq_id = encoder.encode_rows(rows, next_seq_id)
+            net_fd.write(buf)
+            total_written += len(buf)
+            self.rows_sent += len(rows)
+            rows = self.fetch_rows(self.ROW_BATCH_SIZE)
+        if self.has_more is not None:
+            self.more_results = self.has_more()
+        return self.send_row_eof(net_fd, next_seq_id - 1, total_written)
+
+
+class MultiResultResponse(object):
+    """
+    Response to a multi-statement query or CALL: one result
+    (OK, ERR or result set) after the other, all but the last
+    flagged MORE_RESULTS_EXISTS, sequence ids running on from one
+    to the next.  `responses` may be a generator, so the next
+    result needn't exist before the previous one went out.
+    """
+    def __init__(self, responses, seq_id=1):
+        self.responses = responses
+        self.seq_id = seq_id
+        self.results_sent = 0
+        self.rows_sent = 0
+        # of the ERR that ended the batch, if one did
+        self.error_code = 0
+
+    def write_out(self, net_fd):
+        total_written = 0
+        seq_id = self.seq_id
+        last_seq_id = seq_id
+        flush = getattr(net_fd, 'flush', None)
+        for response in self.responses:
+            response.seq_id = seq_id
+            written, last_seq_id = response.write_out(net_fd)
+            total_written += written
+            seq_id = last_seq_id + 1
+            self.results_sent += 1
+            self.rows_sent += getattr(response, 'rows_sent', 0)
+            self.error_code = getattr(response, 'error_code', 0)
+            if flush is not None:
+                # don't hold results back while the backend works on the next
+                flush()
+        return total_written, last_seq_id
+
+
 class ResultSetRowText(Packet):
     """
     Actual values for the returned rows
@@ -164,14 +449,19 @@ class ResultSetBinary(ResultSetText):
         The binary result set has its own way of transliterating
         variable types to match the columns
         """
-        if len(row_values) != len(self.columns):
+        if len(row_values) != self.column_count:
             raise ValueError(u'row value count (%d) != column count (%d)' % \
-                (len(row_values), len(self.columns)))
+                (len(row_values), self.column_count))
         self.rows.append(ResultSetRowBinary(self.columns, row_values))
 
     def send_row_info(self, net_fd, seq_id):
         if not self.flags & status_flags.STATUS_CURSOR_EXISTS:
-            return super(ResultSetBinary, self).send_row_info(net_fd, seq_id)
+            total_written = 0
+            for row in self.rows:
+                row.seq_id = seq_id+1
+                row_bytes_written, seq_id = row.write_out(net_fd)
+                total_written += row_bytes_written
+            return self.send_row_eof(net_fd, seq_id, total_written)
 
 
 class ResultSetRowBinary(Packet):
@@ -0,0 +1,57 @@
+"""
+Registry of live client sessions.
+
+Hands out the connection ids clients see in the handshake (and
+in CONNECTION_ID(), SHOW PROCESSLIST...), which have nothing to do
+with the backend's own thread ids, and maps them back to sessions
+so KILL can find them.
+"""
+import itertools
+import threading
+import time
+
+
+class SessionRegistry(object):
+    def __init__(self, first_id=1):
+        self.ids = itertools.count(first_id)
+        self.sessions = {} # connection id -> SQLProxy
+        self.started = {} # connection id -> time registered
+        self.lock = threading.Lock()
+
+    def register(self, proxy):
+        """
+        Returns a connection id for `proxy`, unique for the life
+        of the process (well, until it wraps at 2**32)
+        """
+        with self.lock:
+            while True:
+                conn_id = next(self.ids) % (1<<32)
+                if conn_id and conn_id not in self.sessions:
+                    break
+            self.sessions[conn_id] = proxy
+            self.started[conn_id] = time.time()
+        return conn_id
+
+    def unregister(self, conn_id):
+        with self.lock:
+            self.sessions.pop(conn_id, None)
+            self.started.pop(conn_id, None)
+
+    def get(self, conn_id):
+        return self.sessions.get(conn_id)
+
+    def snapshot(self):
+        """
+        [(connection id, proxy, registered at)] for all live sessions
+        """
+        with self.lock:
+            return [(conn_id, proxy, self.started[conn_id])
+                for conn_id, proxy in sorted(self.sessions.items())]
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+# sessions not given a registry of their own share this one,
+# so connection ids are unique across the process
+default_registry = SessionRegistry()
@@ -0,0 +1,223 @@
+"""
+Replay of captured traffic (see mysqlproxy.capture).
+
+Each captured session is re-run on a connection of its own,
+commands sent with the same spacing as when captured (scaled by
+`speed`, or back to back with a speed of 0), sessions starting
+the same time apart as they originally did.  At most `concurrency`
+sessions run at once.  How long each command took to answer is
+kept per command type for comparing runs.
+"""
+from mysqlproxy.capture import CapturedSession
+from pymysql.err import MySQLError
+import threading
+import logging
+import Queue
+import time
+import os
+
+_LOG = logging.getLogger(__name__)
+
+COM_QUIT = 0x01
+COM_QUERY = 0x03
+COM_FIELD_LIST = 0x04
+COM_CHANGE_USER = 0x11
+COM_BINLOG_DUMP = 0x12
+COM_STMT_PREPARE = 0x16
+COM_STMT_EXECUTE = 0x17
+COM_STMT_SEND_LONG_DATA = 0x18
+COM_STMT_CLOSE = 0x19
+
+# commands the server doesn't answer
+NO_RESPONSE_COMMANDS = frozenset([COM_STMT_CLOSE, COM_STMT_SEND_LONG_DATA])
+# answered with more than we know how to read generically
+SKIPPED_COMMANDS = frozenset([COM_STMT_PREPARE, COM_STMT_EXECUTE, COM_BINLOG_DUMP,
+    COM_CHANGE_USER])
+
+
+def load_sessions(paths):
+    """
+    CapturedSessions from capture files and directories
+    of them, oldest first
+    """
+    sessions = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = [os.path.join(path, name) for name in sorted(os.listdir(path))
+                if name.endswith('.cap')]
+        else:
+            files = [path]
+        sessions.extend([CapturedSession(capture_path) for capture_path in files])
+    sessions.sort(key=lambda session: session.started)
+    return sessions
+
+
+def percentile(sorted_values, point):
+    if not sorted_values:
+        return None
+    pos = min(len(sorted_values) - 1, int(round(point / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[pos]
+
+
+class ReplayStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {} # command code -> [seconds]
+        self.errors = {} # command code -> count
+        self.skipped = 0
+        self.sessions = 0
+        self.failed_sessions = 0
+        self.behind = 0.0 # total seconds commands went out late
+
+    def add(self, command, latency, error=False):
+        with self.lock:
+            self.latencies.setdefault(command, []).append(latency)
+            if error:
+                self.errors[command] = self.errors.get(command, 0) + 1
+
+    def summary(self, command_names=None, points=(50, 90, 99, 99.9)):
+        """
+        Lines of count, errors and latency percentiles (in
+        milliseconds) per command type, then for all of them
+        """
+        command_names = command_names or {}
+        lines = ['%-14s %8s %7s %s %9s' % ('command', 'count', 'errors',
+            ' '.join(['%9s' % ('p%s' % point) for point in points]), 'max')]
+        everything = []
+        for command in sorted(self.latencies):
+            latencies = sorted(self.latencies[command])
+            everything.extend(latencies)
+            lines.append(self._summary_line(command_names.get(command, '0x%02x' % command),
+                latencies, self.errors.get(command, 0), points))
+        everything.sort()
+        lines.append(self._summary_line('all', everything,
+            sum(self.errors.values()), points))
+        return lines
+
+    @staticmethod
+    def _summary_line(name, latencies, errors, points):
+        return '%-14s %8d %7d %s %9.3f' % (name, len(latencies), errors,
+            ' '.join(['%9.3f' % (percentile(latencies, point) * 1000) for point in points]),
+            (latencies[-1] if latencies else 0) * 1000)
+
+    def dump(self, out, command_names=None):
+        """
+        Write `command,latency_us` lines to `out`
+        """
+        command_names = command_names or {}
+        for command in sorted(self.latencies):
+            name = command_names.get(command, '0x%02x' % command)
+            for latency in self.latencies[command]:
+                out.write('%s,%d\n' % (name, latency * 1e6))
+
+
+def run_command(conn, command, payload):
+    """
+    Send one raw command on pymysql connection `conn` and
+    read its response.  Returns False if the session's over.
+    """
+    conn._execute_command(command, payload)
+    if command == COM_QUIT:
+        return False
+    if command in NO_RESPONSE_COMMANDS:
+        return True
+    if command == COM_QUERY:
+        conn._read_query_result()
+        while conn._result.has_next:
+            conn._read_query_result()
+    elif command == COM_FIELD_LIST:
+        conn._read_field_descriptors()
+    else:
+        conn._read_packet()
+    return True
+
+
+class Replayer(object):
+    """
+    `connect(header)` returns a fresh connection logged in
+    the way the captured session with `header` was
+    """
+    def __init__(self, connect, sessions, speed=1.0, concurrency=10):
+        self.connect = connect
+        self.sessions = sessions
+        self.speed = speed
+        self.concurrency = concurrency
+        self.stats = ReplayStats()
+
+    def run(self):
+        if not self.sessions:
+            return self.stats
+        self.first_started = self.sessions[0].started
+        self.replay_started = time.time()
+        queue = Queue.Queue()
+        for session in self.sessions:
+            queue.put(session)
+        workers = []
+        for _ in xrange(0, min(self.concurrency, len(self.sessions))):
+            worker = threading.Thread(target=self.work, args=(queue,))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+        return self.stats
+
+    def work(self, queue):
+        while True:
+            try:
+                session = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                self.replay_session(session)
+            except Exception as ex:
+                _LOG.warning('Replaying %s failed: %s' % (session.path, ex))
+                with self.stats.lock:
+                    self.stats.failed_sessions += 1
+
+    def wait_until(self, captured_at):
+        """
+        Sleep until the replay catches up with a command
+        captured at `captured_at`
+        """
+        if not self.speed:
+            return
+        due = self.replay_started + (captured_at - self.first_started) / self.speed
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            with self.stats.lock:
+                self.stats.behind -= delay
+
+    def replay_session(self, session):
+        self.wait_until(session.started)
+        conn = self.connect(session.header)
+        stats = self.stats
+        with stats.lock:
+            stats.sessions += 1
+        try:
+            for elapsed, _, payload in session.commands:
+                if not payload:
+                    continue
+                command, args = ord(payload[0]), payload[1:]
+                if command in SKIPPED_COMMANDS:
+                    with stats.lock:
+                        stats.skipped += 1
+                    continue
+                self.wait_until(session.started + elapsed)
+                began = time.time()
+                try:
+                    more = run_command(conn, command, args)
+                except MySQLError as ex:
+                    if conn.socket is None or ex.args[:1] in ((2006,), (2013,)):
+                        # lost the connection, no point going on
+                        raise
+                    stats.add(command, time.time() - began, error=True)
+                    continue
+                stats.add(command, time.time() - began)
+                if not more:
+                    return
+        finally:
+            if conn.socket is not None:
+                conn.close()
@@ -0,0 +1,320 @@
+"""
+Query rewriting.
+
+Rules are loaded from a JSON file holding a list of objects,
+each with a `match` regex (case insensitive) and one action:
+
+    {"name": "no-sleep", "match": "\\bsleep\\(\\s*\\d+\\s*\\)", "replace": "sleep(0)"}
+    {"name": "cap-reports", "match": "^\\s*select\\b", "hint": "MAX_EXECUTION_TIME(5000)",
+        "keywords": ["report_daily"]}
+    {"name": "bound-audit", "match": "^\\s*select\\b.*\\bfrom\\s+audit_log\\b", "limit": 1000}
+
+`replace` is a re.sub() template, `hint` is put in an optimizer
+hint comment right after the match, and `limit` appends a LIMIT to
+matching queries that don't have one.
+
+Running every rule's regex on every query doesn't scale to
+hundreds of rules, so each rule is keyed on words that must appear
+in a query for it to match (given as `keywords` or pulled out of
+the regex).  A query's fingerprint is split into words once, and
+only rules keyed on one of those get their regex run.  Which rules
+are candidates is memoized per fingerprint.  Keywords are looked for
+in the fingerprint, so literal values can't be keywords.
+"""
+from mysqlproxy.fingerprint import fingerprint
+import sre_parse
+import sre_constants as sre
+import threading
+import logging
+import json
+import re
+
+_LOG = logging.getLogger(__name__)
+
+_WORDS = re.compile(r'[a-z0-9_$]+')
+_HAS_LIMIT = re.compile(r'\blimit\b', re.I)
+
+# markers in a flattened regex, see _required_sequence()
+_BOUNDARY = object()
+_OPTIONAL_BOUNDARY = object()
+_OTHER = object()
+
+_BOUNDARY_ATS = frozenset([sre.AT_BEGINNING, sre.AT_BEGINNING_STRING,
+    sre.AT_BOUNDARY, sre.AT_END, sre.AT_END_STRING])
+
+
+class RewriteRuleError(ValueError):
+    pass
+
+
+def _is_word_char(char):
+    return char.isalnum() or char in '_$'
+
+
+def _matches_nonword(items):
+    """
+    True if parsed regex `items` only ever match
+    whitespace or punctuation (other than quotes)
+    """
+    for op, av in items:
+        if op == sre.LITERAL:
+            char = unichr(av)
+            if _is_word_char(char) or char in '\'"':
+                return False
+        elif op == sre.IN:
+            for in_op, in_av in av:
+                if in_op == sre.CATEGORY and in_av == sre.CATEGORY_SPACE:
+                    continue
+                if in_op == sre.LITERAL and not _is_word_char(unichr(in_av)) \
+                        and unichr(in_av) not in '\'"':
+                    continue
+                return False
+        else:
+            return False
+    return True
+
+
+def _required_sequence(items):
+    """
+    Flatten parsed regex `items` into what any match must
+    contain, in order: lowercase characters, _BOUNDARY for
+    things only matching between words, _OPTIONAL_BOUNDARY for
+    things matching either that or nothing, _OTHER for the rest
+    """
+    out = []
+    for op, av in items:
+        if op == sre.LITERAL:
+            out.append(unichr(av).lower())
+        elif op == sre.AT:
+            out.append(_BOUNDARY if av in _BOUNDARY_ATS else _OTHER)
+        elif op == sre.SUBPATTERN:
+            out.extend(_required_sequence(av[1]))
+        elif op in (sre.MAX_REPEAT, sre.MIN_REPEAT):
+            min_count, _, repeated = av
+            if _matches_nonword(repeated):
+                out.append(_BOUNDARY if min_count > 0 else _OPTIONAL_BOUNDARY)
+            else:
+                out.append(_OTHER)
+        elif op == sre.IN and _matches_nonword([(op, av)]):
+            out.append(_BOUNDARY)
+        else:
+            out.append(_OTHER)
+    return out
+
+
+def _is_boundary(item):
+    return item is _BOUNDARY or (item is not _OTHER and not _is_word_char(item))
+
+
+def extract_keywords(pattern):
+    """
+    Whole words any match of regex `pattern` must contain,
+    skipping anything quoted or numeric
+    """
+    try:
+        sequence = _required_sequence(sre_parse.parse(pattern))
+    except sre.error as ex:
+        raise RewriteRuleError('bad pattern %r: %s' % (pattern, ex))
+    keywords = set()
+    in_quotes = None
+    pos = 0
+    while pos < len(sequence):
+        item = sequence[pos]
+        if item in ('\'', '"'):
+            if in_quotes is None:
+                in_quotes = item
+            elif in_quotes == item:
+                in_quotes = None
+        if item is _BOUNDARY or item is _OTHER or item is _OPTIONAL_BOUNDARY \
+                or not _is_word_char(item):
+            pos += 1
+            continue
+        end = pos
+        while end < len(sequence) and sequence[end] not in (_BOUNDARY, _OTHER,
+                _OPTIONAL_BOUNDARY) and _is_word_char(sequence[end]):
+            end += 1
+        # the word must be delimited on both sides, looking past
+        # anything that may or may not match
+        before = pos - 1
+        while before >= 0 and sequence[before] is _OPTIONAL_BOUNDARY:
+            before -= 1
+        after = end
+        while after < len(sequence) and sequence[after] is _OPTIONAL_BOUNDARY:
+            after += 1
+        word = u''.join(sequence[pos:end])
+        if before >= 0 and after < len(sequence) and in_quotes is None \
+                and _is_boundary(sequence[before]) and _is_boundary(sequence[after]) \
+                and not word.isdigit():
+            keywords.add(str(word))
+        pos = end
+    return frozenset(keywords)
+
+
+class RewriteRule(object):
+    """
+    One rule, see the module docstring for the fields
+    """
+    def __init__(self, name, match, replace=None, hint=None, limit=None,
+            keywords=None, count=0):
+        actions = [action for action in (replace, hint, limit) if action is not None]
+        if len(actions) != 1:
+            raise RewriteRuleError('rule %s needs exactly one of replace, hint or limit' % name)
+        self.name = name
+        try:
+            self.pattern = re.compile(match, re.I)
+        except re.error as ex:
+            raise RewriteRuleError('rule %s: bad pattern: %s' % (name, ex))
+        self.replace = replace
+        self.hint = hint
+        self.limit = limit
+        self.count = count
+        if keywords is None:
+            keywords = extract_keywords(match)
+        self.keywords = frozenset([keyword.lower() for keyword in keywords])
+        self.applied = 0
+
+    @classmethod
+    def from_dict(cls, spec):
+        spec = dict(spec)
+        name = spec.pop('name', None) or spec.get('match')
+        if 'match' not in spec:
+            raise RewriteRuleError('rule %s has no match pattern' % name)
+        try:
+            return cls(name, **spec)
+        except TypeError as ex:
+            raise RewriteRuleError('rule %s: %s' % (name, ex))
+
+    def apply(self, query):
+        """
+        Rewritten query, or None if the rule doesn't apply
+        """
+        if self.replace is not None:
+            rewritten, num_subs = self.pattern.subn(self.replace, query, self.count)
+            return rewritten if num_subs else None
+        match = self.pattern.search(query)
+        if match is None:
+            return None
+        if self.hint is not None:
+            hint = ' /*+ %s */' % self.hint
+            if hint in query:
+                return None
+            return query[:match.end()] + hint + query[match.end():]
+        stripped = query.rstrip().rstrip(';').rstrip()
+        if ';' in stripped or _HAS_LIMIT.search(stripped):
+            return None
+        return '%s LIMIT %d' % (stripped, self.limit)
+
+
+class RuleSet(object):
+    """
+    Rules indexed by keyword.  Each rule is filed under one of
+    its keywords (the longest, as a guess at the rarest), rules
+    without any are candidates for every query.
+    """
+    def __init__(self, rules):
+        self.rules = tuple(rules)
+        self.index = {}
+        unkeyed = []
+        for pos, rule in enumerate(self.rules):
+            if rule.keywords:
+                key = max(rule.keywords, key=lambda keyword: (len(keyword), keyword))
+                self.index.setdefault(key, []).append(pos)
+            else:
+                unkeyed.append(pos)
+        self.unkeyed = tuple(unkeyed)
+
+    def candidates(self, normalized):
+        """
+        Rules that may match a query with fingerprint `normalized`,
+        in the order they were given
+        """
+        words = set(_WORDS.findall(normalized))
+        positions = list(self.unkeyed)
+        index = self.index
+        for word in words:
+            hits = index.get(word)
+            if hits is not None:
+                positions.extend(hits)
+        if not positions:
+            return ()
+        positions.sort()
+        rules = self.rules
+        return tuple([rules[pos] for pos in positions if rules[pos].keywords <= words])
+
+
+class QueryRewriter(object):
+    """
+    Shared by all sessions.  Rules can be swapped at runtime
+    with set_rules() or load().
+    """
+    def __init__(self, rules=(), memo_size=10000):
+        self.memo_size = memo_size
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.rewritten = 0
+        self.memo_hits = 0
+        self.set_rules(rules)
+
+    def set_rules(self, rules):
+        # swapped in one go so rewrite() never sees a half-built set
+        self.state = (RuleSet(rules), {})
+
+    def load(self, path):
+        self.set_rules(load_rules(path))
+
+    @property
+    def rules(self):
+        return self.state[0].rules
+
+    def rewrite(self, query, normalized=None):
+        """
+        `query` with all applicable rules applied in order.
+        Pass its fingerprint as `normalized` if it's known already.
+        """
+        ruleset, memo = self.state
+        self.queries += 1
+        if not ruleset.rules:
+            return query
+        if normalized is None:
+            normalized = fingerprint(query)
+        candidates = memo.get(normalized)
+        if candidates is None:
+            candidates = ruleset.candidates(normalized)
+            if len(memo) >= self.memo_size:
+                memo.clear()
+            memo[normalized] = candidates
+        else:
+            self.memo_hits += 1
+        if not candidates:
+            return query
+        original = query
+        for rule in candidates:
+            rewritten = rule.apply(query)
+            if rewritten is not None:
+                rule.applied += 1
+                query = rewritten
+        if query is not original:
+            self.rewritten += 1
+            _LOG.debug('Rewrote query: %s -> %s' % (original, query))
+        return query
+
+    def stats(self):
+        ruleset, memo = self.state
+        return {
+            'rules': len(ruleset.rules),
+            'queries': self.queries,
+            'rewritten': self.rewritten,
+            'memo_entries': len(memo),
+            'memo_hits': self.memo_hits,
+            }
+
+
+def load_rules(path):
+    """
+    RewriteRules from the JSON file at `path`
+    """
+    with open(path) as rules_file:
+        specs = json.load(rules_file)
+    if not isinstance(specs, list):
+        raise RewriteRuleError('%s should hold a list of rules' % path)
+    return [RewriteRule.from_dict(spec) for spec in specs]
@@ -6,12 +6,23 @@ from mysqlproxy.packet import OKPacket, ERRPacket, Packet, \
         IncomingPacketChain
 from mysqlproxy.types import *
 from mysqlproxy import capabilities, cli_commands, status_flags
-from mysqlproxy.query_response import ResultSetText
+from mysqlproxy.query_response import ResultSetText, StreamingResultSetText, \
+        MultiResultResponse, UTF8_CHARSET_ID
+from mysqlproxy.flow_control import OutputBuffer, ClientWriteTimeout
 from mysqlproxy import column_types, error_codes as errs
 from mysqlproxy.plugin import PluginRegistry
 from mysqlproxy.forward_auth import ForwardAuthConnection
-from mysqlproxy.client import ProxyConnection
-from mysqlproxy.charset import CHARSETS_BY_NAME
+from mysqlproxy.client import ProxyConnection, StreamingCursor
+from mysqlproxy.pool import PoolTimeout
+from mysqlproxy.charset import CHARSETS_BY_NAME, CODECS, BINARY_CHARSET_ID, \
+        charset_name
+from mysqlproxy.multiplex import SessionState, at_transaction_boundary
+from mysqlproxy.registry import default_registry
+from mysqlproxy.audit import STATUS_NO_RESPONSE
+from mysqlproxy.tls import TLSError, SSL_REQUEST_LENGTH
+from mysqlproxy import local_infile
+from mysqlproxy.hedge import is_read_only
+from mysqlproxy.backend_group import NoHealthyBackend
 from random import randint
 from hashlib import sha1
 import pymysql
@@ -20,6 +31,9 @@ from pymysql.err import ProgrammingError, \
 import logging
 import traceback
 import threading
+import select
+import socket
+import time
 
 _LOG = logging.getLogger(__name__)
 
@@ -32,10 +46,23 @@ SERVER_INCAPABILITIES = capabilities.COMPRESS \
 # stuff that we will always support transparently
 PERMANENT_SERVER_CAPABILITIES = capabilities.PROTOCOL_41 \
     | capabilities.SECURE_CONNECTION \
+    | capabilities.MULTI_STATEMENTS \
+    | capabilities.MULTI_RESULTS
 
 PERMANENT_STATUS_FLAGS = status_flags.STATUS_AUTOCOMMIT
 
 
+def backend_charset(charset_id):
+    """
+    Charset to talk to the backend in for a client that asked
+    for `charset_id`: the same one, unless we can't decode it
+    """
+    charset = charset_name(charset_id)
+    if not CODECS[charset_id & 0xff] or charset not in CHARSETS_BY_NAME:
+        return 'utf8'
+    return charset
+
+
 def generate_nonce(nsize=20):
     return ''.join([chr(randint(1, 255)) for _ in range(0, nsize)])
 
@@ -138,31 +165,339 @@ class SQLProxy(object):
         self.passwd = passwd
         self.charset_id = 0
         unix_socket = kwargs.pop('socket', None)
+        self.unix_socket = unix_socket
         self.forward_auth = kwargs.pop('forward_auth', False)
+        # shared PreconnectPool of greeted backend connections for forward auth
+        self.preconnect = kwargs.pop('preconnect', None)
+        # shared BackendGroup picking a healthy backend to connect to,
+        # in place of host/port/socket
+        self.backend_group = kwargs.pop('backend_group', None)
+        # shared TenantRouter picking the backend group by default
+        # schema, see route_schema()
+        self.tenant_router = kwargs.pop('tenant_router', None)
+        if self.tenant_router is not None and self.backend_group is None:
+            self.backend_group = self.tenant_router.default
+        # shared BackendPool for multiplexing sessions over backend connections
+        self.pool = kwargs.pop('pool', None)
+        # shared FieldListCache for COM_FIELD_LIST responses
+        self.field_list_cache = kwargs.pop('field_list_cache', None)
+        # shared ColumnBlockCache of serialized result set metadata
+        self.column_block_cache = kwargs.pop('column_block_cache', None)
+        # shared QueryRewriter applied to every COM_QUERY
+        self.rewriter = kwargs.pop('rewriter', None)
+        # shared AdmissionController limiting queries and handshakes
+        self.admission = kwargs.pop('admission', None)
+        # shared SamplingProfiler, driven by PROXY PROFILE commands
+        self.profiler = kwargs.pop('profiler', None)
+        # shared SlowQueryLog
+        self.slow_log = kwargs.pop('slow_log', None)
+        # shared AuditLog every client command is recorded in
+        self.audit_log = kwargs.pop('audit_log', None)
+        # shared TrafficCapture recording client commands for replay
+        self.capture = kwargs.pop('capture', None)
+        # shared LocalInfileStats for LOAD DATA LOCAL INFILE throughput
+        self.local_infile_stats = kwargs.pop('local_infile_stats', None)
+        # shared TLSTerminator, clients may ask for TLS if set
+        self.tls = kwargs.pop('tls', None)
+        # bytes of rows a buffered result holds in memory before
+        # spilling the rest to a temp file in spill_dir (None to never)
+        self.spill_threshold = kwargs.pop('spill_threshold', None)
+        self.spill_dir = kwargs.pop('spill_dir', None)
+        # shared HedgePolicy, read-only queries get hedged across
+        # the backend group if set
+        self.hedge = kwargs.pop('hedge', None)
+        # users allowed to run PROXY commands, None for everyone
+        self.admin_users = kwargs.pop('admin_users', None)
+        self.state = SessionState()
+        # shared TimerWheel driving the timeouts below (seconds, None for none)
+        self.timer_wheel = kwargs.pop('timer_wheel', None)
+        self.handshake_timeout = kwargs.pop('handshake_timeout', None)
+        self.idle_timeout = kwargs.pop('idle_timeout', None)
+        self.query_timeout = kwargs.pop('query_timeout', None)
+        self.query_timer = None
+        self.query_seq = 0
+        # seconds the last query took to get its first response
+        self.backend_time = None
+        # True from sending a query until its response is fully read
+        self.in_query = False
+        # cursor of the query being streamed, if any
+        self.cursor = None
         if self.forward_auth:
             connection_class = ForwardAuthConnection
         else:
             connection_class = ProxyConnection
-        if unix_socket:
-            self.client_conn = connection_class(unix_socket=unix_socket, user=user, passwd=passwd)
+        if self.tenant_router is not None and (self.forward_auth or self.pool is not None):
+            raise ValueError('tenant routing cannot be used with forward auth or '
+                'a shared backend pool')
+        if self.pool is not None:
+            if self.forward_auth:
+                raise ValueError('forward auth cannot be used with a shared backend pool')
+            # checked out per transaction, see backend()
+            self.client_conn = None
+            backend_capabilities = self.pool.server_capabilities
+        elif self.forward_auth and self.preconnect is not None:
+            self.client_conn = self.preconnect.get()
+            backend_capabilities = self.client_conn.server_capabilities
+        elif self.backend_group is not None:
+            # in the group's own connection class, unless forwarding auth
+            self.client_conn = self.backend_group.connect(
+                connection_class if self.forward_auth else None, user=user, passwd=passwd)
+            backend_capabilities = self.client_conn.server_capabilities
         else:
-            self.client_conn = connection_class(self.host, port=port, user=user, passwd=passwd)
+            if unix_socket:
+                self.client_conn = connection_class(unix_socket=unix_socket, user=user, passwd=passwd)
+            else:
+                self.client_conn = connection_class(self.host, port=port, user=user, passwd=passwd)
+            backend_capabilities = self.client_conn.server_capabilities
         if not self.forward_auth:
             # static user:passwd combo to access the proxy
             self.client_user = kwargs['client_user']
             self.client_passwd = kwargs['client_passwd']
-        self.session = Session(client_fd, self, 
-            (self.client_conn.server_capabilities | PERMANENT_SERVER_CAPABILITIES) \
-                & (0xffffffff ^ SERVER_INCAPABILITIES))
+        # shared MemoryBudget accounting for buffered output
+        self.memory_budget = kwargs.pop('memory_budget', None)
+        client_socket = kwargs.pop('client_socket', None)
+        output_buffer = OutputBuffer(client_fd,
+            high_watermark=kwargs.pop('output_high_watermark', 1<<20),
+            low_watermark=kwargs.pop('output_low_watermark', 1<<18),
+            write_timeout=kwargs.pop('write_timeout', None),
+            sock=client_socket,
+            budget=self.memory_budget)
+        server_capabilities = (backend_capabilities | PERMANENT_SERVER_CAPABILITIES) \
+            & (0xffffffff ^ SERVER_INCAPABILITIES)
+        if self.tls is not None:
+            # terminated here, whatever the backend supports
+            server_capabilities |= capabilities.SSL
+        self.session = Session(client_fd, self, server_capabilities,
+            output_buffer=output_buffer,
+            sock=client_socket)
         self.plugins = PluginRegistry()
+        # shared SessionRegistry handing out connection ids, see start()
+        self.registry = kwargs.pop('registry', None) or default_registry
+        self.connection_id = None
+
+    def backend(self):
+        """
+        Backend connection to run the current command on.
+        When multiplexing, one is checked out of the pool
+        and brought up to date with the session's state.
+        """
+        if self.client_conn is None:
+            conn = self.pool.acquire()
+            try:
+                self.bring_up_to_date(conn, self.state.default_db,
+                    self.state.charset or 'utf8')
+            except:
+                self.pool.discard(conn)
+                raise
+            self.client_conn = conn
+        conn = self.client_conn
+        if conn.multi_statements != self.state.multi_statements:
+            conn.set_multi_statements(self.state.multi_statements)
+        return conn
+
+    def bring_up_to_date(self, conn, db, charset):
+        """
+        Switch a connection that's new to this session to
+        database `db` and character set `charset`
+        """
+        # there's no way to deselect a database, so sessions without
+        # a default db may inherit whatever the last user selected
+        if db and conn.current_db != db:
+            conn.select_db(db)
+        if conn.character_set_name() != charset:
+            conn.set_charset(charset)
+        if conn.multi_statements != self.state.multi_statements:
+            conn.set_multi_statements(self.state.multi_statements)
+
+    def route_schema(self, db):
+        """
+        With tenant routing, move the session to the backend
+        group serving schema `db` if it's on another one, over a
+        new connection that has `db` selected.  Returns None, or
+        ERR if the session can't move.
+        """
+        if self.tenant_router is None:
+            return None
+        group = self.tenant_router.route(db)
+        if group is self.backend_group:
+            return None
+        caps = self.session.client_capabilities
+        conn = self.client_conn
+        if self.state.pinned or conn.server_status & status_flags.STATUS_IN_TRANS:
+            # a transaction or pinned state can't come along
+            return ERRPacket(caps, error_code=errs.CANT_DO_THIS_DURING_AN_TRANSACTION,
+                error_msg=u'Schema %s is on another cluster, it cannot be switched to '
+                    u'inside a transaction or with session state (%s)'
+                    % (db, self.state.pinned_reason or u'transaction'), seq_id=1)
+        try:
+            new_conn = group.connect(user=self.user, passwd=self.passwd,
+                autocommit=bool(conn.server_status & status_flags.STATUS_AUTOCOMMIT))
+        except NoHealthyBackend as ex:
+            return ERRPacket(caps, error_code=errs.CONN_HOST_ERROR,
+                error_msg=u'Cannot reach the cluster of schema %s: %s' % (db, ex), seq_id=1)
+        try:
+            self.bring_up_to_date(new_conn, db, self.state.charset or conn.character_set_name())
+        except (OperationalError, InternalError) as ex:
+            new_conn.close()
+            err_code, err_msg = ex
+            return ERRPacket(caps, error_code=err_code, error_msg=err_msg, seq_id=1)
+        _LOG.debug('Schema %s moves the session to %s' % (db, new_conn.backend.name))
+        self.finish_cursor()
+        self.client_conn = new_conn
+        self.backend_group = group
+        self.tenant_router.switches += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return None
+
+    def set_timer(self, delay, callback, *args):
+        """
+        Schedule callback(*args) on the shared timer wheel,
+        if there is one and `delay` is set
+        """
+        if self.timer_wheel is None or not delay:
+            return None
+        return self.timer_wheel.schedule(delay, callback, *args)
+
+    def clear_timer(self, timer):
+        if timer is not None:
+            self.timer_wheel.cancel(timer)
+
+    def connect_side_channel(self, conn=None):
+        """
+        Fresh backend connection for out-of-band work like
+        killing queries, to the same backend as `conn` if
+        given.  Not pooled, close it when done.
+        """
+        backend = getattr(conn, 'backend', None)
+        if backend is not None and self.backend_group is not None:
+            return backend.connect(self.backend_group.connection_class,
+                user=self.user, passwd=self.passwd)
+        if self.backend_group is not None:
+            return self.backend_group.connect(user=self.user, passwd=self.passwd)
+        if self.unix_socket:
+            return ProxyConnection(unix_socket=self.unix_socket,
+                user=self.user, passwd=self.passwd)
+        return ProxyConnection(self.host, port=self.port,
+            user=self.user, passwd=self.passwd)
+
+    def backend_thread_id(self):
+        """
+        Backend thread id of the connection this session
+        currently holds, None if it holds none
+        """
+        conn = self.client_conn
+        if conn is None or conn.socket is None:
+            return None
+        return conn.thread_id()
+
+    def cancel_backend_query(self):
+        """
+        KILL QUERY whatever the current backend connection is
+        running, if anything.  Connecting takes a while, so it's
+        done on a thread of its own and this returns right away.
+        """
+        conn = self.client_conn
+        if conn is None or not self.in_query:
+            return
+        killer = threading.Thread(target=self._kill_backend_query,
+            args=(conn, self.query_seq))
+        killer.daemon = True
+        killer.start()
+
+    def _kill_backend_query(self, conn, query_seq):
+        try:
+            side_conn = self.connect_side_channel(conn)
+            try:
+                # the query may have finished and the connection moved
+                # on to someone else's query while we were connecting
+                if self.client_conn is conn and self.query_seq == query_seq \
+                        and self.in_query:
+                    side_conn.kill_query(conn.thread_id())
+            finally:
+                side_conn.close()
+        except Exception as ex:
+            _LOG.warning('Could not cancel backend query: %s' % ex)
+
+    def abandon_query(self):
+        """
+        The client went away mid-query.  Stop the backend before
+        the rest of the result gets drained, rather than reading
+        it all just to throw it away.
+        """
+        if self.in_query and self.client_conn is not None:
+            self._kill_backend_query(self.client_conn, self.query_seq)
+
+    def on_query_timeout(self):
+        _LOG.warning('Query exceeded %.1fs, cancelling it' % self.query_timeout)
+        self.cancel_backend_query()
+
+    def end_command(self):
+        """
+        Called after every client command.  When multiplexing,
+        the backend connection goes back to the pool if the
+        session is at a transaction boundary, isn't pinned and
+        didn't just write.
+        """
+        if self.query_timer is not None:
+            self.clear_timer(self.query_timer)
+            self.query_timer = None
+        self.finish_cursor()
+        self.in_query = False
+        conn = self.client_conn
+        if self.pool is None or conn is None:
+            return
+        if conn.socket is None:
+            self.client_conn = None
+            self.pool.discard(conn)
+        elif not self.state.pinned and not self.state.held \
+                and at_transaction_boundary(conn.server_status):
+            self.client_conn = None
+            self.pool.release(conn)
+
+    def finish_cursor(self):
+        """
+        Read and drop whatever results of the last query the
+        client didn't take, so the connection's ready for the next
+        """
+        cursor = self.cursor
+        self.cursor = None
+        if cursor is None or cursor.connection is None:
+            return
+        try:
+            cursor.close()
+        except (InternalError, OperationalError, ProgrammingError) as ex:
+            _LOG.debug('Error draining results: %s' % ex)
+
+    def close_backend(self):
+        self.finish_cursor()
+        self.in_query = False
+        conn = self.client_conn
+        self.client_conn = None
+        if conn is None:
+            return
+        if self.pool is None:
+            conn.close()
+        elif conn.socket is not None and not self.state.pinned \
+                and at_transaction_boundary(conn.server_status):
+            self.pool.release(conn)
+        else:
+            # whatever state it holds can't be handed to anybody else
+            self.pool.discard(conn)
 
     def change_db(self, dbname):
         """
         Changes default database
         Returns OK or ERR
         """
+        error = self.route_schema(dbname)
+        if error is not None:
+            return error
         try:
-            self.client_conn.select_db(dbname)
+            self.backend().select_db(dbname)
+            self.state.default_db = dbname
             return OKPacket(self.session.client_capabilities,
                 0, 0, seq_id=1)
         except (OperationalError, InternalError) as ex:
@@ -170,40 +505,409 @@ class SQLProxy(object):
             return ERRPacket(self.session.client_capabilities,
                 error_code=err_code, error_msg=err_msg, seq_id=1)
 
+    def change_user(self, username, auth_response, db=None, charset_id=None):
+        """
+        COM_CHANGE_USER: log the client in again as `username`,
+        with the session state of a new connection but without
+        the cost of one.  Returns OK or ERR.
+        """
+        caps = self.session.client_capabilities
+        try:
+            if self.forward_auth:
+                # the backend resets itself while checking the password
+                self.finish_cursor()
+                self.in_query = False
+                self.client_conn.forward_change_user(username, auth_response,
+                    db, charset_id)
+            elif not self.session.check_password(username, auth_response,
+                    self.session.nonce):
+                return ERRPacket(caps, error_code=errs.ACCESS_DENIED,
+                    error_msg=u"Access denied for user '%s'" % username, seq_id=1)
+            else:
+                self.reset_backend()
+        except (OperationalError, InternalError) as ex:
+            err_code, err_msg = ex
+            return ERRPacket(caps, error_code=err_code, error_msg=err_msg, seq_id=1)
+        self.session.username = username
+        if charset_id:
+            self.session.charset_id = charset_id
+        return self.reset_state(db or None,
+            backend_charset(self.session.charset_id or UTF8_CHARSET_ID))
+
+    def reset_connection(self):
+        """
+        COM_RESET_CONNECTION: session state back to what it was
+        right after logging in, keeping the default database
+        """
+        try:
+            self.reset_backend()
+        except (OperationalError, InternalError) as ex:
+            err_code, err_msg = ex
+            return ERRPacket(self.session.client_capabilities,
+                error_code=err_code, error_msg=err_msg, seq_id=1)
+        return self.reset_state(self.state.default_db,
+            backend_charset(self.session.charset_id or UTF8_CHARSET_ID))
+
+    def reset_backend(self):
+        """
+        Get rid of whatever session state the backend holds
+        for us.  When multiplexing, a connection we hold on to
+        (pinned or mid-transaction) is thrown away and the next
+        command gets a clean one from the pool.
+        """
+        self.finish_cursor()
+        self.in_query = False
+        conn = self.client_conn
+        if self.pool is not None:
+            if conn is not None:
+                self.client_conn = None
+                self.pool.discard(conn)
+            return
+        try:
+            conn.reset_connection()
+        except pymysql.err.MySQLError as ex:
+            if self.forward_auth:
+                raise
+            # a server without COM_RESET_CONNECTION, a fresh
+            # connection is as reset as it gets
+            _LOG.debug('Backend could not reset connection (%s), reconnecting' % ex)
+            self.client_conn = self.connect_side_channel()
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def reset_state(self, db, charset):
+        """
+        Start over with a fresh SessionState using `db` and
+        `charset`, and bring the backend in line.  Returns OK
+        or ERR.
+        """
+        caps = self.session.client_capabilities
+        self.state = SessionState(db, charset)
+        self.state.multi_statements = bool(caps & capabilities.MULTI_STATEMENTS)
+        self.charset_id = CHARSETS_BY_NAME[charset][0]
+        try:
+            error = self.route_schema(db)
+            if error is not None:
+                self.state.default_db = None
+                return error
+            # when multiplexing, backend() does the syncing itself
+            conn = self.backend()
+            if self.pool is None:
+                if db and conn.current_db != db:
+                    conn.select_db(db)
+                if conn.character_set_name() != charset:
+                    conn.set_charset(charset)
+        except (OperationalError, InternalError) as ex:
+            self.state.default_db = None
+            err_code, err_msg = ex
+            return ERRPacket(caps, error_code=err_code, error_msg=err_msg, seq_id=1)
+        return OKPacket(caps, 0, 0, seq_id=1, status_flags=self.session.server_status)
+
+    def handshake(self):
+        """
+        Client handshake, unless there are too many going on already
+        """
+        if self.admission is None:
+            return self.session.do_handshake()
+        if not self.admission.begin_handshake():
+            ERRPacket(0, errs.CON_COUNT_ERROR, u'Too many connections',
+                seq_id=0).write_out(self.session.net_fd)
+            self.session.net_fd.flush()
+            return False
+        try:
+            return self.session.do_handshake()
+        finally:
+            self.admission.end_handshake()
+
     def start(self):
+        # registered here, next to unregistering, so a session
+        # that fails before it starts doesn't linger in the registry
+        self.connection_id = self.registry.register(self)
         try:
-            if self.session.do_handshake():
+            if self.handshake():
                 self.charset_id = \
-                    CHARSETS_BY_NAME[self.client_conn.character_set_name()][0]
+                    CHARSETS_BY_NAME[self.backend().character_set_name()][0]
+                self.end_command()
+                if self.capture is not None:
+                    self.session.capture = self.capture.open_session(self)
                 self.session.serve_forever()
         finally:
-            self.client_conn.close()
+            if self.session.capture is not None:
+                self.session.capture.close()
+            self.registry.unregister(self.connection_id)
+            self.session.out.discard()
+            self.close_backend()
 
-    def build_response_from_query(self, query):
+    def build_response_from_query(self, query, buffered=False, spill_threshold=None):
         """
         Do the actual query on the target MySQL host.
-        Returns a packet type of either OK, ERR, or a ResultSetText
+        Returns a packet type of either OK, ERR, or a ResultSetText.
+        With `buffered`, a result set comes back with all its rows
+        fetched (only the first result of a multi-statement query),
+        spilled to disk past `spill_threshold` bytes, or the proxy's
+        threshold if None.
         """
-        cursor = self.client_conn.cursor()
-        num_rows = cursor.execute(query)
-        results = cursor.fetchall()
-        if not results or len(results) == 0:
-            cursor.close()
+        if self.memory_budget is not None and self.memory_budget.exceeded:
+            # we can't tell how big a result will be up front, so
+            # nothing new goes to the backend until buffers drain
+            self.memory_budget.reject()
+            return ERRPacket(self.session.client_capabilities,
+                error_code=errs.OUT_OF_RESOURCES,
+                error_msg=u'Proxy memory budget exceeded, try again later',
+                seq_id=1)
+        prev_charset = self.state.charset
+        prev_db = self.state.default_db
+        self.state.observe_query(query)
+        if self.state.default_db != prev_db:
+            # USE may take the session to another cluster
+            error = self.route_schema(self.state.default_db)
+            if error is not None:
+                self.state.default_db = prev_db
+                return error
+        if self.state.charset != prev_charset and self.state.charset in CHARSETS_BY_NAME:
+            # SET NAMES switches both ends of the conversation
+            self.charset_id = self.session.charset_id = \
+                CHARSETS_BY_NAME[self.state.charset][0]
+        ddl = self.field_list_cache is not None \
+            and self.field_list_cache.observe_query(self.state.default_db, query)
+        # unbuffered, rows are read off the backend as the client takes them
+        conn = self.backend()
+        cursor = self.cursor = conn.cursor(StreamingCursor)
+        self.query_seq += 1
+        self.in_query = True
+        # runs until the last row went out, see end_command()
+        self.query_timer = self.set_timer(self.query_timeout, self.on_query_timeout)
+        # response times feed the backend group's load balancing
+        backend = getattr(conn, 'backend', None) if self.backend_group is not None else None
+        if backend is not None:
+            self.backend_group.begin(backend)
+        hedgeable = self.hedge is not None and self.may_hedge(conn, query)
+        started = time.time()
+        self.backend_time = None
+        elapsed = None
+        try:
+            if hedgeable:
+                cursor = self.cursor = self.execute_hedged(cursor, query)
+            else:
+                cursor.execute(query)
+            elapsed = time.time() - started
+        finally:
+            if backend is not None:
+                self.backend_group.observe(backend, elapsed)
+            if ddl:
+                # again, a COM_FIELD_LIST may have cached the old
+                # columns while the DDL ran
+                self.field_list_cache.observe_query(self.state.default_db, query)
+        if self.hedge is not None:
+            self.hedge.observe(elapsed if hedgeable else None)
+        seq_id = 1
+        if getattr(cursor._result, 'local_infile', None) is not None:
+            seq_id, error = self.relay_local_infile(cursor)
+            if error is not None:
+                return error
+        self.backend_time = time.time() - started
+        if buffered:
+            response = self.response_from_cursor(cursor, multi_results=False)
+            if isinstance(response, StreamingResultSetText):
+                response = response.materialize(
+                    spill_threshold if spill_threshold is not None else self.spill_threshold,
+                    self.spill_dir)
+            response.seq_id = seq_id
+            return response
+        if self.session.client_capabilities & capabilities.MULTI_RESULTS:
+            return MultiResultResponse(self.iter_results(cursor), seq_id=seq_id)
+        # anything past the first result is dropped in end_command()
+        response = self.response_from_cursor(cursor, multi_results=False)
+        response.seq_id = seq_id
+        return response
+
+    def may_hedge(self, conn, query):
+        """
+        True if `query` may also be sent to a second backend
+        """
+        return not self.forward_auth \
+            and getattr(conn, 'backend', None) is not None \
+            and len(self.backend_group.healthy()) > 1 \
+            and not self.state.pinned \
+            and at_transaction_boundary(conn.server_status) \
+            and is_read_only(query)
+
+    def execute_hedged(self, cursor, query):
+        """
+        Execute `query`, sending it to a second backend as
+        well if the first is slow to respond.  Returns the
+        cursor of whichever responded first, which the session
+        carries on with.
+        """
+        conn = cursor.connection
+        cursor.send_query(query)
+        delay = self.hedge.delay()
+        if delay is None or select.select([conn.socket], [], [], delay)[0] \
+                or not self.hedge.allow():
+            cursor.read_response()
+            return cursor
+        hedge_conn = self.connect_hedge(conn)
+        if hedge_conn is None:
+            self.hedge.count_unavailable()
+            cursor.read_response()
+            return cursor
+        hedge_cursor = hedge_conn.cursor(StreamingCursor)
+        try:
+            hedge_cursor.send_query(query)
+        except Exception as ex:
+            _LOG.debug('Could not send hedge to %s: %s' % (hedge_conn.backend.name, ex))
+            self.drop_hedge_loser(hedge_conn)
+            cursor.read_response()
+            return cursor
+        self.hedge.fire()
+        readable = select.select([conn.socket, hedge_conn.socket], [], [])[0]
+        if conn.socket in readable:
+            self.drop_hedge_loser(hedge_conn)
+            cursor.read_response()
+            return cursor
+        self.hedge.count_won()
+        self.client_conn = hedge_conn
+        self.drop_hedge_loser(conn)
+        hedge_cursor.read_response()
+        return hedge_cursor
+
+    def connect_hedge(self, conn):
+        """
+        Connection to a backend other than that of `conn`,
+        set up like it, None if there's none to be had.  If it
+        wins, it takes the place of `conn`, in the pool too.
+        """
+        try:
+            # only hedged outside of transactions, i.e. with autocommit on
+            hedge_conn = self.backend_group.connect(exclude=conn.backend,
+                user=self.user, passwd=self.passwd, autocommit=True)
+        except Exception as ex:
+            _LOG.debug('No backend to hedge with: %s' % ex)
+            return None
+        try:
+            self.bring_up_to_date(hedge_conn, self.state.default_db or conn.current_db,
+                conn.character_set_name())
+        except Exception as ex:
+            _LOG.debug('Could not set up hedge connection: %s' % ex)
+            self.drop_hedge_loser(hedge_conn, running=False)
+            return None
+        return hedge_conn
+
+    def drop_hedge_loser(self, conn, running=True):
+        """
+        KILL QUERY the losing side of a hedge, if `running`, and
+        close its connection, on a thread of its own.  A pooled
+        connection's place in the pool went to the winner.
+        """
+        def drop():
+            if running:
+                try:
+                    side_conn = self.connect_side_channel(conn)
+                    try:
+                        side_conn.kill_query(conn.thread_id())
+                    finally:
+                        side_conn.close()
+                except Exception as ex:
+                    _LOG.debug('Could not cancel hedged query: %s' % ex)
+            try:
+                conn.close()
+            except Exception:
+                pass
+        dropper = threading.Thread(target=drop)
+        dropper.daemon = True
+        dropper.start()
+
+    def relay_local_infile(self, cursor):
+        """
+        Stream the file a LOAD DATA LOCAL INFILE query asked for
+        from the client to the backend and read the result.
+        Returns the sequence id the response goes out with and
+        an ERR to send instead, if any.
+        """
+        conn = cursor._get_db()
+        filename = cursor._result.local_infile
+        began = time.time()
+        try:
+            seq_id, nbytes = local_infile.relay(self.session, conn, filename, self.plugins)
+        except local_infile.LocalInfileRefused as ex:
+            if self.local_infile_stats is not None:
+                self.local_infile_stats.count_refused()
+            return 1, ERRPacket(self.session.client_capabilities,
+                error_code=errs.NOT_ALLOWED_COMMAND, error_msg=u'%s' % ex, seq_id=1)
+        try:
+            conn._read_query_result(unbuffered=True)
+        except (InternalError, OperationalError, ProgrammingError) as ex:
+            err_code, err_msg = ex
+            return seq_id, ERRPacket(self.session.client_capabilities,
+                error_code=err_code, error_msg=err_msg, seq_id=seq_id)
+        finally:
+            elapsed = time.time() - began
+            _LOG.info('LOAD DATA LOCAL INFILE %s: %d bytes in %.2fs (%.0f bytes/s)' % \
+                (filename, nbytes, elapsed, nbytes / elapsed if elapsed else 0))
+            if self.local_infile_stats is not None:
+                self.local_infile_stats.add(nbytes, elapsed)
+        cursor._do_get_result()
+        return seq_id, None
+
+    def iter_results(self, cursor):
+        """
+        Response for each result of the query `cursor` ran.
+        The backend is only read from as each one gets sent.
+        """
+        while True:
+            yield self.response_from_cursor(cursor)
+            try:
+                if not cursor.nextset():
+                    return
+            except (InternalError, OperationalError, ProgrammingError) as ex:
+                # a failing statement ends the batch
+                err_code, err_msg = ex
+                yield ERRPacket(self.session.client_capabilities,
+                    error_code=err_code, error_msg=err_msg)
+                return
+
+    def response_from_cursor(self, cursor, multi_results=True):
+        """
+        OK or result set for the current result of `cursor`
+        """
+        if not cursor.description:
+            flags = self.session.server_status
+            if multi_results and cursor.has_more():
+                flags |= status_flags.MORE_RESULTS_EXISTS
             return OKPacket(self.session.client_capabilities,
-                affected_rows=num_rows,
+                affected_rows=cursor.rowcount,
                 last_insert_id=cursor.lastrowid,
+                status_flags=flags,
                 seq_id=1
                 )
         col_types = cursor.description
-        cursor.close()
-        response = ResultSetText(self.session.client_capabilities,
-            flags=self.session.server_status)
-        for colname, coltype, col_max_len, \
-                field_len, field_max_len, _, _ in col_types:
-            response.add_column(unicode(colname), coltype, field_len)
-        for row in results:
-            lvals = list(row)
-            response.add_row(lvals)
+        # the description doesn't say which columns are binary
+        col_charsets = tuple([field.charsetnr for field in cursor._result.fields])
+        client_charset_id = self.session.charset_id or UTF8_CHARSET_ID
+        response = StreamingResultSetText(self.session.client_capabilities,
+            cursor.fetchmany, flags=self.session.server_status,
+            has_more=cursor.has_more if multi_results else None)
+        response.charset_id = client_charset_id
+        response.backend_charset_id = self.charset_id
+        response.column_charsets = col_charsets
+        column_block = None
+        if self.column_block_cache is not None:
+            shape_key = (self.session.client_capabilities, client_charset_id,
+                col_types, col_charsets)
+            column_block = self.column_block_cache.get(shape_key)
+        if column_block is not None:
+            response.set_column_block(column_block)
+        else:
+            for (colname, coltype, col_max_len, field_len, field_max_len, _, _), \
+                    col_charset in zip(col_types, col_charsets):
+                if col_charset != BINARY_CHARSET_ID:
+                    col_charset = client_charset_id
+                response.add_column(unicode(colname), coltype, field_len,
+                    charset_code=col_charset)
+            if self.column_block_cache is not None:
+                self.column_block_cache.put(shape_key, response.build_column_block())
         return response
 
 
@@ -214,15 +918,27 @@ class Session(object):
     always act as a FIFO (a.k.a. if you're going through UDP,
     do your own packet mangling).
     """
-    def __init__(self, fde, proxy_obj, server_capabilities):
+    def __init__(self, fde, proxy_obj, server_capabilities, output_buffer=None, sock=None):
         self.net_fd = fde
+        # raw socket under fde, so timeouts can cut off blocked reads
+        self.sock = sock or getattr(fde, '_sock', None)
+        # everything sent after the handshake goes through here
+        self.out = output_buffer or OutputBuffer(fde)
         self.connected = True
         self.charset_id = 0
         self.default_db = None
         self.client_capabilities = 0
+        self.username = None
+        self.nonce = None
         self.server_capabilities = server_capabilities
         self.server_status = PERMANENT_STATUS_FLAGS
         self.proxy_obj = proxy_obj
+        # SessionCapture the commands read get recorded in, if any
+        self.capture = None
+        # SSLSocket once the client connection went over to TLS
+        self.tls_sock = None
+        # error code of the last response sent (0 for none), for the audit log
+        self.response_status = STATUS_NO_RESPONSE
 
     def send_payload(self, what):
         """
@@ -233,12 +949,13 @@ class Session(object):
         last_seq_id = 0
         if type(what) == list:
             for field in what:
-                more_bytes, last_seq_id = field.write_out(self.net_fd)
+                more_bytes, last_seq_id = field.write_out(self.out)
                 nbytes += more_bytes
         else:
-            more_bytes, last_seq_id = what.write_out(self.net_fd)
+            more_bytes, last_seq_id = what.write_out(self.out)
             nbytes += more_bytes
-        self.net_fd.flush()
+        self.out.flush()
+        self.response_status = getattr(what, 'error_code', 0)
         return (nbytes, last_seq_id)
 
     def serve_forever(self):
@@ -246,13 +963,16 @@ class Session(object):
         Client command loop
         """
         while self.connected:
-            cmd_packet = self.get_next_client_command()
+            idle_timer = self.proxy_obj.set_timer(self.proxy_obj.idle_timeout,
+                self.abort, 'idle for more than %ss' % self.proxy_obj.idle_timeout)
+            try:
+                cmd_packet = self.get_next_client_command()
+            finally:
+                self.proxy_obj.clear_timer(idle_timer)
+            self.response_status = STATUS_NO_RESPONSE
             try:
                 if not cli_commands.handle_client_command(self, cmd_packet):
-                    try:
-                        self.net_fd.close()
-                    except:
-                        pass
+                    self.close()
                     self.connected = False
             except (InternalError, OperationalError, 
                     ProgrammingError) as ex:
@@ -260,7 +980,24 @@ class Session(object):
                 self.send_payload(ERRPacket(self.client_capabilities,
                     9999, u'Error occured during operation: %s' % ex,
                     seq_id=1))
-            
+            except PoolTimeout as ex:
+                self.send_payload(ERRPacket(self.client_capabilities,
+                    errs.CON_COUNT_ERROR, u'%s' % ex, seq_id=1))
+            except ClientWriteTimeout as ex:
+                _LOG.warning('Dropping slow client: %s' % ex)
+                self.proxy_obj.abandon_query()
+                self.disconnect()
+            except socket.error as ex:
+                _LOG.info('Client went away: %s' % ex)
+                self.proxy_obj.abandon_query()
+                self.disconnect()
+            finally:
+                self.proxy_obj.end_command()
+                if self.proxy_obj.audit_log is not None and cmd_packet:
+                    self.proxy_obj.audit_log.record(self.proxy_obj.connection_id,
+                        self.username, ord(cmd_packet[0]), cmd_packet[1:],
+                        self.response_status)
+
     def get_next_client_command(self):
         """
         Read next packet in.  This should only
@@ -269,7 +1006,10 @@ class Session(object):
         """
         ipc = IncomingPacketChain()
         ipc.read_in(self.net_fd)
-        return ipc.payload.read()
+        payload = ipc.payload.read()
+        if self.capture is not None:
+            self.capture.record(ipc.seq_id, payload)
+        return payload
 
     def _init_and_authenticate(self, nonce, response):
         """
@@ -278,8 +1018,11 @@ class Session(object):
         cap_flags = response.get_field('client_capabilities').val
         self.client_capabilities = cap_flags
         username = response.get_field('username').val
+        self.username = username
         auth_response = response.get_field('auth_response').val
         self.charset_id = response.get_field('charset').val
+        self.proxy_obj.state.multi_statements = \
+            bool(cap_flags & capabilities.MULTI_STATEMENTS)
 
         if self.proxy_obj.forward_auth:
             if not auth_response:
@@ -310,11 +1053,18 @@ class Session(object):
         except:
             pass
 
+        return True, self.check_password(username, auth_response, nonce), cap_flags
+
+    def check_password(self, username, auth_response, nonce):
+        """
+        Whether mysql_native_password `auth_response` to
+        `nonce` is right for `username`
+        """
         valid_users = {
             self.proxy_obj.client_user: self.proxy_obj.client_passwd
             }
         if username not in valid_users:
-            return True, False, cap_flags
+            return False
 
         if auth_response:
             passwd_sha = sha1(valid_users[username]).digest()
@@ -326,8 +1076,8 @@ class Session(object):
             if valid_users[username] in (None, ''):
                 expected_auth_response = auth_response
             else:
-                return True, False, cap_flags
-        return True, expected_auth_response == auth_response, cap_flags
+                return False
+        return expected_auth_response == auth_response
 
     def do_handshake(self):
         """
@@ -339,36 +1089,65 @@ class Session(object):
                 nonce = self.proxy_obj.client_conn.salt
             else:
                 nonce = generate_nonce()
+            # COM_CHANGE_USER auth responses are computed from it too
+            self.nonce = nonce
             handshake_pkt = HandshakeV10(self.server_capabilities | PERMANENT_SERVER_CAPABILITIES, nonce,
-                self.server_status, seq_id=0)
-            handshake_pkt.write_out(self.net_fd)
-            last_seq_id += 2
-            self.net_fd.flush()
-            response = HandshakeResponse()
-            # TODO: SSL / Compression
-            response.read_in(self.net_fd)
+                self.server_status, seq_id=0, connection_id=self.proxy_obj.connection_id)
+            handshake_timer = self.proxy_obj.set_timer(self.proxy_obj.handshake_timeout,
+                self.abort, 'no handshake response within %ss' % self.proxy_obj.handshake_timeout)
+            try:
+                # in one write, some clients (openssl s_client) expect
+                # the greeting in a single read before starting TLS
+                handshake_pkt.write_out(self.out)
+                last_seq_id += 2
+                self.out.flush()
+                response = self.read_handshake_response()
+            finally:
+                self.proxy_obj.clear_timer(handshake_timer)
+            if response is None:
+                return False
+            last_seq_id = response.seq_id + 1
             _LOG.debug('response seq id: %d' % response.seq_id) # it better be 1
             success, authenticated, client_caps = self._init_and_authenticate(nonce, response)
             if success:
+                resp_pkt = None
                 if authenticated:
                     try:
                         db_name = response.get_field('db_name').val
-                        self.proxy_obj.client_conn.select_db(db_name)
                     except ValueError:
-                        pass
-                    self.proxy_obj.client_conn.set_charset('utf8')
+                        db_name = None
+                    resp_pkt = self.proxy_obj.route_schema(db_name)
+                    if resp_pkt is not None:
+                        authenticated = False
+                if authenticated:
+                    backend = self.proxy_obj.backend()
+                    if db_name is not None:
+                        backend.select_db(db_name)
+                        self.proxy_obj.state.default_db = db_name
+                    # talk to the backend in whatever the client asked
+                    # for so rows don't need transcoding on the way back
+                    charset = backend_charset(self.charset_id)
+                    try:
+                        backend.set_charset(charset)
+                    except (AttributeError, InternalError, OperationalError):
+                        _LOG.warning('backend refused charset %s, using utf8' % charset)
+                        charset = 'utf8'
+                        backend.set_charset(charset)
+                    self.proxy_obj.state.charset = charset
                     resp_pkt = OKPacket(client_caps,
                         affected_rows=0,
                         last_insert_id=0,
                         status_flags=self.server_status,
                         seq_id=2)
-                else:
+                elif resp_pkt is None:
                     resp_pkt = ERRPacket(client_caps,
                         error_code=errs.ACCESS_DENIED,
                         error_msg='Access denied',
                         seq_id=2)
             else:
                 resp_pkt = client_caps
+            # one further along if the client went through an SSL request
+            resp_pkt.seq_id = response.seq_id + 1
             resp_pkt.write_out(self.net_fd)
             self.net_fd.flush()
             return authenticated
@@ -378,6 +1157,78 @@ class Session(object):
                 seq_id=last_seq_id).write_out(self.net_fd)
             return False
         
+    def read_handshake_response(self):
+        """
+        Read the client's HandshakeResponse, switching to TLS
+        first if it starts with an SSL request.  None if the
+        client was turned away.
+        """
+        tls = self.proxy_obj.tls
+        ipc = IncomingPacketChain()
+        ipc.read_in(self.net_fd)
+        if tls is not None:
+            ssl_requested = False
+            if ipc.total_length == SSL_REQUEST_LENGTH:
+                client_caps = FixedLengthInteger(4, 0)
+                client_caps.read_in(ipc.payload, label=None)
+                ssl_requested = bool(client_caps.val & capabilities.SSL)
+                ipc.payload.seek(0)
+            if ssl_requested:
+                try:
+                    self.start_tls(tls)
+                except TLSError as ex:
+                    _LOG.info('Client failed to start TLS: %s' % ex)
+                    return None
+                ipc = IncomingPacketChain()
+                ipc.read_in(self.net_fd)
+            elif tls.required:
+                ERRPacket(0, errs.INSECURE_TRANSPORT,
+                    'Connections using insecure transport are prohibited',
+                    seq_id=ipc.seq_id + 1).write_out(self.net_fd)
+                self.net_fd.flush()
+                return None
+        response = HandshakeResponse()
+        response.seq_id = ipc.seq_id
+        response.read_in_internal(ipc.payload, ipc.total_length)
+        return response
+
+    def start_tls(self, tls):
+        """
+        Wrap the client connection in TLS.  self.sock stays the
+        raw socket, which abort() and write timeouts still work on.
+        """
+        if self.sock is None:
+            raise TLSError('no socket to run TLS over')
+        self.tls_sock = tls.wrap(self.sock)
+        self.net_fd = self.tls_sock.makefile('r+b', bufsize=0)
+        self.out.net_fd = self.net_fd
+
+    def close(self):
+        """
+        Close the client connection, ending TLS properly
+        first so the client can resume its session
+        """
+        if self.tls_sock is not None:
+            self.proxy_obj.tls.shutdown(self.tls_sock)
+        try:
+            self.net_fd.close()
+        except socket.error:
+            pass
+
+    def abort(self, reason):
+        """
+        Cut the client off from another thread, e.g. on a timeout.
+        Whatever read the session thread is blocked on fails.
+        """
+        _LOG.info('Disconnecting client: %s' % reason)
+        self.connected = False
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
     def disconnect(self):
-        self.net_fd.close()
+        self.out.discard()
+        self.close()
         self.connected = False
@@ -0,0 +1,162 @@
+"""
+Slow query log.
+
+Queries taking `threshold` seconds or more are written out one
+JSON object per line:
+
+    {"time": 1700000000.123, "user": "app", "db": "shop",
+     "fingerprint": "select * from t where id = ?", "query": "SELECT * ...",
+     "rows": 1, "bytes": 97, "backend_time": 0.0012, "total_time": 1.52,
+     "sampled": false}
+
+`backend_time` is the time until the backend's first response,
+`total_time` until the last byte was handed to the client.  With
+`sample_every` set to N, every Nth query is logged as well whatever
+its time (and flagged `sampled`).
+
+Sessions only put entries on a bounded queue, a writer thread
+formats them and writes them out in batches, so a slow disk never
+holds up a query.  When the queue is full entries are dropped and
+counted rather than waited on.
+"""
+from mysqlproxy.fingerprint import fingerprint
+import itertools
+import threading
+import logging
+import Queue
+import json
+import time
+
+_LOG = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class SlowQueryLog(object):
+    """
+    Shared by all sessions.  Call start() before logging
+    and close() to flush what's queued on shutdown.
+    """
+    def __init__(self, path, threshold=1.0, sample_every=0, max_queue=10000,
+            batch_size=256, max_query_length=4096):
+        self.path = path
+        self.threshold = threshold
+        self.sample_every = sample_every
+        self.batch_size = batch_size
+        self.max_query_length = max_query_length
+        self.queue = Queue.Queue(max_queue)
+        self.seen = itertools.count(1)
+        self.thread = None
+        self.logged = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.write_errors = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='slowlog')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        if self.thread is None:
+            return
+        # waits for room, unlike log(); everything before it gets written
+        self.queue.put(_STOP)
+        self.thread.join()
+        self.thread = None
+
+    def log(self, query, total_time, backend_time=None, rows=0, nbytes=0,
+            user=None, db=None, normalized=None):
+        """
+        Log the query if it was slow or is sampled, never
+        blocking.  Returns True if it was queued.
+        """
+        sampled = False
+        if total_time < self.threshold:
+            # itertools.count is safe to share between threads
+            if not self.sample_every or next(self.seen) % self.sample_every:
+                return False
+            sampled = True
+        try:
+            # fingerprinting and formatting are left to the writer thread
+            self.queue.put_nowait((time.time(), query[:self.max_query_length], normalized,
+                user, db, rows, nbytes, backend_time, total_time, sampled))
+        except Queue.Full:
+            self.dropped += 1
+            return False
+        self.logged += 1
+        return True
+
+    @staticmethod
+    def format_entry(entry):
+        logged_at, query, normalized, user, db, rows, nbytes, backend_time, \
+            total_time, sampled = entry
+        if normalized is None:
+            normalized = fingerprint(query)
+        if isinstance(query, str):
+            query = query.decode('utf8', 'replace')
+        if isinstance(normalized, str):
+            normalized = normalized.decode('utf8', 'replace')
+        return json.dumps({
+            'time': round(logged_at, 3),
+            'user': user,
+            'db': db,
+            'fingerprint': normalized,
+            'query': query,
+            'rows': rows,
+            'bytes': nbytes,
+            'backend_time': backend_time if backend_time is None else round(backend_time, 6),
+            'total_time': round(total_time, 6),
+            'sampled': sampled,
+            }, sort_keys=True, ensure_ascii=False) + '\n'
+
+    def run(self):
+        out = open(self.path, 'a')
+        try:
+            while True:
+                batch = [self.queue.get()]
+                # take whatever else piled up while we were writing
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get_nowait())
+                    except Queue.Empty:
+                        break
+                stopping = batch[-1] is _STOP
+                if stopping:
+                    batch.pop()
+                if batch:
+                    self.write_batch(out, batch)
+                if stopping:
+                    return
+        finally:
+            out.close()
+
+    def write_batch(self, out, batch):
+        lines = []
+        for entry in batch:
+            line = self.format_entry(entry)
+            if isinstance(line, unicode):
+                line = line.encode('utf8')
+            lines.append(line)
+        try:
+            out.write(''.join(lines))
+            out.flush()
+        except (IOError, OSError) as ex:
+            self.write_errors += 1
+            _LOG.warning('Could not write slow query log %s: %s' % (self.path, ex))
+            return
+        self.written += len(batch)
+        self.batches += 1
+
+    def stats(self):
+        return {
+            'threshold': self.threshold,
+            'sample_every': self.sample_every,
+            'logged': self.logged,
+            'dropped': self.dropped,
+            'written': self.written,
+            'batches': self.batches,
+            'queued': self.queue.qsize(),
+            'write_errors': self.write_errors,
+            }
@@ -0,0 +1,87 @@
+"""
+Disk spill for buffered result sets.
+
+A ResultSetText holding more than its spill threshold's worth of
+rows encodes them into row packets in an unlinked temp file, and
+from then on every batch of rows added.  When the result goes out,
+the file is mmap'd and written to the client a chunk at a time, so
+only a batch of rows and a chunk of the file are ever in memory.
+
+Packets are encoded with the sequence ids they're expected to go out
+with.  If the result set ends up starting elsewhere (e.g. as a later
+result of a multi-statement query), the ids get patched on the way out.
+"""
+import tempfile
+import logging
+import struct
+import mmap
+
+_LOG = logging.getLogger(__name__)
+
+# bytes of the file handed to the client at a time
+CHUNK_SIZE = 1 << 20
+
+
+class SpillFile(object):
+    """
+    Row packets spilled by a result set, the first of them
+    with sequence id `first_seq_id`
+    """
+    def __init__(self, first_seq_id, directory=None):
+        self.first_seq_id = first_seq_id
+        self.file = tempfile.TemporaryFile(prefix='mysqlproxy-spill-', dir=directory)
+        self.size = 0
+        self.packets = 0
+        self.rows = 0
+
+    @property
+    def next_seq_id(self):
+        return self.first_seq_id + self.packets
+
+    def append(self, buf, num_rows, next_seq_id):
+        """
+        Append packets encoded up to (not including) `next_seq_id`
+        """
+        self.file.write(buf)
+        self.size += len(buf)
+        self.packets = next_seq_id - self.first_seq_id
+        self.rows += num_rows
+
+    def write_out(self, net_fd, first_seq_id):
+        """
+        Write the packets to `net_fd`, numbered from `first_seq_id`.
+        Returns the number of bytes written.
+        """
+        if not self.size:
+            return 0
+        self.file.flush()
+        spilled = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+        try:
+            delta = (first_seq_id - self.first_seq_id) & 0xff
+            if not delta:
+                for offset in xrange(0, self.size, CHUNK_SIZE):
+                    net_fd.write(spilled[offset:offset + CHUNK_SIZE])
+            else:
+                self._write_renumbered(spilled, net_fd, delta)
+        finally:
+            spilled.close()
+        return self.size
+
+    def _write_renumbered(self, spilled, net_fd, delta):
+        start = 0
+        while start < self.size:
+            # whole packets, about a chunk's worth
+            header_offsets = []
+            end = start
+            while end < self.size and (end == start or end - start < CHUNK_SIZE):
+                header_offsets.append(end - start)
+                length = struct.unpack('<I', spilled[end:end + 3] + '\x00')[0]
+                end += 4 + length
+            chunk = bytearray(spilled[start:end])
+            for offset in header_offsets:
+                chunk[offset + 3] = (chunk[offset + 3] + delta) & 0xff
+            net_fd.write(bytes(chunk))
+            start = end
+
+    def close(self):
+        self.file.close()
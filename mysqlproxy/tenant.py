@@ -0,0 +1,146 @@
+"""
+Schema-based tenant routing.
+
+Each tenant has a schema of its own, and the schemas are spread
+over several clusters.  A JSON routing file says which cluster (a
+BackendGroup) serves which schema:
+
+    {
+        "clusters": {"east": ["db1:3306", "db2:3306"], "west": ["/run/mysqld-w.sock"]},
+        "schemas": {"acme": "east", "initech": "west"},
+        "default": "east"
+    }
+
+A session starts out on the `default` cluster.  That cluster also
+serves any schema the file doesn't list.  Whenever the session's
+default schema changes (handshake, COM_INIT_DB or USE) to one that
+lives on another cluster, the session moves there.
+
+A lookup is one dict access into the current routing table.
+load() builds a new table and swaps it in whole, so a session never
+sees one that's half loaded.  A cluster whose members didn't change
+keeps its BackendGroup, health history and all.
+"""
+from mysqlproxy.backend_group import parse_backend
+import threading
+import logging
+import json
+
+_LOG = logging.getLogger(__name__)
+
+
+class TenantRouteError(ValueError):
+    pass
+
+
+class TenantRouter(object):
+    """
+    Shared by all sessions.  `make_group` turns a list of
+    Backends into a BackendGroup, health checks running.
+    """
+    def __init__(self, make_group):
+        self.make_group = make_group
+        # serializes loads, lookups go without
+        self.lock = threading.Lock()
+        # (schema -> group, cluster name -> (specs, group), default group)
+        self.table = ({}, {}, None)
+        self.lookups = 0
+        self.defaulted = 0
+        self.switches = 0
+        self.loads = 0
+
+    @property
+    def default(self):
+        return self.table[2]
+
+    def route(self, schema):
+        """
+        BackendGroup serving `schema`, the default one for
+        None or a schema not in the routing table
+        """
+        routes, _, default = self.table
+        self.lookups += 1
+        if isinstance(schema, str):
+            # the routing file's names come out of json as unicode
+            schema = schema.decode('utf8', 'replace')
+        group = routes.get(schema)
+        if group is None:
+            self.defaulted += 1
+            return default
+        return group
+
+    def groups(self):
+        """
+        (cluster name, BackendGroup) for every cluster
+        """
+        return sorted((name, group) for name, (_, group) in self.table[1].iteritems())
+
+    def set_routes(self, clusters, schemas, default):
+        """
+        Swap in a routing table.  `clusters` maps cluster names
+        to lists of backend specs (see parse_backend()), `schemas`
+        maps schema names to cluster names, and `default` names
+        the cluster for everything else.
+        """
+        if default not in clusters:
+            raise TenantRouteError('default cluster %r is not defined' % default)
+        for schema, name in schemas.iteritems():
+            if name not in clusters:
+                raise TenantRouteError('schema %s is routed to undefined cluster %r'
+                    % (schema, name))
+        backends = {}
+        for name, specs in clusters.iteritems():
+            if not specs:
+                raise TenantRouteError('cluster %r has no backends' % name)
+            try:
+                backends[name] = [parse_backend(spec) for spec in specs]
+            except ValueError as ex:
+                raise TenantRouteError('cluster %r: %s' % (name, ex))
+        with self.lock:
+            old_clusters = self.table[1]
+            new_clusters = {}
+            for name, specs in clusters.iteritems():
+                specs = tuple(specs)
+                kept = old_clusters.get(name)
+                if kept is not None and kept[0] == specs:
+                    new_clusters[name] = kept
+                else:
+                    new_clusters[name] = (specs, self.make_group(backends[name]))
+            routes = dict((schema, new_clusters[name][1])
+                for schema, name in schemas.iteritems())
+            self.table = (routes, new_clusters, new_clusters[default][1])
+            self.loads += 1
+        kept_groups = set(id(group) for _, group in new_clusters.itervalues())
+        for name, (_, group) in old_clusters.iteritems():
+            if id(group) not in kept_groups:
+                # sessions on it keep their connections, just unchecked
+                _LOG.info('Cluster %s left the routing table' % name)
+                group.stop()
+        _LOG.info('Routing %d schemas over %d clusters' % (len(routes), len(new_clusters)))
+
+    def load(self, path):
+        self.set_routes(*load_routes(path))
+
+    def stats(self):
+        routes, clusters, _ = self.table
+        return {
+            'clusters': len(clusters),
+            'schemas': len(routes),
+            'lookups': self.lookups,
+            'defaulted': self.defaulted,
+            'switches': self.switches,
+            'loads': self.loads,
+            }
+
+
+def load_routes(path):
+    """
+    (clusters, schemas, default) from the JSON routing file at `path`
+    """
+    with open(path) as routes_file:
+        spec = json.load(routes_file)
+    if not isinstance(spec, dict) or not isinstance(spec.get('clusters'), dict) \
+            or not isinstance(spec.get('schemas', {}), dict) or 'default' not in spec:
+        raise TenantRouteError('%s should hold an object with clusters, schemas '
+            'and default' % path)
+    return spec['clusters'], spec.get('schemas', {}), spec['default']
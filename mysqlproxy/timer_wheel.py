@@ -0,0 +1,151 @@
+"""
+Hashed timer wheel.
+
+One background thread drives every timeout in the proxy
+(handshakes, idle sessions, idle backend connections, query
+deadlines) instead of a threading.Timer per session.  Scheduling
+and cancelling are O(1): a timer is dropped into the slot its
+deadline falls in, and timers further out than one revolution
+just carry a count of revolutions left.
+"""
+import threading
+import logging
+import time
+
+_LOG = logging.getLogger(__name__)
+
+
+class Timer(object):
+    """
+    Handle returned by TimerWheel.schedule()
+    """
+    __slots__ = ('deadline', 'callback', 'args', 'rounds', 'slot', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.rounds = 0
+        self.slot = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel(object):
+    """
+    `tick` seconds per slot, `num_slots` slots per revolution.
+    Timers fire at most one tick late.
+    """
+    def __init__(self, tick=0.1, num_slots=512):
+        self.tick = tick
+        self.num_slots = num_slots
+        self.slots = [set() for _ in range(0, num_slots)]
+        self.current_slot = 0
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.ticks = 0
+        self.running = False
+        self.thread = None
+        self.fired = 0
+        self.active = 0
+
+    def schedule(self, delay, callback, *args):
+        """
+        Call callback(*args) on the wheel thread in `delay` seconds.
+        Callbacks must be quick; anything slow should hand off.
+        """
+        timer = Timer(time.time() + delay, callback, args)
+        ticks = max(1, int(delay / self.tick + 0.5))
+        with self.lock:
+            timer.rounds = (ticks - 1) // self.num_slots
+            timer.slot = (self.current_slot + ticks) % self.num_slots
+            self.slots[timer.slot].add(timer)
+            self.active += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer is None:
+            return
+        timer.cancelled = True
+        with self.lock:
+            if timer.slot is not None and timer in self.slots[timer.slot]:
+                self.slots[timer.slot].discard(timer)
+                self.active -= 1
+
+    def every(self, interval, callback, *args):
+        """
+        Call callback(*args) every `interval` seconds until the
+        returned timer (the first one) is cancelled
+        """
+        first = []
+        def repeat():
+            if first[0].cancelled:
+                return
+            try:
+                callback(*args)
+            finally:
+                self.schedule(interval, repeat)
+        first.append(self.schedule(interval, repeat))
+        return first[0]
+
+    def reschedule(self, timer, delay):
+        """
+        Cancel `timer` and schedule its callback again
+        """
+        self.cancel(timer)
+        return self.schedule(delay, timer.callback, *timer.args)
+
+    def advance(self):
+        """
+        Move one slot ahead, firing what's due there
+        """
+        due = []
+        with self.lock:
+            self.current_slot = (self.current_slot + 1) % self.num_slots
+            slot = self.slots[self.current_slot]
+            for timer in list(slot):
+                if timer.rounds > 0:
+                    timer.rounds -= 1
+                else:
+                    slot.discard(timer)
+                    self.active -= 1
+                    due.append(timer)
+        for timer in due:
+            if timer.cancelled:
+                continue
+            self.fired += 1
+            try:
+                timer.callback(*timer.args)
+            except Exception as ex:
+                _LOG.warning('Timer callback %r failed: %s' % (timer.callback, ex))
+
+    def run(self):
+        while self.running:
+            self.ticks += 1
+            sleep_for = self.started_at + self.ticks * self.tick - time.time()
+            if sleep_for > 0:
+                time.sleep(sleep_for)
+            self.advance()
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.started_at = time.time()
+        self.ticks = 0
+        self.thread = threading.Thread(target=self.run, name='timer-wheel')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'fired': self.fired,
+            'tick': self.tick,
+            'slots': self.num_slots,
+            }
@@ -0,0 +1,135 @@
+"""
+TLS termination on the client side.
+
+When configured, the handshake advertises CLIENT_SSL and clients
+that answer with an SSL request get their socket wrapped before
+they send their credentials.  The backend side is unaffected.
+
+All sessions share one SSLContext, and with it OpenSSL's server
+side session cache and session ticket keys, so a client reconnecting
+with a session it got earlier skips the full handshake (and its
+public key operations).  Session tickets can be turned off to fall
+back on the (per process) session id cache only.
+"""
+import subprocess
+import threading
+import logging
+import socket
+import time
+import ssl
+import os
+
+_LOG = logging.getLogger(__name__)
+
+# not exported by the ssl module of older Pythons
+OP_NO_COMPRESSION = getattr(ssl, 'OP_NO_COMPRESSION', 0x20000)
+OP_NO_TICKET = getattr(ssl, 'OP_NO_TICKET', 0x4000)
+
+DEFAULT_CIPHERS = 'ECDHE+AESGCM:ECDHE+CHACHA20:DHE+AESGCM:ECDHE+AES:!aNULL:!MD5:!DSS'
+
+# size of an SSL request: capabilities, max packet size, charset, filler
+SSL_REQUEST_LENGTH = 32
+
+# seconds to wait for the client's close_notify after sending ours
+SHUTDOWN_TIMEOUT = 1.0
+
+
+class TLSError(Exception):
+    pass
+
+
+def server_context(certfile, keyfile=None, ciphers=None, session_tickets=True):
+    """
+    SSLContext for the client side of the proxy.  `ciphers`
+    is an OpenSSL cipher list (TLS 1.2 and older; TLS 1.3
+    suites aren't configurable from Python 2).
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | OP_NO_COMPRESSION
+    if not session_tickets:
+        context.options |= OP_NO_TICKET
+    try:
+        context.load_cert_chain(certfile, keyfile)
+        context.set_ciphers(ciphers or DEFAULT_CIPHERS)
+    except (ssl.SSLError, IOError) as ex:
+        raise TLSError('could not set up TLS: %s' % ex)
+    return context
+
+
+def self_signed_cert(directory, common_name='mysqlproxy', days=30):
+    """
+    Make a self-signed certificate and key with the openssl
+    command line tool, for testing.  Returns (certfile, keyfile).
+    """
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                '-nodes', '-keyout', keyfile, '-out', certfile, '-days', str(days),
+                '-subj', '/CN=%s' % common_name], stdout=devnull, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError) as ex:
+        raise TLSError('could not make a certificate: %s' % ex)
+    return certfile, keyfile
+
+
+class TLSTerminator(object):
+    """
+    Shared by all sessions.  With `required`, clients that
+    don't ask for TLS are turned away.
+    """
+    def __init__(self, context, required=False, handshake_timeout=None):
+        self.context = context
+        self.required = required
+        self.handshake_timeout = handshake_timeout
+        self.lock = threading.Lock()
+        self.handshakes = 0
+        self.failures = 0
+        self.handshake_time = 0.0
+
+    def wrap(self, sock):
+        """
+        Run the server side of the TLS handshake on `sock`,
+        returning the SSLSocket to talk to the client through
+        """
+        began = time.time()
+        old_timeout = sock.gettimeout()
+        if self.handshake_timeout is not None:
+            sock.settimeout(self.handshake_timeout)
+        try:
+            ssl_sock = self.context.wrap_socket(sock, server_side=True,
+                do_handshake_on_connect=False)
+            ssl_sock.do_handshake()
+            ssl_sock.settimeout(old_timeout)
+        except (ssl.SSLError, socket.error) as ex:
+            with self.lock:
+                self.failures += 1
+            raise TLSError('TLS handshake failed: %s' % ex)
+        with self.lock:
+            self.handshakes += 1
+            self.handshake_time += time.time() - began
+        return ssl_sock
+
+    def shutdown(self, ssl_sock):
+        """
+        End TLS on `ssl_sock` with a close_notify.  OpenSSL drops
+        the session of a connection closed without one from its
+        cache, and the client couldn't resume it.
+        """
+        try:
+            ssl_sock.settimeout(SHUTDOWN_TIMEOUT)
+            ssl_sock.unwrap()
+        except (ssl.SSLError, socket.error):
+            # the client may well be gone without a close_notify of its own
+            pass
+
+    def stats(self):
+        session_stats = self.context.session_stats()
+        return {
+            'handshakes': self.handshakes,
+            'failures': self.failures,
+            'resumed': session_stats.get('hits', 0),
+            'cache_size': session_stats.get('number', 0),
+            'avg_handshake_ms': 1000 * self.handshake_time / self.handshakes
+                if self.handshakes else 0.0,
+            }
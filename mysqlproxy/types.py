@@ -40,7 +40,7 @@ class MySQLDataType(object):
         self._old_read_in = self.read_in
         def debug_read_in(fstream, label="<unlabeled>"):
             ret = self._old_read_in(fstream)
-            if label:
+            if label and _LOG.isEnabledFor(logging.DEBUG):
                 print_val = self.val
                 if type(print_val) in [unicode,str,bytes]:
                     print_val = repr(print_val)
@@ -51,7 +51,7 @@ class MySQLDataType(object):
         self._old_write_out = self.write_out
         def debug_write_out(fstream, label="<unlabeled>"):
             ret = self._old_write_out(fstream)
-            if label:
+            if label and _LOG.isEnabledFor(logging.DEBUG):
                 print_val = self.val
                 if type(print_val) in [unicode,str,bytes]:
                     print_val = repr(print_val)
@@ -192,7 +192,7 @@ class FixedLengthInteger(MySQLDataType):
         for _ in range(0, self.length):
             mbytes += bytes(chr(val & 255))
             val >>= 8
-        if fstream:
+        if fstream is not None:
             fstream.write(mbytes)
             return len(mbytes)
         else:
@@ -12,7 +12,8 @@ setup(
     name='mysqlproxy',
     version=VERSION,
     packages=['mysqlproxy'],
-    scripts=['scripts/mysqlproxy-standalone'],
+    scripts=['scripts/mysqlproxy-standalone', 'scripts/mysqlproxy-audit',
+        'scripts/mysqlproxy-replay'],
     description='proxy library for MySQL',
     author='Pat Mac',
     author_email='itgpmc@gmail.com',
@@ -0,0 +1,51 @@
+"""
+Stand-ins shared by the unit tests
+"""
+from hashlib import sha1
+
+
+def scramble(password, nonce):
+    """
+    mysql_native_password auth response for `password`
+    """
+    passwd_sha = sha1(password).digest()
+    hashed_nonce = sha1(nonce + sha1(passwd_sha).digest()).digest()
+    return ''.join([chr(ord(passwd_sha[x]) ^ ord(hashed_nonce[x])) for x in range(0, 20)])
+
+
+class FakeConnection(object):
+    """
+    Backend connection a session can bring up to date with its
+    state, at an `address` if made like a BackendGroup member's.
+    Selecting database 'missing' fails as it would on a server.
+    """
+    server_capabilities = 0
+
+    def __init__(self, host=None, port=None, unix_socket=None, **kwargs):
+        self.address = unix_socket or ('%s:%d' % (host, port) if host else None)
+        self.kwargs = kwargs
+        self.socket = object()
+        self.server_status = 0x0002 # autocommit
+        self.current_db = None
+        self.charset = 'utf8'
+        self.multi_statements = True
+        self.closed = False
+
+    def select_db(self, db):
+        if db == 'missing':
+            from pymysql.err import InternalError
+            raise InternalError(1049, u"Unknown database 'missing'")
+        self.current_db = db
+
+    def character_set_name(self):
+        return self.charset
+
+    def set_charset(self, charset):
+        self.charset = charset
+
+    def set_multi_statements(self, enabled):
+        self.multi_statements = enabled
+
+    def close(self):
+        self.closed = True
+        self.socket = None
@@ -0,0 +1,130 @@
+"""
+Admin command unit tests
+"""
+from unittest import main, TestCase
+from StringIO import StringIO
+import struct
+
+
+def read_rows(data):
+    """
+    Column count and row values of a text result set
+    """
+    packets = []
+    offset = 0
+    while offset < len(data):
+        length = struct.unpack('<I', data[offset:offset + 4])[0] & 0xffffff
+        packets.append(data[offset + 4:offset + 4 + length])
+        offset += 4 + length
+    num_columns = ord(packets[0][0])
+    rows = []
+    for payload in packets[num_columns + 2:-1]:
+        row = []
+        pos = 0
+        while pos < len(payload):
+            if payload[pos] == '\xfb':
+                row.append(None)
+                pos += 1
+                continue
+            length = ord(payload[pos])
+            row.append(payload[pos + 1:pos + 1 + length])
+            pos += 1 + length
+        rows.append(row)
+    return num_columns, rows
+
+
+class FakeConnection(object):
+    server_capabilities = 0
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    client_capabilities = 0x200 # PROTOCOL_41
+    server_status = 0
+
+    def __init__(self, proxy_obj, username):
+        self.proxy_obj = proxy_obj
+        self.username = username
+        self.sent = []
+
+    def send_payload(self, what):
+        self.sent.append(what)
+
+
+class FakeProxy(object):
+    field_list_cache = None
+    rewriter = None
+    admission = None
+    memory_budget = None
+    timer_wheel = None
+    admin_users = None
+    in_query = False
+
+    def __init__(self, registry, username, **components):
+        from mysqlproxy.multiplex import SessionState
+        self.registry = registry
+        self.state = SessionState('shop', 'utf8')
+        self.session = FakeSession(self, username)
+        self.connection_id = registry.register(self)
+        self.__dict__.update(components)
+
+    def backend_thread_id(self):
+        return 77
+
+
+class AdminCommandTest(TestCase):
+    """
+    Test PROXY SHOW commands answer from local counters
+    """
+    def runTest(self):
+        from mysqlproxy.registry import SessionRegistry
+        from mysqlproxy.pool import BackendPool
+        from mysqlproxy.cache import ColumnBlockCache
+        from mysqlproxy.profiler import SamplingProfiler
+        from mysqlproxy.cli_commands import cli_command_query
+        from mysqlproxy.packet import ERRPacket
+        from mysqlproxy import error_codes as errs
+
+        registry = SessionRegistry()
+        cache = ColumnBlockCache()
+        cache.get('missing')
+        proxy = FakeProxy(registry, 'app', pool=BackendPool(FakeConnection),
+            column_block_cache=cache, profiler=SamplingProfiler())
+        FakeProxy(registry, 'ops', pool=None, column_block_cache=None, profiler=None)
+        session = proxy.session
+
+        def run(query):
+            cli_command_query(session, query, 3)
+            out = StringIO()
+            session.sent[-1].write_out(out)
+            return read_rows(out.getvalue())
+
+        num_columns, rows = run('proxy show sessions;')
+        self.assertEqual(num_columns, 8)
+        self.assertEqual([row[:3] for row in rows], [['1', 'app', 'shop'], ['2', 'ops', 'shop']])
+        self.assertEqual(rows[0][4:7], ['77', 'Sleep', '0'])
+        self.assertEqual(rows[0][7], None)
+
+        _, rows = run('PROXY SHOW STATS')
+        stats = dict([((row[0], row[1]), row[2]) for row in rows])
+        self.assertEqual(stats[('sessions', 'active')], '2')
+        self.assertEqual(stats[('pool', 'open')], '1')
+        self.assertEqual(stats[('column_block_cache', 'misses')], '1')
+
+        _, rows = run('PROXY  show   CACHE')
+        self.assertEqual(rows, [['column_block_cache', '0', '0', '1', '0.0%']])
+
+        num_columns, rows = run('PROXY SHOW POOLS')
+        self.assertEqual(rows[0][0], 'default')
+
+        cli_command_query(session, 'PROXY DROP EVERYTHING', 3)
+        self.assertEqual(session.sent[-1].error_code, errs.UNKNOWN_COMMAND)
+        proxy.admin_users = frozenset(['root'])
+        cli_command_query(session, 'PROXY SHOW STATS', 3)
+        self.assertEqual(session.sent[-1].error_code, errs.ACCESS_DENIED)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Admission control unit tests
+"""
+from unittest import main, TestCase
+
+
+class TokenBucketTest(TestCase):
+    """
+    Test refill, queueing and refusal
+    """
+    def runTest(self):
+        from mysqlproxy.admission import TokenBucket
+
+        bucket = TokenBucket(10, burst=2)
+        now = bucket.updated
+        self.assertEqual(bucket.reserve(0, now), 0.0)
+        self.assertEqual(bucket.reserve(0, now), 0.0)
+        self.assertEqual(bucket.reserve(0, now), None)
+        # willing to wait for the next token
+        self.assertAlmostEqual(bucket.reserve(1, now), 0.1)
+        # ...which the next caller has to wait behind
+        self.assertAlmostEqual(bucket.reserve(1, now), 0.2)
+        self.assertEqual(bucket.reserve(0, now + 0.35), 0.0)
+
+
+class AdmissionControllerTest(TestCase):
+    """
+    Test per-user and per-fingerprint limits and runtime changes
+    """
+    def runTest(self):
+        from mysqlproxy.admission import AdmissionController, AdmissionRejected
+
+        controller = AdmissionController(user_concurrency=1, fingerprint_concurrency=2)
+        first = controller.admit('app', 'select ?')
+        self.assertRaises(AdmissionRejected, controller.admit, 'app', 'select ?')
+        # other users aren't affected
+        second = controller.admit('batch', 'select ?')
+        self.assertRaises(AdmissionRejected, controller.admit, 'ops', 'select ?')
+        second.release()
+        controller.admit('ops', 'select ?').release()
+        first.release()
+        controller.admit('app', 'select ?').release()
+
+        controller.set_user_limits('app', concurrency=2)
+        held = [controller.admit('app'), controller.admit('app')]
+        self.assertRaises(AdmissionRejected, controller.admit, 'app')
+        controller.set_limits(user_concurrency=5)
+        self.assertRaises(AdmissionRejected, controller.admit, 'app')
+        controller.set_user_limits('app')
+        held.append(controller.admit('app'))
+        for admission in held:
+            admission.release()
+
+        controller.set_limits(user_qps=1)
+        controller.admit('qps').release()
+        self.assertRaises(AdmissionRejected, controller.admit, 'qps')
+        self.assertRaises(ValueError, controller.set_limits, bogus=1)
+        stats = controller.stats()
+        self.assertEqual(stats['rejected'], 5)
+
+
+class HandshakeLimitTest(TestCase):
+    """
+    Test the cap on handshakes in progress
+    """
+    def runTest(self):
+        from mysqlproxy.admission import AdmissionController
+
+        controller = AdmissionController(max_handshakes=1)
+        self.assertTrue(controller.begin_handshake())
+        self.assertFalse(controller.begin_handshake())
+        controller.end_handshake()
+        self.assertTrue(controller.begin_handshake())
+        self.assertEqual(controller.stats()['handshakes_rejected'], 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Audit log unit tests
+"""
+from unittest import main, TestCase
+import tempfile
+import shutil
+import os
+
+
+class AuditLogRingTest(TestCase):
+    """
+    Test records survive wrapping around the ring and
+    the reader picks up where it left off
+    """
+    def runTest(self):
+        from mysqlproxy.audit import AuditLog, AuditLogReader, STATUS_NO_RESPONSE
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'audit.ring')
+            audit_log = AuditLog(path, capacity=4096, max_query_length=100)
+            audit_log.record(7, u'app', 0x03, 'SELECT 1', 0, when=1000.5)
+            audit_log.record(7, 'app', 0x02, 'shop', 1049)
+            reader = AuditLogReader(path)
+            records, offset = reader.read()
+            self.assertEqual([(r.session_id, r.user, r.command, r.query, r.status)
+                for r in records], [(7, 'app', 3, 'SELECT 1', 0), (7, 'app', 2, 'shop', 1049)])
+            self.assertEqual(records[0].time, 1000.5)
+            self.assertEqual(reader.read(offset), ([], offset))
+
+            # lots more than fit, of sizes that leave odd bits at the end
+            for i in xrange(0, 200):
+                audit_log.record(i, 'app', 0x03, 'SELECT %s' % ('x' * (i % 37)),
+                    STATUS_NO_RESPONSE if i % 5 == 0 else 0)
+            audit_log.record(200, 'app', 0x03, 'y' * 150)
+            records, _ = reader.read(offset)
+            self.assertEqual(reader.lost, 1)
+            session_ids = [record.session_id for record in records]
+            self.assertEqual(session_ids, range(session_ids[0], 201))
+            self.assertTrue(session_ids[0] > 100)
+            self.assertEqual(records[-2].query, 'SELECT ' + 'x' * (199 % 37))
+            self.assertEqual((records[-1].query, records[-1].truncated), ('y' * 100, True))
+            self.assertEqual(audit_log.stats()['records'], 203)
+            self.assertTrue(audit_log.stats()['bytes_used'] <= 4096)
+            self.assertTrue('[none]' in records[0 if session_ids[0] % 5 == 0 else
+                5 - session_ids[0] % 5].format())
+            reader.close()
+
+            # reopening carries on from where it was
+            audit_log.close()
+            audit_log = AuditLog(path, capacity=4096, max_query_length=100)
+            audit_log.record(201, 'app', 0x01, '')
+            reader = AuditLogReader(path)
+            records, _ = reader.read()
+            self.assertEqual(records[-1].session_id, 201)
+            self.assertEqual(records[-2].session_id, 200)
+            reader.close()
+            audit_log.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
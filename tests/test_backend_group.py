@@ -0,0 +1,211 @@
+"""
+Backend group health checking and failover unit tests
+"""
+from unittest import main, TestCase
+import socket
+import time
+
+
+class FakeSocket(object):
+    def settimeout(self, timeout):
+        pass
+
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query):
+        if self.conn.address in FakeConnection.down:
+            raise socket.error('connection reset')
+        self.conn.queries.append(query)
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        pass
+
+
+class FakeConnection(object):
+    """
+    Connects unless its address is in `down`
+    """
+    down = set()
+    server_capabilities = 0
+
+    def __init__(self, host=None, port=None, unix_socket=None, **kwargs):
+        self.address = unix_socket or '%s:%d' % (host, port)
+        if self.address in FakeConnection.down:
+            raise socket.error('connection refused')
+        self.socket = FakeSocket()
+        self.kwargs = kwargs
+        self.queries = []
+
+    def ping(self, reconnect=True):
+        if self.address in FakeConnection.down:
+            raise socket.error('connection reset')
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        self.socket = None
+
+
+class BackendGroupTest(TestCase):
+    def setUp(self):
+        FakeConnection.down = set()
+
+    def group(self, **kwargs):
+        from mysqlproxy.backend_group import BackendGroup, parse_backend
+        return BackendGroup([parse_backend('db1:3306'), parse_backend('db2:3307'),
+            parse_backend('/tmp/db3.sock')], user='proxy', passwd='secret',
+            connection_class=FakeConnection, **kwargs)
+
+
+class FailoverTest(BackendGroupTest):
+    """
+    Test connections go to the first backend that takes
+    them, and repeated failures eject a backend
+    """
+    def runTest(self):
+        from mysqlproxy.backend_group import NoHealthyBackend
+
+        group = self.group(fall=2)
+        conn = group.connect(user='app')
+        self.assertEqual((conn.address, conn.backend.name), ('db1:3306', 'db1:3306'))
+        self.assertEqual(conn.kwargs, {'user': 'app'})
+
+        FakeConnection.down.add('db1:3306')
+        self.assertEqual(group.connect().address, 'db2:3307')
+        self.assertTrue(group.backends[0].healthy)
+        self.assertEqual(group.connect().address, 'db2:3307')
+        self.assertFalse(group.backends[0].healthy)
+        # ejected, so not tried anymore
+        self.assertEqual(group.connect().address, 'db2:3307')
+        stats = group.stats()
+        self.assertEqual((stats['healthy'], stats['ejections'], stats['connect_failures'],
+            stats['failovers']), (2, 1, 2, 3))
+        self.assertEqual(stats['db1:3306.healthy'], 0)
+
+        # with nothing healthy, everything gets a try anyway
+        FakeConnection.down.update(['db2:3307', '/tmp/db3.sock'])
+        for _ in range(2):
+            self.assertRaises(NoHealthyBackend, group.connect)
+        self.assertEqual(group.healthy(), [])
+        FakeConnection.down.discard('/tmp/db3.sock')
+        self.assertEqual(group.connect().address, '/tmp/db3.sock')
+
+
+class HealthCheckTest(BackendGroupTest):
+    """
+    Test checks eject failing backends and reinstate
+    them once they pass enough checks in a row
+    """
+    def runTest(self):
+        group = self.group(fall=2, rise=3, check_query='SELECT 2')
+        group.check_all()
+        self.assertEqual(group.backends[0].check_conn.queries, ['SELECT 2'])
+        self.assertEqual(group.backends[0].check_conn.kwargs['connect_timeout'], 1.0)
+
+        FakeConnection.down.add('db2:3307')
+        self.assertFalse(group.check(group.backends[1]))
+        self.assertTrue(group.backends[1].healthy)
+        self.assertEqual(group.backends[1].check_conn, None)
+        self.assertFalse(group.check(group.backends[1]))
+        self.assertFalse(group.backends[1].healthy)
+        self.assertEqual(group.backends[1].last_error, 'connection refused')
+
+        FakeConnection.down.clear()
+        for passed in range(3):
+            self.assertFalse(group.backends[1].healthy)
+            self.assertTrue(group.check(group.backends[1]))
+        self.assertTrue(group.backends[1].healthy)
+        stats = group.stats()
+        self.assertEqual((stats['checks'], stats['check_failures'], stats['ejections'],
+            stats['reinstatements']), (8, 2, 1, 1))
+
+        # checks run on a thread of their own once started
+        group.interval = 0.01
+        group.start()
+        deadline = time.time() + 5
+        while group.stats()['checks'] <= 8 and time.time() < deadline:
+            time.sleep(0.01)
+        group.stop()
+        self.assertTrue(group.stats()['checks'] > 8)
+        self.assertEqual(group.backends[0].check_conn, None)
+
+
+class LoadBalancingTest(BackendGroupTest):
+    """
+    Test P2C steers connections away from slow and busy
+    backends, and gives them another go once idle a while
+    """
+    def runTest(self):
+        from mysqlproxy.backend_group import P2C
+        from mysqlproxy.pool import BackendPool
+
+        group = self.group(balance=P2C)
+        db1, db2, db3 = group.backends
+        for backend, elapsed in ((db1, 0.5), (db2, 0.01), (db3, 0.01)):
+            group.begin(backend)
+            group.observe(backend, elapsed)
+        addresses = [group.connect().address for _ in range(50)]
+        self.assertFalse('db1:3306' in addresses)
+        self.assertEqual(group.stats()['failovers'], 0)
+
+        # queries piling up make a backend look slower
+        for _ in range(5):
+            group.begin(db2)
+        self.assertEqual(group.pick([db2, db3]), db3)
+        self.assertEqual(group.candidates()[-1], db1)
+        self.assertEqual(group.stats()['db2:3307.in_flight'], 5)
+        for _ in range(5):
+            group.observe(db2, None)
+        self.assertEqual(db2.queries, 1)
+
+        # the average decays while nothing is observed
+        db1.last_observed -= 3600
+        self.assertTrue(group.load(db1) < group.load(db2))
+        group.begin(db1)
+        group.observe(db1, 0.005)
+        self.assertTrue(db1.ewma < 0.01)
+
+        # the pool picks among idle connections the same way
+        fast = db1.connect(FakeConnection)
+        slow = db3.connect(FakeConnection)
+        group.begin(db3)
+        group.observe(db3, 5.0)
+        self.assertEqual(group.choose([slow, fast]), 1)
+        pool = BackendPool(lambda: fast, max_size=2, choose=group.choose)
+        # most recently used, but slower
+        pool.release(slow)
+        self.assertTrue(pool.acquire() is fast)
+
+
+class PoolUsableTest(BackendGroupTest):
+    """
+    Test the pool closes idle connections to ejected
+    backends rather than handing them out
+    """
+    def runTest(self):
+        from mysqlproxy.pool import BackendPool
+
+        group = self.group(fall=1)
+        pool = BackendPool(group.connect, max_size=2, usable=group.is_usable)
+        conn = pool.acquire()
+        self.assertEqual(conn.address, 'db1:3306')
+        pool.release(conn)
+
+        FakeConnection.down.add('db1:3306')
+        group.check(group.backends[0])
+        fresh = pool.acquire()
+        self.assertEqual(fresh.address, 'db2:3307')
+        self.assertEqual(conn.socket, None)
+        stats = pool.stats()
+        self.assertEqual((stats['open'], stats['unusable']), (1, 1))
+
+
+if __name__ == '__main__':
+    main()
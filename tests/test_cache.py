@@ -0,0 +1,192 @@
+"""
+Cache unit tests
+"""
+from unittest import main, TestCase
+from StringIO import StringIO
+
+from tests.fakes import FakeConnection
+
+
+class FieldListCacheTest(TestCase):
+    """
+    Test field list cache lookups and DDL invalidation
+    """
+    def runTest(self):
+        from mysqlproxy.cache import FieldListCache
+
+        cache = FieldListCache(ttl=60)
+        cache.put('shop', 'orders', '', [b'a'])
+        cache.put('shop', 'users', '', [b'b'])
+        cache.put('blog', 'posts', '', [b'c'])
+        self.assertEqual(cache.get('SHOP', 'Orders', ''), [b'a'])
+        self.assertEqual(cache.get('shop', 'orders', 'id%'), None)
+
+        self.assertFalse(cache.observe_query('shop', 'SELECT * FROM orders'))
+        self.assertEqual(cache.get('shop', 'orders', ''), [b'a'])
+        self.assertTrue(cache.observe_query('shop', 'ALTER TABLE orders ADD COLUMN x int'))
+        self.assertEqual(cache.get('shop', 'orders', ''), None)
+        self.assertEqual(cache.get('shop', 'users', ''), [b'b'])
+        cache.observe_query(None, 'drop database `shop`')
+        self.assertEqual(cache.get('shop', 'users', ''), None)
+        cache.observe_query('blog', 'DROP TABLE posts, comments')
+        self.assertEqual(cache.get('blog', 'posts', ''), None)
+
+        cache = FieldListCache(ttl=-1)
+        cache.put('shop', 'orders', '', [b'a'])
+        self.assertEqual(cache.get('shop', 'orders', ''), None)
+
+
+class DDLCursor(object):
+    """
+    Runs DDL during which another session caches the old
+    columns of the table being altered
+    """
+    description = None
+    rowcount = 0
+    lastrowid = 0
+    _result = None
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, query):
+        self.connection.cache.put('shop', 'orders', '', [b'old'])
+
+
+class DDLConnection(FakeConnection):
+    def cursor(self, cursor_class=None):
+        return DDLCursor(self)
+
+
+class DDLInvalidationTest(TestCase):
+    """
+    Test DDL going through a session clears the table's
+    columns once it's done, not just before it starts
+    """
+    def runTest(self):
+        from mysqlproxy.session import SQLProxy
+        from mysqlproxy.cache import FieldListCache
+        from mysqlproxy.pool import BackendPool
+        from mysqlproxy.registry import SessionRegistry
+
+        cache = FieldListCache(ttl=60)
+        DDLConnection.cache = cache
+        proxy = SQLProxy(StringIO(), pool=BackendPool(DDLConnection), field_list_cache=cache,
+            client_user='app', client_passwd='', registry=SessionRegistry())
+        proxy.state.default_db = 'shop'
+        response = proxy.build_response_from_query('ALTER TABLE orders ADD COLUMN x int')
+        self.assertEqual(response.__class__.__name__, 'OKPacket')
+        self.assertEqual(cache.get('shop', 'orders', ''), None)
+
+
+class FakeField(object):
+    name = u'id'
+    db = b'shop'
+    table_name = u'orders'
+    org_table = u'orders'
+    org_name = u'id'
+    charsetnr = 63
+    length = 11
+    type_code = 3
+    flags = 0x4203
+    scale = 0
+    default = None
+
+
+class FakeBackend(object):
+    def __init__(self):
+        self.calls = 0
+
+    def get_field_descriptors(self, table_name, wildcard):
+        self.calls += 1
+        return [FakeField()]
+
+
+class FakeProxy(object):
+    def __init__(self, cache):
+        from mysqlproxy.multiplex import SessionState
+        self.state = SessionState(default_db='shop')
+        self.field_list_cache = cache
+        self.conn = FakeBackend()
+
+    def backend(self):
+        return self.conn
+
+
+class FakeSession(object):
+    client_capabilities = 0x200 # PROTOCOL_41
+    server_status = 0x2
+
+    def __init__(self, proxy_obj):
+        self.proxy_obj = proxy_obj
+        self.net_fd = StringIO()
+
+    def send_payload(self, what):
+        for pkt in what:
+            pkt.write_out(self.net_fd)
+
+
+class FieldListCommandTest(TestCase):
+    """
+    Test COM_FIELD_LIST responses, cached and uncached
+    """
+    def runTest(self):
+        from mysqlproxy.cli_commands import cli_command_field_list
+        from mysqlproxy.cache import FieldListCache
+
+        session = FakeSession(FakeProxy(FieldListCache()))
+        cli_command_field_list(session, 'orders\x00', 0x04)
+        first = session.net_fd.getvalue()
+        col_def = b'\x03def\x04shop\x06orders\x06orders\x02id\x02id\x0c' \
+            b'\x3f\x00\x0b\x00\x00\x00\x03\x03\x42\x00\x00\x00\xfb'
+        self.assertEqual(first[:4], b'\x2b\x00\x00\x01')
+        self.assertEqual(first[4:4+0x2b], col_def)
+        self.assertEqual(first[4+0x2b:], b'\x05\x00\x00\x02\xfe\x00\x00\x02\x00')
+
+        session.net_fd = StringIO()
+        cli_command_field_list(session, 'orders\x00', 0x04)
+        self.assertEqual(session.net_fd.getvalue(), first)
+        self.assertEqual(session.proxy_obj.conn.calls, 1)
+
+
+class ColumnBlockTest(TestCase):
+    """
+    Test that cached column metadata goes out exactly
+    like freshly built column definitions would
+    """
+    def runTest(self):
+        from mysqlproxy.query_response import ResultSetText
+        from mysqlproxy.cache import ColumnBlockCache
+        from mysqlproxy import column_types
+
+        def column_info(flags, seq_id, use_block):
+            results = ResultSetText(0x200, flags=flags)
+            results.add_column(u'id', column_types.LONG, 11)
+            results.add_column(u'name', column_types.VAR_STRING, 32)
+            block = results.build_column_block()
+            if not use_block:
+                results.column_block = None
+            results.add_row([1, 'bob'])
+            sio = StringIO()
+            written, last_seq_id = results.send_column_info(sio, seq_id)
+            return sio.getvalue(), last_seq_id, block
+
+        fresh, fresh_seq, block = column_info(0x3, 1, False)
+        cached, cached_seq, _ = column_info(0x3, 1, True)
+        self.assertEqual(fresh, cached)
+        self.assertEqual(fresh_seq, cached_seq)
+        self.assertEqual(cached_seq, 4)
+
+        fresh, fresh_seq, _ = column_info(0x2, 5, False)
+        self.assertEqual(fresh, bytes(block.render(5, 0x2)))
+
+        cache = ColumnBlockCache(max_entries=1)
+        cache.put('a', block)
+        self.assertTrue(cache.get('a') is block)
+        cache.put('b', block)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Traffic capture and replay unit tests
+"""
+from unittest import main, TestCase
+import tempfile
+import shutil
+import os
+
+
+class FakeSession(object):
+    username = 'app'
+    client_capabilities = 0x200
+
+
+class FakeState(object):
+    default_db = 'shop'
+    charset = 'utf8'
+
+
+class FakeProxy(object):
+    def __init__(self, connection_id):
+        self.connection_id = connection_id
+        self.session = FakeSession()
+        self.state = FakeState()
+
+
+class FakeResult(object):
+    has_next = False
+
+
+class FakeConnection(object):
+    """
+    Records the commands sent, failing queries containing FAIL
+    """
+    def __init__(self, header, sent):
+        self.header = header
+        self.sent = sent
+        self.socket = object()
+        self._result = FakeResult()
+        self.last = None
+
+    def _execute_command(self, command, payload):
+        self.last = payload
+        self.sent.append((self.header['connection_id'], command, payload))
+
+    def _read_query_result(self):
+        from pymysql.err import ProgrammingError
+        if 'FAIL' in self.last:
+            raise ProgrammingError(1064, 'syntax error')
+
+    def _read_packet(self):
+        pass
+
+    def _read_field_descriptors(self):
+        return []
+
+    def close(self):
+        self.socket = None
+
+
+class CaptureReplayTest(TestCase):
+    """
+    Test captured sessions read back as written and
+    replay in order with errors counted
+    """
+    def runTest(self):
+        from mysqlproxy.capture import TrafficCapture
+        from mysqlproxy.replay import Replayer, load_sessions
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            capture = TrafficCapture(tmp_dir, sample_every=2)
+            first = capture.open_session(FakeProxy(1))
+            self.assertEqual(capture.open_session(FakeProxy(2)), None)
+            second = capture.open_session(FakeProxy(3))
+            started = first.last
+            first.record(0, '\x03SELECT 1', when=started + 0.5)
+            first.record(0, '\x04t\x00', when=started + 0.75)
+            second.record(0, '\x03SELECT FAIL', when=second.last + 0.1)
+            second.record(0, '\x16SELECT ?', when=second.last + 0.1)
+            second.record(0, '\x0e', when=second.last + 0.1)
+            first.record(0, '\x01', when=started + 1.0)
+            first.close()
+            # cut off mid-record, as if the proxy died
+            second.file.write('\x00\x00')
+            second.close()
+            self.assertEqual(capture.stats()['sessions'], 2)
+            self.assertEqual(capture.stats()['active'], 0)
+            self.assertEqual(capture.stats()['commands'], 6)
+
+            sessions = load_sessions([tmp_dir])
+            self.assertEqual([session.header['connection_id'] for session in sessions], [1, 3])
+            self.assertEqual(sessions[0].header['db'], 'shop')
+            self.assertEqual([(round(elapsed, 3), payload) for elapsed, _, payload
+                in sessions[0].commands], [(0.5, '\x03SELECT 1'), (0.75, '\x04t\x00'),
+                    (1.0, '\x01')])
+            self.assertEqual(len(sessions[1].commands), 3)
+
+            sent = []
+            replayer = Replayer(lambda header: FakeConnection(header, sent), sessions,
+                speed=0, concurrency=1)
+            stats = replayer.run()
+            self.assertEqual(sent, [(1, 0x03, 'SELECT 1'), (1, 0x04, 't\x00'), (1, 0x01, ''),
+                (3, 0x03, 'SELECT FAIL'), (3, 0x0e, '')])
+            self.assertEqual(stats.sessions, 2)
+            self.assertEqual(stats.skipped, 1)
+            self.assertEqual(stats.errors, {0x03: 1})
+            self.assertEqual(len(stats.latencies[0x03]), 2)
+            summary = stats.summary({0x03: 'query'})
+            self.assertEqual(len(summary), 6)
+            self.assertTrue(summary[2].startswith('query'))
+            self.assertTrue(summary[-1].split()[:3] == ['all', '5', '1'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+COM_CHANGE_USER / COM_RESET_CONNECTION unit tests
+"""
+from unittest import main, TestCase
+from StringIO import StringIO
+import struct
+
+from tests.fakes import FakeConnection, scramble
+
+
+class ChangeUserTest(TestCase):
+    """
+    Test change user checks the password, throws away a
+    pinned backend connection and starts over with fresh state
+    """
+    def runTest(self):
+        from mysqlproxy.session import SQLProxy
+        from mysqlproxy.pool import BackendPool
+        from mysqlproxy.registry import SessionRegistry
+        from mysqlproxy.cli_commands import handle_client_command, parse_change_user
+        from mysqlproxy import capabilities, error_codes as errs
+
+        caps = capabilities.PROTOCOL_41 | capabilities.SECURE_CONNECTION
+        nonce = 'x' * 20
+        auth = scramble('secret', nonce)
+        payload = 'app\x00' + chr(len(auth)) + auth + 'shop\x00' + struct.pack('<H', 8) \
+            + 'mysql_native_password\x00'
+        self.assertEqual(parse_change_user(payload, caps), ('app', auth, 'shop', 8))
+        self.assertEqual(parse_change_user('app\x00\x00\x00', caps), ('app', '', '', None))
+
+        pool = BackendPool(FakeConnection)
+        proxy = SQLProxy(StringIO(), pool=pool, client_user='app', client_passwd='secret',
+            registry=SessionRegistry())
+        sent = []
+        session = proxy.session
+        session.send_payload = sent.append
+        session.nonce = nonce
+        session.client_capabilities = caps
+        session.charset_id = 33
+        session.username = 'app'
+        pinned_conn = proxy.backend()
+        proxy.state.pin('temporary table')
+
+        bad_payload = 'app\x00' + chr(20) + scramble('wrong', nonce) + 'shop\x00'
+        self.assertFalse(handle_client_command(session, '\x11' + bad_payload))
+        self.assertEqual(sent[-1].error_code, errs.ACCESS_DENIED)
+        self.assertTrue(proxy.state.pinned)
+
+        self.assertTrue(handle_client_command(session, '\x11' + payload))
+        self.assertEqual(sent[-1].__class__.__name__, 'OKPacket')
+        self.assertTrue(pinned_conn.closed)
+        self.assertFalse(proxy.state.pinned)
+        self.assertFalse(proxy.state.multi_statements)
+        self.assertEqual((proxy.state.default_db, proxy.state.charset), ('shop', 'latin1'))
+        self.assertEqual(session.charset_id, 8)
+        self.assertEqual(proxy.client_conn.current_db, 'shop')
+        proxy.end_command()
+        self.assertEqual(proxy.client_conn, None)
+
+        # reset keeps the database
+        proxy.state.observe_query('SET NAMES utf8')
+        self.assertTrue(handle_client_command(session, '\x1f'))
+        self.assertEqual(sent[-1].__class__.__name__, 'OKPacket')
+        self.assertEqual((proxy.state.default_db, proxy.state.charset), ('shop', 'latin1'))
+        proxy.end_command()
+
+        bad_db = 'app\x00' + chr(len(auth)) + auth + 'missing\x00'
+        self.assertTrue(handle_client_command(session, '\x11' + bad_db))
+        self.assertEqual(sent[-1].error_code, 1049)
+        self.assertEqual(proxy.state.default_db, None)
+
+
+
+class ForwardChangeUserTest(TestCase):
+    """
+    Test with forward auth, change user goes to the backend
+    as is, an empty password as an empty auth response
+    """
+    def runTest(self):
+        from mysqlproxy.session import SQLProxy
+        from mysqlproxy.pool import BackendPool
+        from mysqlproxy.registry import SessionRegistry
+        from mysqlproxy.cli_commands import handle_client_command
+        from mysqlproxy import capabilities
+
+        proxy = SQLProxy(StringIO(), pool=BackendPool(FakeConnection), client_user='app',
+            client_passwd='', registry=SessionRegistry())
+        proxy.forward_auth = True
+        changes = []
+        conn = proxy.client_conn = FakeConnection()
+        conn.forward_change_user = lambda *args: changes.append(args)
+        sent = []
+        session = proxy.session
+        session.send_payload = sent.append
+        session.client_capabilities = capabilities.PROTOCOL_41 | capabilities.SECURE_CONNECTION
+        session.charset_id = 33
+
+        self.assertTrue(handle_client_command(session, '\x11' + 'app\x00\x00shop\x00'))
+        self.assertEqual(sent[-1].__class__.__name__, 'OKPacket')
+        self.assertEqual(changes, [('app', '', 'shop', None)])
+        self.assertEqual(session.username, 'app')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Output buffering and streaming unit tests
+"""
+from unittest import main, TestCase
+from StringIO import StringIO
+
+
+class RecordingWriter(object):
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def flush(self):
+        pass
+
+
+class OutputBufferTest(TestCase):
+    """
+    Test watermarks and memory accounting
+    """
+    def runTest(self):
+        from mysqlproxy.flow_control import OutputBuffer, MemoryBudget
+
+        budget = MemoryBudget(100)
+        net_fd = RecordingWriter()
+        out = OutputBuffer(net_fd, high_watermark=100, low_watermark=20,
+            budget=budget)
+        out.write(b'a' * 60)
+        self.assertEqual(net_fd.writes, [])
+        self.assertEqual(budget.used_bytes, 60)
+        out.write(b'b' * 60)
+        # drained down to the low watermark, oldest bytes first
+        self.assertEqual(net_fd.writes, [b'a' * 60 + b'b' * 40])
+        self.assertEqual(len(out), 20)
+        self.assertEqual(budget.used_bytes, 20)
+        self.assertEqual(budget.peak_bytes, 120)
+        self.assertFalse(budget.exceeded)
+        out.flush()
+        self.assertEqual(net_fd.writes[-1], b'b' * 20)
+        self.assertEqual(budget.used_bytes, 0)
+        self.assertEqual(out.pauses, 1)
+
+
+class StreamingResultSetTest(TestCase):
+    """
+    Test that streamed rows go out like buffered ones
+    """
+    def runTest(self):
+        from mysqlproxy.query_response import ResultSetText, StreamingResultSetText
+        from mysqlproxy import column_types
+
+        rows = [[i, 'row %d' % i] for i in range(0, 10)]
+        batches = [rows[0:4], rows[4:8], rows[8:10], []]
+        fetched = []
+        def fetch_rows(size):
+            fetched.append(size)
+            return batches.pop(0)
+
+        buffered = ResultSetText(0x200)
+        streamed = StreamingResultSetText(0x200, fetch_rows)
+        for results in (buffered, streamed):
+            results.add_column(u'id', column_types.LONG, 11)
+            results.add_column(u'name', column_types.VAR_STRING, 32)
+        for row in rows:
+            buffered.add_row(row)
+
+        expected, actual = StringIO(), StringIO()
+        buffered.write_out(expected)
+        streamed.write_out(actual)
+        self.assertEqual(actual.getvalue(), expected.getvalue())
+        self.assertEqual(streamed.rows_sent, 10)
+        self.assertEqual(len(fetched), 4)
+
+
+if __name__ == '__main__':
+    main()
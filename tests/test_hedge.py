@@ -0,0 +1,174 @@
+"""
+Hedged read unit tests
+"""
+from unittest import main, TestCase
+import threading
+import socket
+import time
+
+from tests.fakes import FakeConnection
+
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.connection = conn
+        self.responses_read = 0
+
+    def send_query(self, query):
+        self.connection.sent.append(query)
+        if self.connection.address in SocketConnection.fast:
+            self.connection.peer.send('x')
+
+    def read_response(self):
+        self.responses_read += 1
+
+
+class SocketConnection(FakeConnection):
+    """
+    Backend connection over a socket pair, the test
+    holding the backend's end in `peer`
+    """
+    kills = []
+    # addresses that respond right away
+    fast = set()
+
+    def __init__(self, *largs, **kwargs):
+        FakeConnection.__init__(self, *largs, **kwargs)
+        self.socket, self.peer = socket.socketpair()
+        self.sent = []
+
+    def cursor(self, cursor_class=None):
+        return FakeCursor(self)
+
+    def thread_id(self):
+        return id(self)
+
+    def kill_query(self, thread_id):
+        SocketConnection.kills.append(thread_id)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class ReadOnlyTest(TestCase):
+    """
+    Test only single SELECTs without side effects are hedged
+    """
+    def runTest(self):
+        from mysqlproxy.hedge import is_read_only
+
+        self.assertTrue(is_read_only('SELECT * FROM orders WHERE id = 5'))
+        self.assertTrue(is_read_only('  /* web-7 */ select 1;'))
+        self.assertTrue(is_read_only('(SELECT 1) UNION (SELECT 2)'))
+        self.assertFalse(is_read_only('UPDATE orders SET paid = 1'))
+        self.assertFalse(is_read_only('SELECT 1; SELECT 2'))
+        self.assertFalse(is_read_only('SELECT * FROM orders FOR UPDATE'))
+        self.assertFalse(is_read_only('SELECT * FROM t LOCK IN SHARE MODE'))
+        self.assertFalse(is_read_only("SELECT * INTO OUTFILE '/tmp/x' FROM t"))
+        self.assertFalse(is_read_only("SELECT GET_LOCK('x', 10)"))
+        self.assertFalse(is_read_only('SELECT @n := COUNT(*) FROM t'))
+
+
+class HedgePolicyTest(TestCase):
+    """
+    Test the hedge delay follows recent response times and
+    the budget holds hedges to their share of queries
+    """
+    def runTest(self):
+        from mysqlproxy.hedge import HedgePolicy
+
+        policy = HedgePolicy(percentile=90, budget_percent=10, min_samples=10,
+            recompute_every=1)
+        for _ in range(9):
+            policy.observe(0.01)
+        self.assertEqual(policy.delay(), None)
+        policy.observe(0.5)
+        self.assertEqual(policy.delay(), 0.5)
+        for _ in range(90):
+            policy.observe(0.01)
+        self.assertEqual(policy.delay(), 0.01)
+
+        # 100 queries pay for 10 hedges
+        fired = 0
+        while policy.allow():
+            policy.fire()
+            fired += 1
+        self.assertEqual(fired, 10)
+        # writes count towards the budget without skewing the delay
+        for _ in range(10):
+            policy.observe(None)
+        self.assertTrue(policy.allow())
+        stats = policy.stats()
+        self.assertEqual((stats['queries'], stats['hedges_fired'], stats['budget_exhausted'],
+            stats['delay_ms']), (110, 10, 1, 10.0))
+
+
+class HedgedExecuteTest(TestCase):
+    """
+    Test a slow backend gets a hedge to another one, and the
+    session carries on with whichever responded first
+    """
+    def runTest(self):
+        from mysqlproxy.session import SQLProxy
+        from mysqlproxy.backend_group import BackendGroup, parse_backend
+        from mysqlproxy.hedge import HedgePolicy
+        from mysqlproxy.pool import BackendPool
+        from mysqlproxy.registry import SessionRegistry
+
+        SocketConnection.kills = []
+        SocketConnection.fast = set()
+        group = BackendGroup([parse_backend('db1:3306'), parse_backend('db2:3306')],
+            connection_class=SocketConnection)
+        policy = HedgePolicy(budget_percent=100, min_samples=1)
+        policy.observe(0.01)
+        server_sock, client_sock = [socket.socket(_sock=sock) for sock in socket.socketpair()]
+        proxy = SQLProxy(server_sock.makefile('r+b', bufsize=0),
+            pool=BackendPool(group.connect, max_size=1), backend_group=group, hedge=policy,
+            client_user='app', client_passwd='secret', registry=SessionRegistry(),
+            client_socket=server_sock)
+        primary = proxy.backend()
+        self.assertEqual(primary.address, 'db1:3306')
+        self.assertTrue(proxy.may_hedge(primary, 'SELECT 1'))
+        self.assertFalse(proxy.may_hedge(primary, 'DELETE FROM t'))
+
+        # answered in time: no hedge
+        SocketConnection.fast.add('db1:3306')
+        cursor = proxy.execute_hedged(primary.cursor(), 'SELECT 1')
+        self.assertTrue(cursor.connection is primary)
+        self.assertEqual(cursor.responses_read, 1)
+        self.assertEqual(policy.fired, 0)
+        primary.socket.recv(1)
+        SocketConnection.fast.clear()
+
+        # slow, but answers before the hedge does
+        policy.observe(0.01)
+        threading.Timer(0.1, primary.peer.send, ['x']).start()
+        cursor = proxy.execute_hedged(primary.cursor(), 'SELECT 2')
+        self.assertTrue(cursor.connection is primary)
+        self.assertEqual((policy.fired, policy.won), (1, 0))
+        self.assertTrue(wait_for(lambda: len(SocketConnection.kills) == 1))
+        self.assertNotEqual(SocketConnection.kills[0], id(primary))
+        primary.socket.recv(1)
+
+        # slow, and the hedge wins
+        policy.observe(0.01)
+        proxy.state.default_db = 'shop'
+        SocketConnection.fast.add('db2:3306')
+        cursor = proxy.execute_hedged(primary.cursor(), 'SELECT 3')
+        hedge_conn = cursor.connection
+        self.assertEqual((hedge_conn.address, hedge_conn.sent), ('db2:3306', ['SELECT 3']))
+        self.assertEqual(hedge_conn.current_db, 'shop')
+        self.assertEqual(hedge_conn.kwargs['autocommit'], True)
+        self.assertTrue(proxy.client_conn is hedge_conn)
+        self.assertEqual((policy.fired, policy.won), (2, 1))
+        self.assertTrue(wait_for(lambda: primary.closed))
+        self.assertEqual(SocketConnection.kills[-1], id(primary))
+        client_sock.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Connection id and KILL handling unit tests
+"""
+from unittest import main, TestCase
+import struct
+
+
+class FakeSession(object):
+    client_capabilities = 0
+    server_status = 0
+
+    def __init__(self, proxy_obj, username):
+        self.proxy_obj = proxy_obj
+        self.username = username
+        self.sent = []
+        self.aborted = None
+
+    def send_payload(self, what):
+        self.sent.append(what)
+
+    def abort(self, reason):
+        self.aborted = reason
+
+
+class FakeProxy(object):
+    def __init__(self, registry, username):
+        self.registry = registry
+        self.session = FakeSession(self, username)
+        self.connection_id = registry.register(self)
+        self.cancelled = 0
+
+    def cancel_backend_query(self):
+        self.cancelled += 1
+
+
+class SessionRegistryTest(TestCase):
+    """
+    Test connection ids are unique and map back to sessions
+    """
+    def runTest(self):
+        from mysqlproxy.registry import SessionRegistry
+
+        registry = SessionRegistry(first_id=(1<<32) - 1)
+        first, second = object(), object()
+        first_id = registry.register(first)
+        second_id = registry.register(second)
+        # wraps around, skipping 0
+        self.assertEqual((first_id, second_id), ((1<<32) - 1, 1))
+        self.assertTrue(registry.get(second_id) is second)
+        registry.unregister(first_id)
+        self.assertEqual(registry.get(first_id), None)
+        self.assertEqual([conn_id for conn_id, _, _ in registry.snapshot()], [second_id])
+
+
+class KillTest(TestCase):
+    """
+    Test KILL [QUERY] n and COM_PROCESS_KILL
+    """
+    def runTest(self):
+        from mysqlproxy.registry import SessionRegistry
+        from mysqlproxy.cli_commands import cli_command_query, cli_command_kill
+        from mysqlproxy.packet import OKPacket, ERRPacket
+        from mysqlproxy import error_codes as errs
+
+        registry = SessionRegistry()
+        killer = FakeProxy(registry, 'app')
+        victim = FakeProxy(registry, 'app')
+        stranger = FakeProxy(registry, 'ops')
+        session = killer.session
+
+        self.assertTrue(cli_command_query(session, 'KILL QUERY %d' % victim.connection_id, 3))
+        self.assertTrue(isinstance(session.sent[-1], OKPacket))
+        self.assertEqual(victim.cancelled, 1)
+        self.assertEqual(victim.session.aborted, None)
+
+        self.assertTrue(cli_command_kill(session, struct.pack('<I', victim.connection_id), 0x0c))
+        self.assertEqual(victim.cancelled, 2)
+        self.assertTrue(victim.session.aborted)
+
+        cli_command_query(session, 'kill %d' % stranger.connection_id, 3)
+        self.assertEqual(session.sent[-1].error_code, errs.KILL_DENIED)
+        self.assertEqual(stranger.cancelled, 0)
+        cli_command_query(session, 'KILL 999', 3)
+        self.assertEqual(session.sent[-1].error_code, errs.NO_SUCH_THREAD)
+
+        # killing your own connection ends it
+        self.assertFalse(cli_command_query(session, 'KILL %d' % killer.connection_id, 3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+LOAD DATA LOCAL INFILE relay unit tests
+"""
+from unittest import main, TestCase
+from StringIO import StringIO
+import struct
+
+
+def packet(seq_id, payload):
+    return struct.pack('<I', len(payload))[:3] + chr(seq_id) + payload
+
+
+class FakeBackend(object):
+    """
+    Enough of a ProxyConnection to read packets off
+    `data` and record the ones written
+    """
+    def __init__(self, data=''):
+        self.rfile = StringIO(data)
+        self.written = []
+        self.results_read = 0
+
+    def _read_bytes(self, num_bytes):
+        return self.rfile.read(num_bytes)
+
+    def _read_packet(self):
+        from pymysql.connections import MysqlPacket
+        packet = MysqlPacket(self)
+        packet.check_error()
+        return packet
+
+    def write_packet(self, seq_id, payload):
+        self.written.append((seq_id, payload))
+
+    def _read_query_result(self, unbuffered=False):
+        self.results_read += 1
+
+
+class FakeSession(object):
+    def __init__(self, client_data, client_capabilities):
+        from mysqlproxy.flow_control import OutputBuffer
+        self.net_fd = StringIO(client_data)
+        self.sent = StringIO()
+        self.out = OutputBuffer(self.sent)
+        self.client_capabilities = client_capabilities
+
+
+class Uppercase(object):
+    plugin_name = 'uppercase'
+
+    def run(self, hook_name, session, filename, chunk):
+        if chunk == 'drop\n':
+            return True, ''
+        return True, chunk.upper()
+
+
+class FileRequestTest(TestCase):
+    """
+    Test a file request from the backend is recognized
+    rather than read as a result set
+    """
+    def runTest(self):
+        from mysqlproxy.client import ProxyResult
+
+        conn = FakeBackend(packet(1, '\xfb/tmp/data.csv'))
+        result = ProxyResult(conn)
+        result.init_unbuffered_query()
+        self.assertEqual(result.local_infile, '/tmp/data.csv')
+        self.assertFalse(result.unbuffered_active)
+
+        conn = FakeBackend(packet(1, '\x00\x01\x00\x02\x00\x00\x00'))
+        result = ProxyResult(conn)
+        result.init_unbuffered_query()
+        self.assertEqual(result.local_infile, None)
+        self.assertEqual(result.affected_rows, 1)
+
+
+class RelayTest(TestCase):
+    """
+    Test the file goes from client to backend packet by
+    packet, through plugins, with sequence ids on both sides
+    """
+    def runTest(self):
+        from mysqlproxy.local_infile import relay, LocalInfileRefused
+        from mysqlproxy.plugin import PluginRegistry
+        from mysqlproxy import capabilities
+
+        caps = capabilities.PROTOCOL_41 | capabilities.LOCAL_FILES
+        client_data = packet(2, 'a,1\n') + packet(3, 'drop\n') + packet(4, 'b,2\n') \
+            + packet(5, '')
+        session = FakeSession(client_data, caps)
+        conn = FakeBackend()
+        plugins = PluginRegistry()
+        plugins.plugins['local_infile_chunk'] = [Uppercase()]
+        seq_id, nbytes = relay(session, conn, 'data.csv', plugins)
+        self.assertEqual(session.sent.getvalue(), packet(1, '\xfbdata.csv'))
+        self.assertEqual(conn.written, [(2, 'A,1\n'), (3, 'B,2\n'), (4, '')])
+        self.assertEqual((seq_id, nbytes), (6, 13))
+
+        # a client that can't send files gets none asked for
+        session = FakeSession('', capabilities.PROTOCOL_41)
+        conn = FakeBackend()
+        self.assertRaises(LocalInfileRefused, relay, session, conn, 'data.csv')
+        self.assertEqual(session.sent.getvalue(), '')
+        self.assertEqual(conn.written, [(2, '')])
+        self.assertEqual(conn.results_read, 1)
+
+        # hanging up halfway is the client going away
+        import socket
+        session = FakeSession(packet(2, 'a,1\n') + packet(3, 'b,')[:6], caps)
+        self.assertRaises(socket.error, relay, session, FakeBackend(), 'data.csv')
+
+
+class LocalInfileStatsTest(TestCase):
+    def runTest(self):
+        from mysqlproxy.local_infile import LocalInfileStats
+
+        stats = LocalInfileStats()
+        stats.add(1000, 0.5)
+        stats.add(3000, 0.5)
+        stats.count_refused()
+        self.assertEqual(stats.stats(), {'loads': 2, 'refused': 1, 'bytes': 4000,
+            'bytes_per_sec': 4000.0, 'last_bytes_per_sec': 6000.0})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Multi-result response unit tests
+"""
+from unittest import main, TestCase
+from StringIO import StringIO
+import struct
+
+
+def read_packets(data):
+    """
+    (seq id, payload) for each packet in `data`
+    """
+    packets = []
+    offset = 0
+    while offset < len(data):
+        header, = struct.unpack('<I', data[offset:offset + 4])
+        length = header & 0xffffff
+        packets.append((header >> 24, data[offset + 4:offset + 4 + length]))
+        offset += 4 + length
+    return packets
+
+
+class MultiResultResponseTest(TestCase):
+    """
+    Test results are chained with running sequence ids
+    and MORE_RESULTS_EXISTS on all but the last
+    """
+    def runTest(self):
+        from mysqlproxy.query_response import MultiResultResponse, \
+            StreamingResultSetText
+        from mysqlproxy.packet import OKPacket, ERRPacket
+        from mysqlproxy import capabilities, column_types, status_flags
+
+        caps = capabilities.PROTOCOL_41 | capabilities.MULTI_RESULTS
+        batches = [[[1], [2]], []]
+        result_set = StreamingResultSetText(caps,
+            lambda size: batches.pop(0), has_more=lambda: True)
+        result_set.add_column(u'n', column_types.LONG, 11)
+        responses = [
+            OKPacket(caps, 3, 0, status_flags=status_flags.MORE_RESULTS_EXISTS),
+            result_set,
+            ERRPacket(caps, error_code=1146, error_msg=u'no such table'),
+            ]
+        out = StringIO()
+        _, last_seq_id = MultiResultResponse(iter(responses)).write_out(out)
+
+        packets = read_packets(out.getvalue())
+        # OK, column count, column, EOF, 2 rows, EOF, ERR
+        self.assertEqual([seq_id for seq_id, _ in packets], range(1, 9))
+        self.assertEqual(last_seq_id, 8)
+        ok_flags, = struct.unpack('<H', packets[0][1][3:5])
+        self.assertTrue(ok_flags & status_flags.MORE_RESULTS_EXISTS)
+        eof_flags, = struct.unpack('<H', packets[6][1][3:5])
+        self.assertTrue(eof_flags & status_flags.MORE_RESULTS_EXISTS)
+        self.assertEqual(packets[7][1][0], '\xff')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Multiplexing unit tests
+"""
+from unittest import main, TestCase
+from StringIO import StringIO
+
+from tests.fakes import FakeConnection
+
+
+class SessionStateTest(TestCase):
+    """
+    Test tracking of restorable vs. pinning session state
+    """
+    def runTest(self):
+        from mysqlproxy.multiplex import SessionState
+
+        state = SessionState()
+        state.observe_query('USE `shop`')
+        state.observe_query('SET NAMES latin1')
+        state.observe_query('SET autocommit=0')
+        state.observe_query('SELECT * FROM orders')
+        self.assertEqual(state.default_db, 'shop')
+        self.assertEqual(state.charset, 'latin1')
+        self.assertFalse(state.pinned)
+
+        state.observe_query('CREATE TEMPORARY TABLE t (id int)')
+        self.assertTrue(state.pinned)
+        self.assertEqual(state.pinned_reason, 'temporary table')
+
+        state = SessionState()
+        state.observe_query('SELECT @n := COUNT(*) FROM orders')
+        self.assertEqual(state.pinned_reason, 'user variable')
+        state = SessionState()
+        state.observe_query('SELECT MAX(id) INTO @top FROM orders')
+        self.assertEqual(state.pinned_reason, 'user variable')
+
+        # a write keeps the connection for the next command only
+        state = SessionState()
+        state.observe_query('INSERT INTO orders (paid) VALUES (1)')
+        self.assertTrue(state.held)
+        state.observe_query('SELECT LAST_INSERT_ID()')
+        self.assertFalse(state.held)
+        self.assertFalse(state.pinned)
+
+        # every statement of a batch counts
+        state = SessionState()
+        state.observe_query('SELECT 1; USE shop; SET @a = 1;')
+        self.assertEqual(state.default_db, 'shop')
+        self.assertEqual(state.pinned_reason, 'session variable')
+
+
+class TransactionBoundaryTest(TestCase):
+    """
+    Test transaction boundary detection off of server status flags
+    """
+    def runTest(self):
+        from mysqlproxy.multiplex import at_transaction_boundary
+        from mysqlproxy import status_flags
+
+        self.assertTrue(at_transaction_boundary(status_flags.STATUS_AUTOCOMMIT))
+        self.assertFalse(at_transaction_boundary(
+            status_flags.STATUS_AUTOCOMMIT | status_flags.STATUS_IN_TRANS))
+        self.assertFalse(at_transaction_boundary(0))
+
+
+class BackendPoolTest(TestCase):
+    """
+    Test pool checkout/checkin and bounds
+    """
+    def runTest(self):
+        from mysqlproxy.pool import BackendPool, PoolTimeout
+
+        pool = BackendPool(FakeConnection, max_size=2)
+        conn_a = pool.acquire()
+        conn_b = pool.acquire()
+        self.assertRaises(PoolTimeout, pool.acquire, 0.01)
+        pool.release(conn_a)
+        self.assertTrue(pool.acquire() is conn_a)
+        pool.discard(conn_b)
+        self.assertTrue(conn_b.closed)
+        self.assertEqual(pool.stats()['open'], 1)
+        pool.acquire()
+        self.assertEqual(pool.stats()['acquire_timeouts'], 1)
+
+
+
+class HeldConnectionTest(TestCase):
+    """
+    Test a session keeps the connection it wrote on for its
+    next command, then hands it back
+    """
+    def runTest(self):
+        from mysqlproxy.session import SQLProxy
+        from mysqlproxy.pool import BackendPool
+        from mysqlproxy.registry import SessionRegistry
+
+        pool = BackendPool(FakeConnection, max_size=2)
+        proxy = SQLProxy(StringIO(), pool=pool, client_user='app', client_passwd='',
+            registry=SessionRegistry())
+        conn = proxy.backend()
+        proxy.state.observe_query('INSERT INTO orders (paid) VALUES (1)')
+        proxy.end_command()
+        self.assertTrue(proxy.client_conn is conn)
+        proxy.state.observe_query('SELECT LAST_INSERT_ID()')
+        self.assertTrue(proxy.backend() is conn)
+        proxy.end_command()
+        self.assertEqual(proxy.client_conn, None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Pre-connected backend pool unit tests
+"""
+from unittest import main, TestCase
+import time
+
+
+class FakeGreetedConnection(object):
+    salt = 's' * 20
+
+    def __init__(self):
+        self.user = None
+        self.auth_response = None
+        self.closed = False
+
+    def forward_authentication(self, auth_response):
+        self.auth_response = auth_response
+
+    def close(self):
+        self.closed = True
+
+
+class PreconnectPoolTest(TestCase):
+    """
+    Test warm connections get handed out until they're too
+    old, then logged in and closed, and sizing follows the
+    connect rate
+    """
+    def runTest(self):
+        from mysqlproxy.preconnect import PreconnectPool
+
+        made = []
+        def connect():
+            made.append(FakeGreetedConnection())
+            return made[-1]
+        pool = PreconnectPool(connect, user='proxy', passwd='secret', max_age=5.0,
+            min_size=1, max_size=4, rate_window=10.0, refill_interval=0.5)
+        now = time.time()
+        fresh, stale = FakeGreetedConnection(), FakeGreetedConnection()
+        pool.warm.extend([(stale, now - 6), (fresh, now - 1)])
+        self.assertTrue(pool.get() is fresh)
+        self.assertEqual(pool.get(), made[0])
+        self.assertEqual((pool.hits, pool.misses), (1, 1))
+        pool.retire_expired()
+        self.assertEqual(stale.user, 'proxy')
+        self.assertEqual(len(stale.auth_response), 21) # length prefixed
+        self.assertTrue(stale.closed)
+
+        # 2 connects in 10s, connects take 0.05s: covered by the minimum
+        self.assertEqual(pool.compute_target(now), 1)
+        pool.arrivals.extend([now] * 18)
+        self.assertEqual(pool.compute_target(now), 3)
+        pool.arrivals.extend([now] * 100)
+        self.assertEqual(pool.compute_target(now), 4)
+        self.assertEqual(pool.compute_target(now + 11), 1)
+
+        pool.start()
+        try:
+            deadline = time.time() + 5
+            while len(pool.warm) < 1 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(len(pool.warm), 1)
+        finally:
+            pool.stop()
+        self.assertEqual(len(pool.warm), 0)
+        self.assertTrue(made[-1].closed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Sampling profiler unit tests
+"""
+from unittest import main, TestCase
+from StringIO import StringIO
+import threading
+import time
+import sys
+
+
+def parked_in_known_function(ready, done):
+    ready.set()
+    done.wait()
+
+
+def wait_until_blocked(thread):
+    # ready is set just before the thread gets to block on done
+    while True:
+        frame = sys._current_frames()[thread.ident]
+        if frame.f_code.co_name == 'wait' and frame.f_back.f_code.co_name == 'wait':
+            return
+        time.sleep(0.001)
+
+
+class SamplingProfilerTest(TestCase):
+    """
+    Test stacks of other threads get counted and collapsed
+    """
+    def runTest(self):
+        from mysqlproxy.profiler import SamplingProfiler
+
+        ready, done = threading.Event(), threading.Event()
+        worker = threading.Thread(target=parked_in_known_function, args=(ready, done))
+        worker.start()
+        try:
+            ready.wait()
+            wait_until_blocked(worker)
+            profiler = SamplingProfiler(skip_idle=False)
+            profiler.sample()
+            profiler.sample()
+            # blocked threads don't count by default
+            idle_profiler = SamplingProfiler()
+            idle_profiler.sample()
+        finally:
+            done.set()
+            worker.join()
+
+        out = StringIO()
+        profiler.dump(out)
+        worker_stacks = [line for line in out.getvalue().splitlines()
+            if 'parked_in_known_function (test_profiler.py' in line]
+        self.assertEqual(len(worker_stacks), 1)
+        stack, count = worker_stacks[0].rsplit(' ', 1)
+        self.assertEqual(count, '2')
+        # root first, leaf last
+        self.assertTrue(stack.startswith('__bootstrap'))
+        self.assertTrue(stack.endswith(')') and 'wait (threading.py' in stack)
+        self.assertFalse([line for line in idle_profiler.collapsed()
+            if 'parked_in_known_function' in line])
+        self.assertTrue(idle_profiler.stats()['idle_samples'] >= 1)
+
+
+class ProfilerThreadTest(TestCase):
+    """
+    Test starting, stopping and resetting the sampling thread
+    """
+    def runTest(self):
+        from mysqlproxy.profiler import SamplingProfiler
+
+        profiler = SamplingProfiler(interval=0.001, skip_idle=False)
+        self.assertTrue(profiler.start())
+        self.assertFalse(profiler.start())
+        time.sleep(0.05)
+        self.assertTrue(profiler.stop())
+        self.assertFalse(profiler.stop())
+        stats = profiler.stats()
+        self.assertTrue(stats['samples'] > 0)
+        self.assertTrue(stats['overhead'] <= 0.05)
+        profiler.reset()
+        self.assertEqual(profiler.collapsed(), [])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Fingerprinting and query rewrite unit tests
+"""
+from unittest import main, TestCase
+
+
+class FingerprintTest(TestCase):
+    """
+    Test literals, comments and whitespace are normalized away
+    """
+    def runTest(self):
+        from mysqlproxy.fingerprint import fingerprint
+
+        self.assertEqual(fingerprint('SELECT * FROM t WHERE id = 5'),
+            fingerprint('select *  from t where id=7;'))
+        self.assertEqual(
+            fingerprint("SELECT a FROM `T` WHERE b IN (1, 2,3) AND c='x''y' -- why"),
+            "select a from `t` where b in (?+) and c=?")
+        self.assertEqual(fingerprint("INSERT INTO t VALUES (1,'a'), (2,'b')"),
+            'insert into t values (?+)+')
+        self.assertEqual(fingerprint('SELECT /*+ BKA(t) */ t1.c2 /* x */ FROM t1'),
+            'select /*+ bka(t) */ t1.c2 from t1')
+
+
+class KeywordExtractionTest(TestCase):
+    """
+    Test only whole, unquoted words are taken from patterns
+    """
+    def runTest(self):
+        from mysqlproxy.rewrite import extract_keywords
+
+        self.assertEqual(extract_keywords(r'^\s*select\b.*\bfrom\s+audit_log\b'),
+            frozenset(['select', 'from', 'audit_log']))
+        self.assertEqual(extract_keywords(r'\bsleep\(\s*\d+\s*\)'), frozenset(['sleep']))
+        # could be part of longer words
+        self.assertEqual(extract_keywords(r'sel\w*\s+x'), frozenset())
+        self.assertEqual(extract_keywords(r'x\s*select\b'), frozenset())
+        self.assertEqual(extract_keywords(r"\bwhere\s+name\s*=\s*'bob big smith'"),
+            frozenset(['where', 'name']))
+
+
+class QueryRewriterTest(TestCase):
+    """
+    Test replace, hint and limit rules
+    """
+    def runTest(self):
+        from mysqlproxy.rewrite import QueryRewriter, RewriteRule
+
+        rules = [
+            RewriteRule('no-sleep', r'\bsleep\(\s*\d+\s*\)', replace='sleep(0)'),
+            RewriteRule('reports', r'^\s*select\b', hint='MAX_EXECUTION_TIME(5000)',
+                keywords=['report_daily']),
+            RewriteRule('audit', r'^\s*select\b.*\bfrom\s+audit_log\b', limit=100),
+            ]
+        rewriter = QueryRewriter(rules)
+        self.assertEqual(rewriter.rewrite('SELECT SLEEP(10)'), 'SELECT sleep(0)')
+        self.assertEqual(rewriter.rewrite('SELECT * FROM report_daily'),
+            'SELECT /*+ MAX_EXECUTION_TIME(5000) */ * FROM report_daily')
+        self.assertEqual(rewriter.rewrite('select * from audit_log;'),
+            'select * from audit_log LIMIT 100')
+        self.assertEqual(rewriter.rewrite('select * from audit_log limit 5'),
+            'select * from audit_log limit 5')
+        self.assertEqual(rewriter.rewrite('select * from orders'), 'select * from orders')
+
+        # same fingerprint, candidates come from the memo
+        rewriter.rewrite('SELECT SLEEP(3)')
+        stats = rewriter.stats()
+        self.assertEqual(stats['memo_hits'], 1)
+        self.assertEqual(stats['rewritten'], 4)
+
+        rewriter.set_rules([])
+        self.assertEqual(rewriter.rewrite('SELECT SLEEP(10)'), 'SELECT SLEEP(10)')
+
+
+class LoadRulesTest(TestCase):
+    """
+    Test rules load from JSON and bad ones are refused
+    """
+    def runTest(self):
+        from mysqlproxy.rewrite import load_rules, RewriteRuleError
+        import tempfile
+        import json
+        import os
+
+        fd, path = tempfile.mkstemp(suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as rules_file:
+                json.dump([{'name': 'cap', 'match': r'^\s*select\b', 'limit': 10}],
+                    rules_file)
+            rules = load_rules(path)
+            self.assertEqual(len(rules), 1)
+            self.assertEqual(rules[0].keywords, frozenset(['select']))
+            with open(path, 'w') as rules_file:
+                json.dump([{'name': 'both', 'match': 'x', 'limit': 1, 'hint': 'y'}],
+                    rules_file)
+            self.assertRaises(RewriteRuleError, load_rules, path)
+        finally:
+            os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Text row encoder unit tests
+"""
+from unittest import main, TestCase
+from StringIO import StringIO
+
+
+class TextRowEncoderTest(TestCase):
+    """
+    Test that batched rows match ResultSetRowText packets
+    """
+    def runTest(self):
+        from mysqlproxy.row_encoder import TextRowEncoder
+        from mysqlproxy.query_response import ResultSetRowText
+        from mysqlproxy import column_types
+        from decimal import Decimal
+        from datetime import datetime
+
+        types = [column_types.LONG, column_types.VAR_STRING,
+            column_types.NEWDECIMAL, column_types.DATETIME, column_types.BLOB]
+        rows = [
+            [1, 'abc', Decimal('1.50'), datetime(2016, 1, 2, 3, 4, 5), None],
+            [2**40, 'x' * 300, None, None, '\x00\xff'],
+            ]
+        expected = StringIO()
+        seq_id = 4
+        for row in rows:
+            _, seq_id = ResultSetRowText(row, seq_id=seq_id+1).write_out(expected)
+
+        buf, next_seq_id = TextRowEncoder(types).encode_rows(rows, 5)
+        self.assertEqual(bytes(buf), expected.getvalue())
+        self.assertEqual(next_seq_id, 7)
+
+
+class TextFormatterTest(TestCase):
+    """
+    Test per-column value formatting
+    """
+    def runTest(self):
+        from mysqlproxy.row_encoder import TextRowEncoder, lenenc_int
+        from mysqlproxy import column_types
+        from datetime import timedelta
+
+        encoder = TextRowEncoder([column_types.TIME, column_types.VAR_STRING])
+        self.assertEqual(encoder.encode_row([timedelta(days=1, seconds=61), u'\xe9']),
+            b'\x0824:01:01\x02\xc3\xa9')
+        self.assertEqual(encoder.encode_row([-timedelta(seconds=1), None]),
+            b'\x09-00:00:01\xfb')
+        self.assertEqual(lenenc_int(251), b'\xfc\xfb\x00')
+        self.assertEqual(lenenc_int(1<<16), b'\xfd\x00\x00\x01')
+
+
+class TranscodingTest(TestCase):
+    """
+    Test charset transcoding between backend and client
+    """
+    def runTest(self):
+        from mysqlproxy.row_encoder import TextRowEncoder
+        from mysqlproxy.charset import make_transcoder, BINARY_CHARSET_ID
+        from mysqlproxy import column_types
+
+        utf8_id, latin1_id = 33, 8
+        self.assertEqual(make_transcoder(utf8_id, 45), None)
+        self.assertEqual(make_transcoder(utf8_id, BINARY_CHARSET_ID), None)
+        self.assertEqual(make_transcoder(utf8_id, latin1_id)(u'\xe9\u4e2d'.encode('utf8')),
+            b'\xe9?')
+
+        types = [column_types.VAR_STRING, column_types.BLOB]
+        value = u'\xe9'.encode('utf8')
+        encoder = TextRowEncoder(types, charset_id=latin1_id,
+            column_charsets=[utf8_id, BINARY_CHARSET_ID], backend_charset_id=utf8_id)
+        self.assertEqual(encoder.encode_row([value, value]),
+            b'\x01\xe9\x02\xc3\xa9')
+
+        # same charset on both ends, bytes go out untouched
+        encoder = TextRowEncoder(types, charset_id=utf8_id,
+            column_charsets=[utf8_id, BINARY_CHARSET_ID], backend_charset_id=utf8_id)
+        self.assertTrue(encoder.formatters[0](value) is value)
+        self.assertEqual(encoder.encode_row([u'\xe9', None]), b'\x02\xc3\xa9\xfb')
+
+
+if __name__ == '__main__':
+    main()
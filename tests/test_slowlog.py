@@ -0,0 +1,53 @@
+"""
+Slow query log unit tests
+"""
+from unittest import main, TestCase
+import tempfile
+import shutil
+import json
+import os
+
+
+class SlowQueryLogTest(TestCase):
+    """
+    Test slow and sampled queries get written, fast ones
+    don't, and a full queue drops instead of blocking
+    """
+    def runTest(self):
+        from mysqlproxy.slowlog import SlowQueryLog
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'slow.log')
+            slow_log = SlowQueryLog(path, threshold=0.5, sample_every=3, max_queue=3,
+                max_query_length=30)
+            self.assertTrue(slow_log.log('SELECT SLEEP(1) FROM t WHERE id = 42 AND x = 1',
+                1.2, backend_time=1.1, rows=1, nbytes=90, user='app', db='shop'))
+            self.assertFalse(slow_log.log('SELECT 1', 0.001))
+            self.assertFalse(slow_log.log('SELECT 2', 0.001))
+            self.assertTrue(slow_log.log('SELECT 3', 0.001))
+            self.assertTrue(slow_log.log('SELECT \xc3\xa9', 0.6, normalized='select ?'))
+            # no writer running, so the queue's full
+            self.assertFalse(slow_log.log('SELECT 4', 3.0))
+            self.assertEqual(slow_log.stats()['dropped'], 1)
+
+            slow_log.start()
+            slow_log.close()
+            with open(path) as log_file:
+                entries = [json.loads(line) for line in log_file]
+            self.assertEqual(len(entries), 3)
+            self.assertEqual(entries[0]['query'], 'SELECT SLEEP(1) FROM t WHERE i')
+            self.assertEqual(entries[0]['fingerprint'], 'select sleep(?) from t where i')
+            self.assertEqual((entries[0]['user'], entries[0]['db'], entries[0]['rows'],
+                entries[0]['bytes'], entries[0]['backend_time']), ('app', 'shop', 1, 90, 1.1))
+            self.assertFalse(entries[0]['sampled'])
+            self.assertTrue(entries[1]['sampled'])
+            self.assertEqual(entries[1]['query'], 'SELECT 3')
+            self.assertEqual(entries[2]['query'], u'SELECT \xe9')
+            stats = slow_log.stats()
+            self.assertEqual((stats['logged'], stats['written'], stats['batches']), (3, 3, 1))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Result set disk spill unit tests
+"""
+from unittest import main, TestCase
+from StringIO import StringIO
+import tempfile
+import shutil
+import struct
+import os
+
+
+def read_packets(data):
+    """
+    (seq id, payload) for each packet in `data`
+    """
+    packets = []
+    offset = 0
+    while offset < len(data):
+        header, = struct.unpack('<I', data[offset:offset + 4])
+        length = header & 0xffffff
+        packets.append((header >> 24, data[offset + 4:offset + 4 + length]))
+        offset += 4 + length
+    return packets
+
+
+class SpillTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def result_set(self, rows, seq_id=1, **kwargs):
+        from mysqlproxy.query_response import ResultSetText
+        from mysqlproxy import capabilities, column_types
+
+        result = ResultSetText(capabilities.PROTOCOL_41, seq_id=seq_id,
+            spill_dir=self.tmp_dir, **kwargs)
+        result.add_column(u'id', column_types.LONG, 11)
+        result.add_column(u'name', column_types.VAR_STRING, 255)
+        for row in rows:
+            result.add_row(row)
+        return result
+
+
+class SpillOutputTest(SpillTest):
+    """
+    Test spilled rows go out the same as rows kept in memory,
+    with sequence ids wrapping past 255
+    """
+    def runTest(self):
+        rows = [[x, 'row %d' % x] for x in range(1000)] + [[1000, None]]
+        expected = StringIO()
+        in_memory = self.result_set(rows)
+        in_memory.write_out(expected)
+
+        spilled = self.result_set(rows, spill_threshold=4096)
+        self.assertNotEqual(spilled.spill_file, None)
+        # past the threshold, no more than a batch is held at a time
+        self.assertTrue(len(spilled.rows) < spilled.ROW_BATCH_SIZE)
+        self.assertEqual(spilled.row_count, 1001)
+        out = StringIO()
+        self.assertEqual(spilled.write_out(out), in_memory.write_out(StringIO()))
+        self.assertEqual(out.getvalue(), expected.getvalue())
+        self.assertEqual(spilled.spill_file, None)
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+        # small enough results never touch the disk
+        small = self.result_set(rows[:10], spill_threshold=4096)
+        self.assertEqual(small.spill_file, None)
+
+
+class SpillRenumberTest(SpillTest):
+    """
+    Test spilled rows get their sequence ids patched when the
+    result set goes out later in a response than it expected
+    """
+    def runTest(self):
+        from mysqlproxy import spill
+
+        rows = [[x, 'x' * 100] for x in range(300)]
+        spilled = self.result_set(rows, spill_threshold=1024)
+        spilled.seq_id = 5
+        old_chunk_size, spill.CHUNK_SIZE = spill.CHUNK_SIZE, 4096
+        try:
+            out = StringIO()
+            _, last_seq_id = spilled.write_out(out)
+        finally:
+            spill.CHUNK_SIZE = old_chunk_size
+        packets = read_packets(out.getvalue())
+        # column count, 2 columns, EOF, rows, EOF
+        self.assertEqual(len(packets), 305)
+        self.assertEqual([seq_id for seq_id, _ in packets],
+            [seq_id & 0xff for seq_id in range(5, 310)])
+        self.assertEqual(last_seq_id, 309)
+        self.assertEqual(packets[4][1], '\x010' + '\x64' + 'x' * 100)
+
+
+class MaterializeTest(SpillTest):
+    """
+    Test a streaming result set can be fetched in full,
+    spilling as it goes
+    """
+    def runTest(self):
+        from mysqlproxy.query_response import StreamingResultSetText
+        from mysqlproxy import capabilities, column_types
+
+        rows = [[x, 'row %d' % x] for x in range(600)]
+        batches = [rows[:256], rows[256:512], rows[512:], []]
+        streaming = StreamingResultSetText(capabilities.PROTOCOL_41,
+            lambda size: batches.pop(0), has_more=lambda: False)
+        streaming.add_column(u'id', column_types.LONG, 11)
+        streaming.add_column(u'name', column_types.VAR_STRING, 255)
+        result = streaming.materialize(spill_threshold=2048, spill_dir=self.tmp_dir)
+        self.assertNotEqual(result.spill_file, None)
+        self.assertEqual(result.row_count, 600)
+
+        expected = StringIO()
+        self.result_set(rows).write_out(expected)
+        out = StringIO()
+        result.write_out(out)
+        self.assertEqual(out.getvalue(), expected.getvalue())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Schema-based tenant routing unit tests
+"""
+from unittest import main, TestCase
+import tempfile
+import socket
+import json
+import os
+
+from tests.fakes import FakeConnection
+
+
+def make_router():
+    from mysqlproxy.backend_group import BackendGroup
+    from mysqlproxy.tenant import TenantRouter
+
+    made = []
+    def make_group(backends):
+        group = BackendGroup(backends, connection_class=FakeConnection)
+        made.append(group)
+        return group
+    router = TenantRouter(make_group)
+    router.set_routes({'east': ['db1:3306', 'db2:3306'], 'west': ['/tmp/west.sock']},
+        {'acme': 'east', 'initech': 'west'}, 'east')
+    return router, made
+
+
+class TenantRouterTest(TestCase):
+    """
+    Test schemas map to their cluster's group, and reloads
+    keep the groups of clusters that didn't change
+    """
+    def runTest(self):
+        from mysqlproxy.tenant import TenantRouteError
+
+        router, made = make_router()
+        east, west = router.route('acme'), router.route(u'initech')
+        self.assertEqual([backend.name for backend in west.backends], ['/tmp/west.sock'])
+        self.assertTrue(router.route(None) is east)
+        self.assertTrue(router.route('unlisted') is east)
+        self.assertEqual([name for name, _ in router.groups()], ['east', 'west'])
+
+        self.assertRaises(TenantRouteError, router.set_routes, {'east': ['db1:3306']},
+            {'acme': 'north'}, 'east')
+        self.assertRaises(TenantRouteError, router.set_routes, {'east': ['db1:x']},
+            {}, 'east')
+        self.assertEqual(len(made), 2)
+
+        routes_fd, routes_path = tempfile.mkstemp(suffix='.json')
+        try:
+            with os.fdopen(routes_fd, 'w') as routes_file:
+                json.dump({'clusters': {'east': ['db1:3306', 'db2:3306'],
+                    'north': ['db9:3306']}, 'schemas': {'acme': 'east', 'initech': 'north'},
+                    'default': 'north'}, routes_file)
+            router.load(routes_path)
+        finally:
+            os.unlink(routes_path)
+        self.assertTrue(router.route('acme') is east)
+        north = router.route('initech')
+        self.assertEqual([backend.name for backend in north.backends], ['db9:3306'])
+        self.assertTrue(router.route(None) is north)
+        self.assertEqual(len(made), 3)
+        self.assertFalse(west.running)
+        stats = router.stats()
+        self.assertEqual((stats['clusters'], stats['schemas'], stats['loads'],
+            stats['lookups'], stats['defaulted']), (2, 2, 2, 7, 3))
+
+
+class SchemaSwitchTest(TestCase):
+    """
+    Test a session moves to the cluster of the schema it
+    switches to, and stays put when it can't move
+    """
+    def runTest(self):
+        from mysqlproxy.session import SQLProxy
+        from mysqlproxy.registry import SessionRegistry
+        from mysqlproxy.packet import OKPacket, ERRPacket
+        from mysqlproxy import status_flags
+
+        router, _ = make_router()
+        server_sock, client_sock = [socket.socket(_sock=sock) for sock in socket.socketpair()]
+        proxy = SQLProxy(server_sock.makefile('r+b', bufsize=0), tenant_router=router,
+            client_user='app', client_passwd='secret', registry=SessionRegistry(),
+            client_socket=server_sock)
+        first = proxy.backend()
+        self.assertEqual(first.address, 'db1:3306')
+
+        # same cluster, same connection
+        self.assertTrue(isinstance(proxy.change_db('acme'), OKPacket))
+        self.assertTrue(proxy.backend() is first)
+
+        proxy.state.charset = 'latin1'
+        self.assertTrue(isinstance(proxy.change_db('initech'), OKPacket))
+        moved = proxy.backend()
+        self.assertEqual((moved.address, moved.current_db, moved.charset),
+            ('/tmp/west.sock', 'initech', 'latin1'))
+        self.assertEqual(moved.kwargs['autocommit'], True)
+        self.assertTrue(proxy.backend_group is router.route('initech'))
+        self.assertEqual(first.socket, None)
+        self.assertEqual(proxy.state.default_db, 'initech')
+
+        # a schema the cluster doesn't have leaves the session where it was
+        response = proxy.change_db('missing')
+        self.assertTrue(isinstance(response, ERRPacket))
+        self.assertTrue(proxy.backend() is moved)
+
+        # nor does a USE inside a transaction
+        moved.server_status |= status_flags.STATUS_IN_TRANS
+        response = proxy.build_response_from_query('USE acme')
+        self.assertTrue(isinstance(response, ERRPacket))
+        self.assertEqual(proxy.state.default_db, 'initech')
+        self.assertTrue(proxy.backend() is moved)
+        self.assertEqual(router.stats()['switches'], 1)
+        client_sock.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Timer wheel and idle connection reaping unit tests
+"""
+from unittest import main, TestCase
+
+
+class TimerWheelTest(TestCase):
+    """
+    Test timers fire in the right slot, and not once cancelled
+    """
+    def runTest(self):
+        from mysqlproxy.timer_wheel import TimerWheel
+
+        fired = []
+        wheel = TimerWheel(tick=1.0, num_slots=4)
+        wheel.schedule(2, fired.append, 'a')
+        wheel.schedule(6, fired.append, 'b')
+        cancelled = wheel.schedule(1, fired.append, 'c')
+        wheel.cancel(cancelled)
+        self.assertEqual(wheel.active, 2)
+
+        wheel.advance()
+        self.assertEqual(fired, [])
+        wheel.advance()
+        self.assertEqual(fired, ['a'])
+        # 'b' is more than one revolution out
+        for _ in range(0, 3):
+            wheel.advance()
+        self.assertEqual(fired, ['a'])
+        wheel.advance()
+        self.assertEqual(fired, ['a', 'b'])
+        self.assertEqual(wheel.stats()['active'], 0)
+        self.assertEqual(wheel.stats()['fired'], 2)
+
+        ticks = []
+        repeating = wheel.every(1, ticks.append, 1)
+        wheel.advance()
+        wheel.advance()
+        self.assertEqual(ticks, [1, 1])
+        repeating.cancel()
+        wheel.advance()
+        self.assertEqual(ticks, [1, 1])
+
+
+class ReapIdleTest(TestCase):
+    """
+    Test stale pooled connections get closed
+    """
+    def runTest(self):
+        from mysqlproxy.pool import BackendPool
+        import time
+
+        class FakeConn(object):
+            server_capabilities = 0
+            closed = False
+            def close(self):
+                self.closed = True
+
+        pool = BackendPool(FakeConn, max_size=4)
+        stale = pool.acquire()
+        fresh = pool.acquire()
+        pool.release(stale)
+        pool.release(fresh)
+        pool.idle[0] = (stale, time.time() - 600)
+
+        self.assertEqual(pool.reap_idle(300), 1)
+        self.assertTrue(stale.closed)
+        self.assertFalse(fresh.closed)
+        stats = pool.stats()
+        self.assertEqual(stats['open'], 1)
+        self.assertEqual(stats['reaped'], 1)
+
+
+if __name__ == '__main__':
+    main()
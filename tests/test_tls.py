@@ -0,0 +1,160 @@
+"""
+TLS termination unit tests
+"""
+from unittest import main, TestCase
+import threading
+import tempfile
+import shutil
+import socket
+import struct
+import ssl
+
+from tests.fakes import FakeConnection, scramble
+
+
+def read_packet(sock):
+    header = ''
+    while len(header) < 4:
+        header += sock.recv(4 - len(header))
+    length = struct.unpack('<I', header[:3] + '\x00')[0]
+    payload = ''
+    while len(payload) < length:
+        payload += sock.recv(length - len(payload))
+    return ord(header[3]), payload
+
+
+def write_packet(sock, seq_id, payload):
+    sock.sendall(struct.pack('<I', len(payload))[:3] + chr(seq_id) + payload)
+
+
+class TLSTest(TestCase):
+    def setUp(self):
+        from mysqlproxy.tls import self_signed_cert, TLSError
+        self.tmp_dir = tempfile.mkdtemp()
+        try:
+            self.certfile, self.keyfile = self_signed_cert(self.tmp_dir)
+        except TLSError as ex:
+            shutil.rmtree(self.tmp_dir)
+            self.skipTest(str(ex))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def start_session(self, tls):
+        """
+        Proxy handshaking on one end of a socket pair in a
+        thread.  Returns the other end and the thread.
+        """
+        from mysqlproxy.session import SQLProxy
+        from mysqlproxy.pool import BackendPool
+        from mysqlproxy.registry import SessionRegistry
+        server_sock, client_sock = [socket.socket(_sock=sock) for sock in socket.socketpair()]
+        proxy = SQLProxy(server_sock.makefile('r+b', bufsize=0), pool=BackendPool(FakeConnection),
+            client_user='app', client_passwd='secret', registry=SessionRegistry(),
+            client_socket=server_sock, tls=tls)
+        result = {}
+        def handshake():
+            result['authenticated'] = proxy.session.do_handshake()
+        thread = threading.Thread(target=handshake)
+        thread.daemon = True
+        thread.start()
+        return proxy, client_sock, thread, result
+
+
+class TLSHandshakeTest(TLSTest):
+    """
+    Test a client asking for TLS gets its connection wrapped
+    before logging in
+    """
+    def runTest(self):
+        from mysqlproxy.tls import server_context, TLSTerminator
+        from mysqlproxy import capabilities
+
+        tls = TLSTerminator(server_context(self.certfile, self.keyfile))
+        client_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        caps = capabilities.PROTOCOL_41 | capabilities.SECURE_CONNECTION | capabilities.SSL
+        proxy, client_sock, thread, result = self.start_session(tls)
+
+        seq_id, greeting = read_packet(client_sock)
+        self.assertEqual(seq_id, 0)
+        nonce_start = greeting.index('\x00', 1) + 5
+        nonce = greeting[nonce_start:nonce_start + 8]
+        cap_lower = struct.unpack('<H', greeting[nonce_start + 9:nonce_start + 11])[0]
+        self.assertTrue(cap_lower & capabilities.SSL)
+        nonce += greeting[nonce_start + 27:nonce_start + 39]
+
+        fixed = struct.pack('<IIB', caps, 1<<24, 33) + '\x00' * 23
+        write_packet(client_sock, 1, fixed)
+        ssl_sock = client_context.wrap_socket(client_sock)
+        auth = scramble('secret', nonce)
+        write_packet(ssl_sock, 2, fixed + 'app\x00' + chr(len(auth)) + auth)
+        seq_id, response = read_packet(ssl_sock)
+        thread.join(5)
+        self.assertEqual((seq_id, response[0]), (3, '\x00'))
+        self.assertTrue(result['authenticated'])
+        self.assertNotEqual(proxy.session.tls_sock, None)
+        self.assertEqual(tls.stats()['handshakes'], 1)
+
+        # everything after the handshake goes over TLS too
+        proxy.session.out.write('\x01\x00\x00\x01\xfb')
+        proxy.session.out.flush()
+        self.assertEqual(read_packet(ssl_sock), (1, '\xfb'))
+
+        # closed with a close_notify, or the session can't be resumed
+        closer = threading.Thread(target=proxy.session.close)
+        closer.start()
+        ssl_sock.unwrap()
+        closer.join(5)
+        client_sock.close()
+
+
+class TLSRequiredTest(TLSTest):
+    """
+    Test clients not asking for TLS are turned away when it's
+    required, and let in otherwise
+    """
+    def runTest(self):
+        from mysqlproxy.tls import server_context, TLSTerminator
+        from mysqlproxy import capabilities, error_codes as errs
+
+        caps = capabilities.PROTOCOL_41 | capabilities.SECURE_CONNECTION
+        for required in (True, False):
+            tls = TLSTerminator(server_context(self.certfile, self.keyfile), required=required)
+            proxy, client_sock, thread, result = self.start_session(tls)
+            read_packet(client_sock)
+            write_packet(client_sock, 1, struct.pack('<IIB', caps, 1<<24, 33) + '\x00' * 23
+                + 'app\x00\x00')
+            seq_id, response = read_packet(client_sock)
+            thread.join(5)
+            self.assertFalse(result['authenticated'])
+            self.assertEqual(proxy.session.tls_sock, None)
+            self.assertEqual(seq_id, 2)
+            self.assertEqual(response[0], '\xff')
+            error_code = struct.unpack('<H', response[1:3])[0]
+            if required:
+                self.assertEqual(error_code, errs.INSECURE_TRANSPORT)
+            else:
+                # got as far as checking the (missing) password
+                self.assertEqual(error_code, errs.ACCESS_DENIED)
+            client_sock.close()
+
+
+class TLSContextTest(TLSTest):
+    """
+    Test cipher lists and session tickets get configured
+    """
+    def runTest(self):
+        from mysqlproxy.tls import server_context, TLSError, OP_NO_TICKET
+
+        context = server_context(self.certfile, self.keyfile)
+        self.assertFalse(context.options & OP_NO_TICKET)
+        context = server_context(self.certfile, self.keyfile, session_tickets=False,
+            ciphers='ECDHE+AESGCM')
+        self.assertTrue(context.options & OP_NO_TICKET)
+        self.assertRaises(TLSError, server_context, self.certfile, self.keyfile,
+            ciphers='NO-SUCH-CIPHER')
+        self.assertRaises(TLSError, server_context, self.tmp_dir + '/missing.pem')
+
+
+if __name__ == '__main__':
+    main()